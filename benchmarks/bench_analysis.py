@@ -0,0 +1,55 @@
+'''
+Compare vectorized arrival reconstruction against a record by record implementation,
+on synthetic prediction output, and time loading it from JSON lines.
+
+    python -m benchmarks.bench_analysis [--trips N] [--stops N] [--batch-size N]
+'''
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from munificent import analysis
+from munificent.bench import synthetic_prediction_records
+from munificent.io import serialize_records
+
+
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=100)
+    parser.add_argument('--stops', type=int, default=40)
+    parser.add_argument('--batch-size', type=int, default=100000)
+    args = parser.parse_args()
+
+    records = list(synthetic_prediction_records(args.trips, args.stops, random.Random(1)))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'predictions.jsonl')
+        with open(path, 'wb') as f:
+            f.write(serialize_records(records))
+
+        batches, load_time = timed(lambda: list(analysis.iter_prediction_batches([path], args.batch_size)))
+        _, naive_time = timed(lambda: analysis.naive_arrivals(records))
+        results, vectorized_time = timed(lambda: list(analysis.reconstruct_arrivals(batches)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    arrivals = sum(len(batch_arrivals['arrival']) for batch_arrivals, _ in results)
+    print("{} predictions, {} arrivals, batches of {}".format(len(records), arrivals, args.batch_size))
+    print("load (JSON lines) {:8.2f}s  {:8.0f} predictions/s".format(load_time, len(records) / load_time))
+    print("reconstruct       {:8.2f}s  {:8.0f} predictions/s".format(
+        vectorized_time, len(records) / vectorized_time))
+    print("naive             {:8.2f}s  {:8.0f} predictions/s  speedup: {:.1f}x".format(
+        naive_time, len(records) / naive_time, naive_time / vectorized_time))
+
+
+if __name__ == '__main__':
+    main()
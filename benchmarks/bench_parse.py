@@ -0,0 +1,46 @@
+'''
+Compare the dict and compact prediction parsers against the multiprediction.json
+fixture, with and without serializing the parsed records.
+
+    python -m benchmarks.bench_parse [--repeat N]
+'''
+import argparse
+import json
+import os
+import timeit
+
+from munificent.collect import parse_prediction_points, parse_prediction_points_compact
+from munificent.io import serialize_records
+
+FIXTURE = os.path.join(os.path.dirname(__file__), os.pardir, 'test', 'data', 'multiprediction.json')
+
+
+def best_time(fn, repeat, number):
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    with open(FIXTURE) as f:
+        result = json.load(f)
+    records = parse_prediction_points(result)
+    assert serialize_records(records) == serialize_records(parse_prediction_points_compact(result))
+
+    print("{} prediction records per response".format(len(records)))
+    for label, stage in [
+            ('parse', lambda parse: parse(result)),
+            ('parse + serialize', lambda parse: serialize_records(parse(result))),
+            ]:
+        baseline = best_time(lambda: stage(parse_prediction_points), args.repeat, args.number)
+        compact = best_time(lambda: stage(parse_prediction_points_compact), args.repeat, args.number)
+        print("{:<18} dict: {:8.1f}us  compact: {:8.1f}us  speedup: {:.2f}x".format(
+            label, baseline * 1e6, compact * 1e6, baseline / compact,
+        ))
+
+
+if __name__ == '__main__':
+    main()
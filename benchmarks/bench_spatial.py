@@ -0,0 +1,92 @@
+'''
+Compare `StopIndex` nearest-stop, radius and snapping queries against a brute-force
+scan over every stop, for a synthetic city of stops (or the reference database's).
+
+    python -m benchmarks.bench_spatial [--stops N] [--from-db]
+'''
+import argparse
+import random
+import timeit
+
+from munificent.collect import parse_vehicle_locations
+from munificent.bench import synthetic_vehicle_locations
+from munificent.spatial import IndexedStop, StopIndex, brute_force_nearest
+
+# Roughly the extent of San Francisco
+SOUTH, WEST, NORTH, EAST = 37.70, -122.51, 37.82, -122.36
+
+
+def synthetic_stops(count, routes, rng):
+    return [
+        IndexedStop(
+            str(i), 'Stop {}'.format(i),
+            rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST),
+            ('R{}'.format(i % routes),),
+        )
+        for i in range(count)
+    ]
+
+
+def best_time(fn, repeat, number):
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stops', type=int, default=3500)
+    parser.add_argument('--routes', type=int, default=80)
+    parser.add_argument('--from-db', action='store_true', default=False, help='Index the reference database')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    if args.from_db:
+        index = StopIndex.from_db()
+    else:
+        index = StopIndex(synthetic_stops(args.stops, args.routes, rng))
+    stops = index.stops
+    points = [(rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST)) for _ in range(args.number)]
+    routes = sorted(set(route for stop in stops for route in stop.routes))
+    records = []
+    for route in routes:
+        result = synthetic_vehicle_locations(route, 10, rng)
+        result['_meta'] = {'request_id': 'bench', 'timestamp': 0}
+        records.extend(parse_vehicle_locations(result))
+    for record in records:
+        record['lat'], record['lon'] = rng.choice(points)
+    for route in routes:
+        index.for_route(route)
+
+    def each_point(query):
+        return lambda: [query(lat, lon) for lat, lon in points]
+
+    def brute_force_snap(record):
+        route_stops = [stop for stop in stops if record['routeTag'] in stop.routes]
+        return brute_force_nearest(route_stops, record['lat'], record['lon'], 1, index.reference_lat)
+
+    print("{} stops on {} routes, {} vehicle locations".format(len(stops), len(routes), len(records)))
+    for label, indexed, brute_force, count in [
+            ('nearest', each_point(index.nearest),
+             each_point(lambda lat, lon: brute_force_nearest(stops, lat, lon, 1, index.reference_lat)),
+             len(points)),
+            ('nearest 10', each_point(lambda lat, lon: index.nearest(lat, lon, 10)),
+             each_point(lambda lat, lon: brute_force_nearest(stops, lat, lon, 10, index.reference_lat)),
+             len(points)),
+            ('within 500m', each_point(lambda lat, lon: index.within_radius(lat, lon, 500)),
+             each_point(lambda lat, lon: [s for s in brute_force_nearest(stops, lat, lon, len(stops),
+                                                                         index.reference_lat) if s[0] <= 500]),
+             len(points)),
+            ('snap', lambda: [index.snap(record) for record in records],
+             lambda: [brute_force_snap(record) for record in records],
+             len(records)),
+            ]:
+        indexed_time = best_time(indexed, args.repeat, 1) / count
+        brute_force_time = best_time(brute_force, args.repeat, 1) / count
+        print("{:<12} index: {:8.1f}us  brute force: {:8.1f}us  speedup: {:.0f}x".format(
+            label, indexed_time * 1e6, brute_force_time * 1e6, brute_force_time / indexed_time,
+        ))
+
+
+if __name__ == '__main__':
+    main()
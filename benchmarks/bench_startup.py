@@ -0,0 +1,78 @@
+'''
+Time how long each CLI subcommand takes to start, by running it in a fresh
+interpreter, and list the heaviest modules it imports.
+
+    python -m benchmarks.bench_startup [--repeat N]
+'''
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+COMMANDS = [
+    ['--help'],
+    ['version'],
+    ['targets'],
+    ['populate-db', '--help'],
+    ['collect', '--help'],
+]
+
+IMPORT_TIME = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def run(command, extra_flags=()):
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable] + list(extra_flags) + ['-m', 'munificent.cli'] + command,
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    _, stderr = process.communicate()
+    return time.time() - start, stderr.decode('utf-8')
+
+
+def time_interpreter():
+    start = time.time()
+    subprocess.call([sys.executable, '-c', ''])
+    return time.time() - start
+
+
+def heaviest_imports(stderr, count):
+    '''
+    Return the slowest top-level imports from `python -X importtime` output, as
+    (cumulative microseconds, module) pairs.
+    '''
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match and len(match.group(2)) == 1:
+            imports.append((int(match.group(1)), match.group(3)))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--imports', type=int, default=3, help='Number of heaviest imports to show')
+    args = parser.parse_args()
+
+    interpreter = min(time_interpreter() for _ in range(args.repeat))
+    print("bare interpreter{:<17} best: {:7.1f}ms".format('', interpreter * 1e3))
+    for command in COMMANDS:
+        times = sorted(run(command)[0] for _ in range(args.repeat))
+        print("munificent {:<22} best: {:7.1f}ms  median: {:7.1f}ms".format(
+            ' '.join(command), times[0] * 1e3, times[len(times) // 2] * 1e3,
+        ))
+        if args.imports:
+            _, stderr = run(command, ['-X', 'importtime'])
+            for micros, module in heaviest_imports(stderr, args.imports):
+                print("    {:<30} {:7.1f}ms".format(module, micros / 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,30 @@ class Config(object):
     def SQLALCHEMY_DBURI(self):
         return os.getenv('SQLALCHEMY_DBURI', 'sqlite:///nextbus.db')
 
+    @property
+    def NEXTBUS_CONNECT_TIMEOUT(self):
+        return float(os.getenv('NEXTBUS_CONNECT_TIMEOUT', '3.05'))
+
+    @property
+    def NEXTBUS_READ_TIMEOUT(self):
+        return float(os.getenv('NEXTBUS_READ_TIMEOUT', '10'))
+
+    @property
+    def NEXTBUS_RETRIES(self):
+        return int(os.getenv('NEXTBUS_RETRIES', '2'))
+
+    @property
+    def NEXTBUS_RETRY_BACKOFF(self):
+        return float(os.getenv('NEXTBUS_RETRY_BACKOFF', '0.5'))
+
+    @property
+    def NEXTBUS_ACCEPT_ENCODING(self):
+        return os.getenv('NEXTBUS_ACCEPT_ENCODING', 'gzip, deflate')
+
+    @property
+    def CACHE_DIR(self):
+        return os.getenv('MUNIFICENT_CACHE_DIR', os.path.expanduser('~/.cache/munificent'))
+
 
 config = Config()
 
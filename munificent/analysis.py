@@ -0,0 +1,335 @@
+'''
+Arrival reconstruction from collected predictions, vectorized with NumPy.
+Install with `pip install munificent[analysis]`.
+
+Collection output holds repeated snapshots of the predictions for each trip at each
+stop.  The trip's arrival at the stop is taken to be the last prediction made for it
+before it disappeared from the snapshots, and every earlier prediction can then be
+scored against that arrival.
+
+Predictions are loaded into batches of columns (dicts of equal length NumPy
+arrays) and each batch is reconstructed with sorts and array operations rather than
+per-record Python.  Batches must arrive in collection order, as a collector writes
+them: trips still being predicted at the end of a batch are carried over into the
+next one, so memory is bounded by the batch size plus the trips in flight, however
+long the input is.
+'''
+import gzip
+
+import numpy as np
+
+from munificent.io import (
+    JSON_LINES_EXTENSIONS, decode_lines, iter_lines, iter_output_files, read_metadata, serialize_records,
+)
+
+# Predictions of a (tripTag, stopTag) more than this many seconds apart are taken to
+# be of different trips, e.g. the same scheduled trip on another day
+DEFAULT_GAP = 600
+# A prediction that disappears while the arrival is still further away than this,
+# in seconds, is taken to be a cancellation or the end of collection, not an arrival
+DEFAULT_MAX_LEAD = 180
+
+TEXT_FIELDS = ('routeTag', 'stopTag', 'tripTag', 'vehicle')
+PREDICTION_FIELDS = ('request_timestamp', 'epochTime', 'isDeparture') + TEXT_FIELDS
+# Percentiles reported by `ErrorSummary`
+PERCENTILES = (10, 50, 90)
+# Upper edges, in seconds, of the prediction lead times `ErrorSummary` groups by
+LEAD_BUCKETS = (60, 120, 300, 600, 1200, 1800)
+
+
+def prediction_columns(records):
+    '''
+    Convert prediction records (dicts or `munificent.collect.PredictionPoint`s) into
+    a batch of columns, skipping other record types and predictions without a trip.
+    '''
+    return _columns([record for record in records if is_trip_prediction(record)])
+
+
+def is_trip_prediction(record):
+    return record.get('type') == 'prediction' and bool(record.get('tripTag'))
+
+
+def _columns(records):
+    batch = {
+        'request_timestamp': np.array([record['request_timestamp'] for record in records], dtype=np.float64),
+        'epochTime': np.array([record['epochTime'] for record in records], dtype=np.int64),
+        'isDeparture': np.array([record['isDeparture'] for record in records], dtype=bool),
+    }
+    for field in TEXT_FIELDS:
+        batch[field] = np.array([record[field] or '' for record in records], dtype=np.str_)
+    return batch
+
+
+def iter_prediction_batches(paths, batch_size=500000):
+    '''
+    Load the predictions in collection output files into batches of columns of up
+    to `batch_size` rows each.  `paths` are JSON lines files, optionally compressed,
+    Parquet files (which need pyarrow), or directories of them, whose files are read
+    in the order they were written (see `munificent.io.iter_output_files`).
+    '''
+    for path in iter_output_files(paths, JSON_LINES_EXTENSIONS + ('.parquet',)):
+        if path.endswith('.parquet'):
+            batches = _iter_parquet_batches(path, batch_size)
+        else:
+            batches = _iter_json_lines_batches(path, batch_size)
+        for batch in batches:
+            if len(batch['epochTime']):
+                yield batch
+
+
+def _iter_json_lines_batches(path, batch_size):
+    metadata = read_metadata(path)
+    if metadata is not None and 'prediction' not in metadata.types:
+        return
+    lines = []
+    for line in iter_lines(path):
+        # Cheap test to skip decoding vehicle locations, keyframes, etc.
+        if b'"prediction"' not in line:
+            continue
+        lines.append(line.strip())
+        if len(lines) >= batch_size:
+            yield _decode_batch(path, lines)
+            lines = []
+    yield _decode_batch(path, lines)
+
+
+def _decode_batch(path, lines):
+    records, _ = decode_lines(path, lines) if lines else ([], [])
+    return _columns([record for record in records if is_trip_prediction(record)])
+
+
+def _iter_parquet_batches(path, batch_size):
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    if 'tripTag' not in parquet_file.schema_arrow.names:
+        return
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size, columns=list(PREDICTION_FIELDS)):
+        record_batch = record_batch.filter(pc.invert(pc.is_null(record_batch.column('tripTag'))))
+        batch = {
+            'request_timestamp': record_batch.column('request_timestamp').to_numpy().astype(np.float64),
+            'epochTime': record_batch.column('epochTime').to_numpy().astype(np.int64),
+            'isDeparture': record_batch.column('isDeparture').fill_null(False).to_numpy(zero_copy_only=False),
+        }
+        for field in TEXT_FIELDS:
+            column = pc.cast(record_batch.column(field), 'string').fill_null('')
+            batch[field] = column.to_numpy(zero_copy_only=False).astype(np.str_)
+        yield batch
+
+
+def column_length(columns):
+    for values in columns.values():
+        return len(values)
+    return 0
+
+
+def concat_columns(batches):
+    batches = [batch for batch in batches if batch is not None]
+    return {field: np.concatenate([batch[field] for batch in batches]) for field in batches[0]}
+
+
+def take_columns(batch, index):
+    return {field: values[index] for field, values in batch.items()}
+
+
+def reconstruct(batch, gap=DEFAULT_GAP, max_lead=DEFAULT_MAX_LEAD, final_before=None):
+    '''
+    Reconstruct the arrivals in one batch of prediction columns.  Returns a tuple of
+    (arrivals, errors, pending) column batches:
+
+    - arrivals: one row per trip arrival at a stop, with its route, stop, trip,
+      vehicle and isDeparture, the `arrival` time (epoch milliseconds), when it was
+      `last_seen` (request timestamp) and the number of `predictions` made for it.
+    - errors: one row per prediction of those arrivals, with its route, stop, trip,
+      `request_timestamp` and `epochTime`, the `arrival`, the prediction's `error`
+      (seconds it was late by, negative if early) and its `lead` (seconds ahead of
+      the arrival it was made).
+    - pending: the rows of trips last seen at or after `final_before`, which may
+      still be predicted in the next batch.
+    '''
+    timestamps = batch['request_timestamp']
+    if not len(timestamps):
+        return {}, {}, None
+    _, trips = np.unique(batch['tripTag'], return_inverse=True)
+    _, stops = np.unique(batch['stopTag'], return_inverse=True)
+    keys = trips.ravel().astype(np.int64) * (stops.max() + 1) + stops.ravel()
+    order = np.lexsort((timestamps, keys))
+    keys, timestamps = keys[order], timestamps[order]
+
+    # Rows sorted by trip and stop, then time, split into one run per arrival
+    starts = np.empty(len(order), dtype=bool)
+    starts[0] = True
+    np.not_equal(keys[1:], keys[:-1], out=starts[1:])
+    starts[1:] |= np.diff(timestamps) > gap
+    run = np.cumsum(starts) - 1
+    last_rows = np.flatnonzero(np.append(starts[1:], True))
+    last = order[last_rows]
+
+    last_seen = timestamps[last_rows]
+    final = np.ones(len(last), dtype=bool) if final_before is None else last_seen < final_before
+    arrival = batch['epochTime'][last]
+    observed = final & (arrival - last_seen * 1000 <= max_lead * 1000)
+
+    arrivals = take_columns(batch, last)
+    del arrivals['epochTime'], arrivals['request_timestamp']
+    arrivals.update(
+        arrival=arrival,
+        last_seen=last_seen,
+        predictions=np.diff(np.append(np.flatnonzero(starts), len(order)))
+    )
+    arrivals = take_columns(arrivals, observed)
+
+    scored = observed[run]
+    rows = order[scored]
+    row_arrival = arrival[run[scored]]
+    errors = take_columns(batch, rows)
+    del errors['vehicle'], errors['isDeparture']
+    errors.update(
+        arrival=row_arrival,
+        error=(errors['epochTime'] - row_arrival) / 1000.0,
+        lead=row_arrival / 1000.0 - errors['request_timestamp'],
+    )
+
+    pending = None
+    if not final.all():
+        pending = take_columns(batch, np.sort(order[~final[run]]))
+    return arrivals, errors, pending
+
+
+def reconstruct_arrivals(batches, gap=DEFAULT_GAP, max_lead=DEFAULT_MAX_LEAD):
+    '''
+    Reconstruct arrivals from batches of prediction columns in collection order
+    (see `iter_prediction_batches`), yielding (arrivals, errors) column batches as
+    described for `reconstruct`.  A trip's arrival is yielded once nothing has been
+    predicted for it for `gap` seconds, or at the end of the input.
+    '''
+    pending = None
+    for batch in batches:
+        if pending is not None:
+            batch = concat_columns([pending, batch])
+        final_before = batch['request_timestamp'].max() - gap
+        arrivals, errors, pending = reconstruct(batch, gap, max_lead, final_before=final_before)
+        if column_length(arrivals):
+            yield arrivals, errors
+    if pending is not None:
+        arrivals, errors, _ = reconstruct(pending, gap, max_lead)
+        yield arrivals, errors
+
+
+def naive_arrivals(records, gap=DEFAULT_GAP, max_lead=DEFAULT_MAX_LEAD):
+    '''
+    Arrivals and prediction errors computed record by record, for testing and
+    benchmarking `reconstruct_arrivals`.  Returns lists of (tripTag, stopTag,
+    arrival) and (tripTag, stopTag, request_timestamp, epochTime, error) tuples.
+    '''
+    runs = {}
+    for record in records:
+        if record.get('type') != 'prediction' or not record.get('tripTag'):
+            continue
+        key = (record['tripTag'], record['stopTag'])
+        key_runs = runs.setdefault(key, [])
+        if not key_runs or record['request_timestamp'] - key_runs[-1][-1]['request_timestamp'] > gap:
+            key_runs.append([])
+        key_runs[-1].append(record)
+
+    arrivals, errors = [], []
+    for (trip, stop), key_runs in runs.items():
+        for run in key_runs:
+            last = run[-1]
+            arrival = last['epochTime']
+            if arrival - last['request_timestamp'] * 1000 > max_lead * 1000:
+                continue
+            arrivals.append((trip, stop, arrival))
+            for record in run:
+                error = (record['epochTime'] - arrival) / 1000.0
+                errors.append((trip, stop, record['request_timestamp'], record['epochTime'], error))
+    return arrivals, errors
+
+
+class ErrorSummary(object):
+    '''
+    Running summary of prediction errors by lead time bucket (see `LEAD_BUCKETS`).
+    Error percentiles are computed from histograms with `resolution` second bins,
+    so memory doesn't grow with the number of predictions.
+    '''
+
+    def __init__(self, lead_buckets=LEAD_BUCKETS, resolution=1.0, max_error=3600):
+        self.lead_buckets = np.asarray(lead_buckets, dtype=np.float64)
+        self.resolution = resolution
+        self.max_error = max_error
+        self._bins = int(2 * max_error / resolution) + 1
+        self._histograms = np.zeros((len(lead_buckets) + 1, self._bins), dtype=np.int64)
+        self.arrivals = 0
+
+    def add(self, arrivals, errors):
+        if not column_length(arrivals):
+            return
+        self.arrivals += column_length(arrivals)
+        buckets = np.searchsorted(self.lead_buckets, errors['lead'], side='left')
+        error_bins = np.clip(
+            np.round((errors['error'] + self.max_error) / self.resolution), 0, self._bins - 1).astype(np.int64)
+        np.add.at(self._histograms, (buckets, error_bins), 1)
+
+    def rows(self, percentiles=PERCENTILES):
+        '''
+        Yield (bucket label, predictions, mean absolute error, error percentiles...)
+        for each lead time bucket with predictions in it.
+        '''
+        edges = [0] + [int(edge) for edge in self.lead_buckets]
+        labels = ['{}-{}s'.format(lo, hi) for lo, hi in zip(edges, edges[1:])] + ['>{}s'.format(edges[-1])]
+        values = np.arange(self._bins) * self.resolution - self.max_error
+        for label, histogram in zip(labels, self._histograms):
+            count = histogram.sum()
+            if not count:
+                continue
+            cumulative = np.cumsum(histogram)
+            quantiles = [values[np.searchsorted(cumulative, count * p / 100.0)] for p in percentiles]
+            mean_absolute = float(np.dot(histogram, np.abs(values)) / count)
+            yield (label, int(count), mean_absolute) + tuple(float(q) for q in quantiles)
+
+
+def iter_column_rows(columns):
+    '''
+    Yield the rows of a batch of columns as dicts of Python values, for writing out.
+    '''
+    fields = sorted(columns)
+    for values in zip(*[columns[field].tolist() for field in fields]):
+        yield dict(zip(fields, values))
+
+
+class ColumnsWriter(object):
+    '''
+    Writes batches of columns to `path`, as Parquet if it ends in '.parquet' (which
+    needs pyarrow), otherwise as JSON lines, gzipped if it ends in '.gz'.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._handle = None
+        self._parquet_writer = None
+
+    def write(self, columns):
+        if not column_length(columns):
+            return
+        if self.path.endswith('.parquet'):
+            self._write_parquet(columns)
+        else:
+            if self._handle is None:
+                self._handle = (gzip.open if self.path.endswith('.gz') else open)(self.path, 'wb')
+            self._handle.write(serialize_records(iter_column_rows(columns)))
+
+    def _write_parquet(self, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pydict({field: columns[field] for field in sorted(columns)})
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, table.schema, compression='zstd')
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
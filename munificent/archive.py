@@ -0,0 +1,253 @@
+'''
+Append-only archive of raw API results, so that collected data can be regenerated
+with fixed or improved parsers (see `reprocess`).
+
+An archive is a directory of hourly segments.  Each segment is a pair of files:
+
+* '<YYYYMMDDHH>.raw.gz', in which every entry is a separately compressed gzip
+  member holding one JSON line, `{"probe": ..., "command": ..., "response": ...}`,
+  where the response includes its `_meta`.  Concatenated gzip members are a valid
+  gzip file, so `zcat` reads a segment as JSON lines.
+* '<YYYYMMDDHH>.idx', a JSON line per entry with its `offset` and `length` in the
+  segment, `timestamp`, `probe`, `command` and `request_id`.
+
+An entry is only indexed once it has been written, so a crash can leave at most an
+unindexed tail, which readers ignore.  Segments are never rewritten, so an archive
+can be copied or reprocessed while it is being appended to.  Only one process should
+append to an archive directory at a time.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from munificent.io import render_path_template, serialize_records
+
+LOG = logging.getLogger(__name__)
+
+SEGMENT_EXTENSION = '.raw.gz'
+INDEX_EXTENSION = '.idx'
+SEGMENT_INTERVAL = 3600
+
+# zlib window bits for gzip framing
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class RawArchive(object):
+    '''
+    Appends raw results to the archive in `directory`.  Safe to share between the
+    threads of a collector.
+    '''
+
+    def __init__(self, directory, compresslevel=6, clock=time.time):
+        self.directory = directory
+        self.compresslevel = compresslevel
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._segment = None
+        self._data = None
+        self._index = None
+
+    def append(self, probe, command, result):
+        '''
+        Archive `result`, the decoded response to a probe's request.  The result is
+        serialized immediately, so it may be modified (e.g. by a parser) afterwards.
+        '''
+        line = json.dumps({'probe': probe, 'command': command, 'response': result}, separators=(',', ':'))
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, GZIP_WBITS)
+        data = compressor.compress(line.encode('utf-8') + b'\n') + compressor.flush()
+        meta = result.get('_meta', {})
+        entry = {
+            'timestamp': meta.get('timestamp'),
+            'request_id': meta.get('request_id'),
+            'probe': probe,
+            'command': command,
+            'length': len(data),
+        }
+        with self._lock:
+            self._open(segment_name(self.clock()))
+            entry['offset'] = self._data.tell()
+            self._data.write(data)
+            self._data.flush()
+            self._index.write(json.dumps(entry, sort_keys=True) + '\n')
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _open(self, segment):
+        if segment == self._segment:
+            return
+        self._close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, segment)
+        self._data = open(path + SEGMENT_EXTENSION, 'ab')
+        self._index = open(path + INDEX_EXTENSION, 'a')
+        self._segment = segment
+
+    def _close(self):
+        if self._segment is None:
+            return
+        self._data.close()
+        self._index.close()
+        self._segment = self._data = self._index = None
+
+
+def segment_name(timestamp):
+    return render_path_template('{YYYYMMDDHH}', timestamp)
+
+
+def list_segments(directory, start=None, end=None):
+    '''
+    Return the paths (without extension) of the segments in the archive in
+    `directory` that may hold entries from between the `start` and `end` timestamps.
+    '''
+    first = segment_name(start - start % SEGMENT_INTERVAL) if start is not None else None
+    last = segment_name(end) if end is not None else None
+    segments = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(INDEX_EXTENSION):
+            continue
+        name = filename[:-len(INDEX_EXTENSION)]
+        if (first is None or name >= first) and (last is None or name <= last):
+            segments.append(os.path.join(directory, name))
+    return segments
+
+
+def read_index(segment):
+    '''
+    Read a segment's index, skipping a partly written last line.
+    '''
+    entries = []
+    with open(segment + INDEX_EXTENSION) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                LOG.warning("Skipping malformed index entry in {}: {!r}".format(segment, line))
+    return entries
+
+
+def iter_entries(segment, start=None, end=None, probes=None):
+    '''
+    Yield the archived entries of a segment, optionally only those with timestamps
+    in [start, end) and probe names matching one of the glob patterns in `probes`.
+    '''
+    index = [entry for entry in read_index(segment) if is_selected(entry, start, end, probes)]
+    with open(segment + SEGMENT_EXTENSION, 'rb') as f:
+        for entry in index:
+            f.seek(entry['offset'])
+            data = zlib.decompress(f.read(entry['length']), GZIP_WBITS)
+            yield json.loads(data.decode('utf-8'))
+
+
+def is_selected(entry, start=None, end=None, probes=None):
+    if start is not None and entry['timestamp'] < start:
+        return False
+    if end is not None and entry['timestamp'] >= end:
+        return False
+    return not probes or any(fnmatch.fnmatchcase(entry['probe'], p) for p in probes)
+
+
+def reprocess_segment(segment, output_path, output_format='jsonl', compress=False, compact=False,
+                      start=None, end=None, probes=None):
+    '''
+    Parse a segment's entries with the current parsers and write the records to
+    `output_path`, returning the number of (entries, records).
+    '''
+    from munificent.collect import get_record_parser
+    if output_format == 'parquet':
+        from munificent.columnar import ColumnarEmitter
+        writer = ColumnarWriter(ColumnarEmitter(output_path))
+    else:
+        writer = JSONLinesWriter(output_path, compress)
+
+    entries = records = 0
+    try:
+        for entry in iter_entries(segment, start, end, probes):
+            parsed = get_record_parser(entry['command'], compact)(entry['response'])
+            writer.write(parsed)
+            entries += 1
+            records += len(parsed)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return entries, records
+
+
+class JSONLinesWriter(object):
+    '''
+    Writes records to a JSON lines file under a temporary name, renaming it into place
+    when closed.
+    '''
+
+    def __init__(self, path, compress=False):
+        self.path = path
+        directory, filename = os.path.split(path)
+        self.tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(filename, os.getpid()))
+        self.handle = (gzip.open if compress else open)(self.tmp_path, 'wb')
+
+    def write(self, records):
+        self.handle.write(serialize_records(records))
+
+    def close(self):
+        self.handle.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        self.handle.close()
+        os.remove(self.tmp_path)
+
+
+class ColumnarWriter(object):
+
+    def __init__(self, emitter):
+        self.emitter = emitter
+
+    def write(self, records):
+        for record in records:
+            self.emitter.emit(record)
+
+    def close(self):
+        self.emitter.close()
+
+    def abort(self):
+        self.emitter.abort()
+
+
+def output_extension(output_format='jsonl', compress=False):
+    if output_format == 'parquet':
+        return '.parquet'
+    return '.jsonl.gz' if compress else '.jsonl'
+
+
+def reprocess(directory, output_dir, workers=None, output_format='jsonl', compress=False, compact=False,
+              start=None, end=None, probes=None):
+    '''
+    Reprocess the segments of the archive in `directory` in parallel, one segment per
+    task in a pool of `workers` processes (by default, one per CPU), writing one output
+    file per segment to `output_dir`.  Yields (segment, output path, entries, records)
+    as segments finish, in order.
+    '''
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    extension = output_extension(output_format, compress)
+    segments = list_segments(directory, start, end)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for segment in segments:
+            output_path = os.path.join(output_dir, os.path.basename(segment) + extension)
+            futures.append((segment, output_path, pool.submit(
+                reprocess_segment, segment, output_path, output_format, compress, compact, start, end, probes,
+            )))
+        for segment, output_path, future in futures:
+            entries, records = future.result()
+            yield segment, output_path, entries, records
@@ -0,0 +1,473 @@
+'''
+Load testing without the live API.  `FakeNextBusServer` is a local stand-in for the
+NextBus JSON feed that serves recorded or synthetic `predictionsForMultiStops` and
+`vehicleLocations` payloads with configurable latency, size and error rate, and
+`run_bench` runs the real collection pipeline against it, reporting throughput,
+per-cycle work time, CPU time and peak memory.
+'''
+import gzip
+import io
+import json
+import math
+import logging
+import multiprocessing
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+from munificent import metrics
+from munificent.collect import Collector, get_location_probes, get_prediction_probes
+from munificent.schedule import PhasedScheduler, Tick
+
+LOG = logging.getLogger(__name__)
+
+FEED_PATH = '/service/publicJSONFeed'
+
+# The member of a recorded payload that identifies which command it answers
+RECORDED_COMMANDS = {
+    'predictions': 'predictionsForMultiStops',
+    'vehicle': 'vehicleLocations',
+}
+
+
+def synthetic_plan(routes, stops_per_route, agency='sf-muni'):
+    '''
+    A probe plan (see `munificent.collect.build_probe_plan`) for made-up routes.
+    '''
+    return [
+        {
+            'agency': agency,
+            'route': 'R{}'.format(r),
+            'stop_codes': ['R{}|{}'.format(r, 1000 + s) for s in range(stops_per_route)],
+        }
+        for r in range(routes)
+    ]
+
+
+def synthetic_predictions(stop_codes, per_stop, rng, now=None):
+    now_ms = int((now or time.time()) * 1000)
+    predictions = []
+    for stop_code in stop_codes:
+        route, _, stop = stop_code.partition('|')
+        points = []
+        for i in range(per_stop):
+            seconds = rng.randint(0, 600) + i * 600
+            points.append({
+                'epochTime': str(now_ms + seconds * 1000),
+                'seconds': str(seconds),
+                'minutes': str(seconds // 60),
+                'isDeparture': 'false',
+                'affectedByLayover': 'true' if i else 'false',
+                'dirTag': '{}____I_F00'.format(route),
+                'vehicle': str(1000 + i),
+                'block': str(9800 + i),
+                'tripTag': str(8260000 + i),
+            })
+        predictions.append({
+            'agencyTitle': 'San Francisco Muni',
+            'routeTag': route,
+            'routeTitle': route,
+            'stopTag': stop,
+            'stopTitle': 'Stop {}'.format(stop),
+            # NextBus returns a bare object rather than a list of one
+            'direction': {'title': 'Inbound', 'prediction': points[0] if len(points) == 1 else points},
+        })
+    return {'predictions': predictions, 'copyright': 'Synthetic data'}
+
+
+def synthetic_vehicle_locations(route, vehicles, rng, now=None):
+    now_ms = int((now or time.time()) * 1000)
+    return {
+        'vehicle': [
+            {
+                'id': str(1000 + v),
+                'routeTag': route,
+                'dirTag': '{}____O_F00'.format(route),
+                'lat': '{:.6f}'.format(37.7 + rng.random() / 10),
+                'lon': '{:.6f}'.format(-122.5 + rng.random() / 10),
+                'heading': str(rng.randint(0, 359)),
+                'predictable': 'true',
+                'secsSinceReport': str(rng.randint(0, 60)),
+                'speedKmHr': str(rng.randint(0, 50)),
+            }
+            for v in range(vehicles)
+        ],
+        'lastTime': {'time': str(now_ms)},
+        'copyright': 'Synthetic data',
+    }
+
+
+def synthetic_prediction_records(trips, stops, rng, start=1550000000, headway=300, travel=120, period=30,
+                                 horizon=1800):
+    '''
+    Yield prediction records, in collection order, as if every `period` seconds the
+    predictions of a route with `stops` stops were collected while `trips` trips
+    ran along it, one every `headway` seconds, taking `travel` seconds between stops.
+    Each stop is predicted from `horizon` seconds before a trip reaches it until it
+    does, with errors that shrink as the trip gets closer.
+    '''
+    arrivals = [[start + t * headway + s * travel for s in range(stops)] for t in range(trips)]
+    end = arrivals[-1][-1]
+    poll = start - horizon
+    while poll < end:
+        request_id = 'synthetic-{}'.format(poll)
+        for t, trip_arrivals in enumerate(arrivals):
+            for s, arrival in enumerate(trip_arrivals):
+                lead = arrival - poll
+                if not 0 < lead <= horizon:
+                    continue
+                predicted = arrival + int(rng.gauss(0, 0.1 * lead))
+                yield {
+                    'type': 'prediction',
+                    'request_id': request_id,
+                    'request_timestamp': poll,
+                    'routeTag': 'R',
+                    'stopTag': str(s),
+                    'routeTitle': 'Route R',
+                    'stopTitle': 'Stop {}'.format(s),
+                    'epochTime': predicted * 1000,
+                    'seconds': max(predicted - poll, 0),
+                    'minutes': max(predicted - poll, 0) // 60,
+                    'isDeparture': s == 0,
+                    'block': str(9800 + t % 10),
+                    'vehicle': str(1000 + t % 40),
+                    'dirTag': 'R____I_F00',
+                    'tripTag': str(8260000 + t),
+                    'affectedByLayover': False,
+                }
+        poll += period
+
+
+def load_recorded(paths):
+    '''
+    Load recorded API responses from JSON files, keyed by the command they answer.
+    '''
+    recorded = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            body = f.read()
+        payload = json.loads(body.decode('utf-8'))
+        commands = [command for key, command in RECORDED_COMMANDS.items() if key in payload]
+        if not commands:
+            raise ValueError("Not a recorded prediction or vehicle location response: {}".format(path))
+        recorded[commands[0]] = body
+    return recorded
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeNextBusServer(object):
+    '''
+    Serves NextBus JSON feed responses at `url`.  Each request waits `latency`
+    seconds (plus up to `jitter` more) and fails with a 503 with probability
+    `error_rate`.  Prediction and vehicle location requests are answered with the
+    `recorded` response for their command if there is one, or else with synthetic
+    data for the requested stops or route, sized by `predictions_per_stop` and
+    `vehicles_per_route`.  Responses are gzipped for clients that accept it.
+
+    Use `start` to serve from a thread in this process, or `start_process` to keep
+    the server's CPU use out of measurements of this one.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 predictions_per_stop=3, vehicles_per_route=10, recorded=None, compress=True, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.predictions_per_stop = predictions_per_stop
+        self.vehicles_per_route = vehicles_per_route
+        self.recorded = recorded or {}
+        self.compress = compress
+        self.rng = random.Random(seed)
+        self._server = None
+        self._process = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}{}'.format(self.host, self.port, FEED_PATH)
+
+    def start(self):
+        self._server = self._make_server()
+        thread = threading.Thread(target=self._server.serve_forever, name='fake-nextbus')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def start_process(self, timeout=10.0):
+        if not self.port:
+            self.port = find_free_port(self.host)
+        self._process = multiprocessing.Process(target=self._serve, name='fake-nextbus')
+        self._process.daemon = True
+        self._process.start()
+        wait_for_port(self.host, self.port, timeout)
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def respond(self, path, accept_encoding=''):
+        '''
+        Return the (status, headers, body) of the response to a GET of `path`.
+        '''
+        url = urlsplit(path)
+        params = parse_qs(url.query)
+        command = params.get('command', [None])[0]
+        rng = self.rng
+
+        delay = self.latency + (rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if url.path != FEED_PATH:
+            return 404, {}, b''
+        if self.error_rate and rng.random() < self.error_rate:
+            return 503, {}, b'Service Unavailable'
+
+        if command in self.recorded:
+            body = self.recorded[command]
+        elif command == 'predictionsForMultiStops':
+            body = self._encode(synthetic_predictions(params.get('stops', []), self.predictions_per_stop, rng))
+        elif command == 'vehicleLocations':
+            route = params.get('r', [''])[0]
+            body = self._encode(synthetic_vehicle_locations(route, self.vehicles_per_route, rng))
+        else:
+            body = self._encode({'Error': {'content': 'Unsupported command: {}'.format(command)}})
+
+        headers = {'Content-Type': 'application/json;charset=UTF-8'}
+        if self.compress and 'gzip' in accept_encoding:
+            body = gzip_bytes(body)
+            headers['Content-Encoding'] = 'gzip'
+        return 200, headers, body
+
+    def _encode(self, payload):
+        return json.dumps(payload).encode('utf-8')
+
+    def _serve(self):
+        self._make_server().serve_forever()
+
+    def _make_server(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, and with Nagle's algorithm the
+            # body would wait on the client's delayed ACK of the headers
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                status, headers, body = fake.respond(self.path, self.headers.get('Accept-Encoding', ''))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = server.server_address[1]
+        return server
+
+
+def gzip_bytes(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def find_free_port(host):
+    sock = socket.socket()
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def wait_for_port(host, port, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except socket.error:
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+class UnthrottledScheduler(PhasedScheduler):
+    '''
+    Scheduler that fires each tick as soon as the consumer asks for it, without
+    sleeping, so that a benchmark measures how fast the pipeline can collect rather
+    than how the schedule paces it.
+    '''
+
+    def ticks(self, slots, cycles=None):
+        end = None if cycles is None else cycles * slots
+        index = 0
+        while (end is None or index < end) and not self.stopped:
+            self.ticks_fired += 1
+            yield Tick(index // slots, index % slots, self.clock(), 0.0)
+            index += 1
+
+
+class SleepTimer(object):
+    '''
+    A `sleep` function that adds up the time it actually spends asleep.
+    '''
+
+    def __init__(self):
+        self.slept = 0.0
+
+    def __call__(self, seconds):
+        start = time.time()
+        try:
+            time.sleep(seconds)
+        finally:
+            self.slept += time.time() - start
+
+
+class CountingEmitter(object):
+    '''
+    Emitter wrapper that counts the records passed through it.
+    '''
+
+    def __init__(self, emitter):
+        self.emitter = emitter
+        self.records = 0
+
+    def emit(self, record):
+        self.records += 1
+        self.emitter.emit(record)
+
+    def flush(self):
+        self.emitter.flush()
+
+    def request_flush(self):
+        self.emitter.request_flush()
+
+    def close(self):
+        self.emitter.close()
+
+
+def run_bench(api, plan, emitter, cycles=10, period=1.0, paced=False, concurrency=1,
+              overrun=PhasedScheduler.COALESCE, compact=False, stream=False, stops_per_request=None, locations=True):
+    '''
+    Collect predictions (and vehicle locations, with `locations`) for every route in
+    `plan` for `cycles` cycles, returning a dict of measurements.
+
+    Cycles run back to back, each starting as soon as the last one's records are
+    emitted, unless `paced`, in which case each cycle's probes are spread over
+    `period` seconds as in collection.  Either way, concurrent probes must finish
+    within `period` seconds of starting.  A cycle's work time is its wall time less
+    any time the scheduler spent sleeping.  Time spent closing the emitter, which
+    writes out anything it buffered, is included in the elapsed time.
+    '''
+    probes = get_prediction_probes(api, plan, compact=compact, stream=stream, stops_per_request=stops_per_request)
+    if locations:
+        probes += get_location_probes(api, plan, stream=stream)
+    counting = CountingEmitter(emitter)
+    sleep = SleepTimer()
+    scheduler = (PhasedScheduler if paced else UnthrottledScheduler)(period, overrun=overrun, sleep=sleep)
+    collector = Collector(probes, counting, period=period, concurrency=concurrency, scheduler=scheduler)
+    errors_before = probe_error_count(probes)
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    work_times = []
+    start = time.time()
+    try:
+        # A cycle at a time, so that all `cycles` run even if the paced scheduler skips ticks
+        for _ in range(cycles):
+            cycle_start, slept_before = time.time(), sleep.slept
+            collector.run(cycles=1)
+            work_times.append(time.time() - cycle_start - (sleep.slept - slept_before))
+    finally:
+        counting.close()
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+    work_times.sort()
+    return {
+        'probes': len(probes),
+        'cycles': len(work_times),
+        'paced': paced,
+        'records': counting.records,
+        'elapsed_s': elapsed,
+        'records_per_s': counting.records / elapsed,
+        'cycles_per_s': len(work_times) / elapsed,
+        'cycle_p50_s': percentile(work_times, 50),
+        'cycle_p99_s': percentile(work_times, 99),
+        'cpu_s': cpu,
+        'cpu_percent': 100.0 * cpu / elapsed,
+        'peak_rss_mb': peak_rss_mb(usage),
+        'probe_errors': probe_error_count(probes) - errors_before,
+        'overruns': scheduler.overruns,
+        'ticks_skipped': scheduler.ticks_skipped,
+    }
+
+
+def probe_error_count(probes):
+    return sum(
+        metrics.PROBE_ERRORS.value(probe=p.name) + metrics.PROBE_DEADLINES_MISSED.value(probe=p.name)
+        for p in probes
+    )
+
+
+def percentile(values, pct):
+    '''
+    Nearest-rank percentile of sorted `values`.
+    '''
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+    return usage.ru_maxrss / scale
+
+
+def format_report(results):
+    lines = [
+        "{probes} probes, {cycles} cycles, {records} records in {elapsed_s:.2f}s".format(**results),
+        "throughput:    {records_per_s:10.1f} records/s  {cycles_per_s:8.3f} cycles/s".format(**results),
+    ]
+    if results['cycles']:
+        lines.append("cycle work:    p50 {:.3f}s  p99 {:.3f}s{}".format(
+            results['cycle_p50_s'], results['cycle_p99_s'], '  (paced)' if results['paced'] else ''))
+    lines.extend([
+        "cpu:           {cpu_s:10.2f}s ({cpu_percent:.0f}% of one core)".format(**results),
+        "peak rss:      {peak_rss_mb:10.1f} MB".format(**results),
+        "probe errors:  {probe_errors:10d}  overruns: {overruns}  ticks skipped: {ticks_skipped}".format(**results),
+    ])
+    return '\n'.join(lines)
@@ -1,17 +1,17 @@
 import argparse
+import functools
 import logging
 import os
 import signal
 import sys
 
-from munificent import __version__, db
-import munificent.collect
-from munificent.collect import Collector
-from munificent.io import Emitter, open_file_gzip, open_file_normal
-from munificent.nextbus import NextBusAPI
+from munificent import __version__, config
+from munificent.schedule import PhasedScheduler
+
+# Modules that pull in SQLAlchemy or requests are imported by the subcommands that
+# use them, so that lightweight commands like 'version' start quickly.
 
 LOG = logging.getLogger(__name__)
-Session = db.configured_session()
 
 
 def build_parser():
@@ -30,23 +30,380 @@ def build_parser():
     targets = subparsers.add_parser('targets')
     targets.set_defaults(func=list_targets)
 
+    # populate-db
+    populate = subparsers.add_parser('populate-db')
+    populate.add_argument(
+        '--agency',
+        action='append',
+        dest='agencies',
+        help='''
+        Tag of an agency to load routes and stops for.  May be given more than once;
+        defaults to sf-muni.
+        ''',
+    )
+    populate.add_argument(
+        '--reload',
+        action='store_true',
+        default=False,
+        help='Drop and recreate the reference tables before loading',
+    )
+    populate.set_defaults(func=populate_reference_db)
+
+    # migrate-db
+    migrate = subparsers.add_parser(
+        'migrate-db',
+        help='Add any tables and indexes missing from an existing reference database',
+    )
+    migrate.set_defaults(func=migrate_reference_db)
+
+    # search
+    search = subparsers.add_parser('search', help='Search the reference database for routes and stops')
+    search.add_argument('query', nargs='+', help='Tag, title, stop ID, or the start of one')
+    search.add_argument(
+        '--kind',
+        action='append',
+        dest='kinds',
+        choices=['route', 'stop'],
+        help='Only return routes or stops.  May be given more than once.',
+    )
+    search.add_argument('--agency', help='Only return routes and stops of this agency')
+    search.add_argument('--limit', default=10, type=int)
+    search.add_argument('--json', action='store_true', default=False, help='Print results as JSON lines')
+    search.set_defaults(func=search_reference_db)
+
     # collect
     collect = subparsers.add_parser('collect')
     collect.add_argument(
         '--period',
         default=60.0,
-        type=float,
+        type=parse_positive_float,
         help=''''
         Period of time between repeated queries, in seconds.  All queries in
         the specified query sets will be run over this time period.
         '''
     )
+    collect.add_argument(
+        '--concurrency',
+        default=1,
+        type=int,
+        help='''
+        Maximum number of probes to run at the same time.  With a value above 1,
+        each cycle's probes run in parallel and must finish within the period.
+        '''
+    )
+    collect.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='''
+        Number of worker processes to split the probes between.  Each worker writes
+        to its own output, named by filling in {worker} in the output path or by
+        adding '-w<N>' to the file name.  Crashed workers are restarted.
+        '''
+    )
+    collect.add_argument(
+        '--shard-by',
+        default='route',
+        choices=['route', 'target'],
+        help='''
+        How to assign probes to workers: 'route' keeps each route's probes together,
+        'target' keeps each kind of probe (predictions or locations) together
+        '''
+    )
+    collect.add_argument(
+        '--overrun',
+        default=PhasedScheduler.SKIP,
+        choices=PhasedScheduler.OVERRUN_POLICIES,
+        help='''
+        What to do with probe ticks that come due while collection is running behind:
+        'skip' runs the overdue probe late and drops the ticks whose slots went by
+        entirely, 'coalesce' runs each overdue probe once for all the cycles it missed.
+        '''
+    )
+    collect.add_argument(
+        '--compact-records',
+        action='store_true',
+        default=False,
+        help='''
+        Parse predictions into compact records that share per-stop context.  The
+        output is identical, but parsing and serialization are faster.
+        '''
+    )
+    collect.add_argument(
+        '--stream',
+        action='store_true',
+        default=False,
+        help='''
+        Decode responses incrementally, parsing and emitting records as they arrive
+        instead of loading each full response into memory first.
+        '''
+    )
+    collect.add_argument(
+        '--stops-per-request',
+        type=int,
+        help='''
+        Split each route's prediction request into sub-requests for at most this many
+        stops, which are performed in parallel and merged into one result.
+        '''
+    )
+    collect.add_argument(
+        '--connect-timeout',
+        default=config.NEXTBUS_CONNECT_TIMEOUT,
+        type=float,
+        help='Seconds to wait for a connection to the API (default: $NEXTBUS_CONNECT_TIMEOUT or 3.05)',
+    )
+    collect.add_argument(
+        '--read-timeout',
+        default=config.NEXTBUS_READ_TIMEOUT,
+        type=float,
+        help='Seconds to wait for the API to send data (default: $NEXTBUS_READ_TIMEOUT or 10)',
+    )
+    collect.add_argument(
+        '--command-timeout',
+        action='append',
+        type=parse_command_timeout,
+        dest='command_timeouts',
+        help='''
+        Timeouts for one API command, as COMMAND=READ or COMMAND=CONNECT,READ, e.g.
+        'vehicleLocations=5'.  May be given more than once.
+        '''
+    )
+    collect.add_argument(
+        '--retries',
+        default=config.NEXTBUS_RETRIES,
+        type=int,
+        help='''
+        Times to retry a request after a connection error or a 429 or 5xx response
+        (default: $NEXTBUS_RETRIES or 2)
+        '''
+    )
+    collect.add_argument(
+        '--retry-backoff',
+        default=config.NEXTBUS_RETRY_BACKOFF,
+        type=float,
+        help='''
+        Base of the exponential backoff between retries, in seconds; each wait is
+        randomly jittered (default: $NEXTBUS_RETRY_BACKOFF or 0.5)
+        '''
+    )
+    collect.add_argument(
+        '--pool-size',
+        type=int,
+        help='''
+        Number of keep-alive connections to the API to hold open for reuse.  Defaults
+        to enough for --concurrency probes, or for parallel sub-requests with
+        --stops-per-request.
+        '''
+    )
+    collect.add_argument(
+        '--accept-encoding',
+        default=config.NEXTBUS_ACCEPT_ENCODING,
+        help='''
+        Accept-Encoding header to send to the API; an empty value disables response
+        compression (default: $NEXTBUS_ACCEPT_ENCODING or 'gzip, deflate')
+        '''
+    )
+    collect.add_argument(
+        '--skip-unchanged',
+        action='store_true',
+        default=False,
+        help='''
+        Make conditional requests and skip responses that are identical to the
+        previous response for the same request, instead of parsing and emitting them.
+        '''
+    )
+    collect.add_argument(
+        '--incremental-locations',
+        action='store_true',
+        default=False,
+        help='''
+        Only request vehicle locations that have been reported since the previous
+        request for the same route, rather than every vehicle on every request.
+        '''
+    )
+    collect.add_argument(
+        '--delta',
+        action='store_true',
+        default=False,
+        help='''
+        Only emit records that changed since the previous result for the same probe,
+        plus 'tombstone' records for those that disappeared and a periodic 'keyframe'
+        of the full state.
+        '''
+    )
+    collect.add_argument(
+        '--keyframe-interval',
+        default=600.0,
+        type=float,
+        help='Seconds between full keyframes in --delta mode',
+    )
+    collect.add_argument(
+        '--delta-ttl',
+        default=600.0,
+        type=float,
+        help='''
+        Seconds after which a vehicle missing from incremental location results is
+        considered gone in --delta mode
+        '''
+    )
+    collect.add_argument(
+        '--delta-max-entries',
+        default=100000,
+        type=int,
+        help='Maximum number of records remembered per probe in --delta mode',
+    )
+    collect.add_argument(
+        '--format',
+        default='jsonl',
+        choices=OUTPUT_FORMATS,
+        help='''
+        Output format.  'parquet' (requires pyarrow) writes one file per record type,
+        named by filling in {type} in the output path or by inserting the type before
+        its extension, and starts new files every million records and every
+        --rotate-interval seconds (by default hourly).  'db' inserts records into the
+        predictions and vehicle_locations tables of the database at the output path, a
+        SQLAlchemy URL or a SQLite file, in batches of --batch-size committed at least
+        every --flush-interval seconds.  Compression, --rotate-size and --buffered
+        apply to 'jsonl'.
+        '''
+    )
     collect.add_argument(
         '--gzip',
         action='store_true',
         default=False,
         help='Whether to apply gzip compression to the output file(s)',
     )
+    collect.add_argument(
+        '--rotate-size',
+        type=parse_size,
+        help='''
+        Start a new output file once the current one reaches this size, in bytes or
+        with a K, M or G suffix.  Enables output rotation (see --rotate-interval).
+        '''
+    )
+    collect.add_argument(
+        '--rotate-interval',
+        type=int,
+        help='''
+        Start a new output file every this many seconds, aligned to the clock (e.g.
+        3600 for hourly files).  With rotation enabled, the output path is a template
+        that may use {target}, {YYYYMMDD}, {YYYYMMDDHH}, {YYYYMMDDHHMM} and {time},
+        e.g. '{target}-{YYYYMMDDHH}.jsonl.gz'.  Each file is written under a hidden
+        temporary name until it rotates.  If collection dies, the next run renames the
+        leftover file into place, losing only what hadn't been flushed to it.
+        '''
+    )
+    collect.add_argument(
+        '--buffered',
+        action='store_true',
+        default=False,
+        help='''
+        Serialize, compress and write records in batches on a background thread
+        instead of on the collection thread.
+        '''
+    )
+    collect.add_argument(
+        '--batch-size',
+        default=1000,
+        type=int,
+        help='Maximum number of records per buffered write or database transaction',
+    )
+    collect.add_argument(
+        '--flush-interval',
+        default=1.0,
+        type=float,
+        help='Maximum time in seconds a buffered record waits before being written (or committed)',
+    )
+    collect.add_argument(
+        '--queue-size',
+        default=10000,
+        type=int,
+        help='Number of buffered records waiting to be written before collection blocks',
+    )
+    collect.add_argument(
+        '--no-probe-cache',
+        action='store_true',
+        default=False,
+        help='''
+        Always build probes from the reference database, rather than reusing the
+        probe plan cached under $MUNIFICENT_CACHE_DIR while the database is unchanged.
+        '''
+    )
+    collect.add_argument(
+        '--metrics-port',
+        type=int,
+        help='''
+        Serve collector metrics in the Prometheus text format at
+        http://<metrics-host>:<port>/metrics.  With --workers, worker N uses port + N.
+        '''
+    )
+    collect.add_argument(
+        '--metrics-host',
+        default='127.0.0.1',
+        help='Address to serve metrics on (default: 127.0.0.1)',
+    )
+    collect.add_argument(
+        '--stats-file',
+        help='''
+        Periodically write collector metrics in the Prometheus text format to this
+        file, e.g. for node_exporter's textfile collector.  With --workers, each worker
+        writes its own file, named like the output files.
+        '''
+    )
+    collect.add_argument(
+        '--stats-interval',
+        default=15.0,
+        type=float,
+        help='Seconds between writes of --stats-file',
+    )
+    collect.add_argument(
+        '--profile',
+        action='store_true',
+        default=False,
+        help='''
+        Profile the first --profile-cycles collection cycles.  A running collector
+        can also be profiled at any time by sending it SIGUSR1.
+        '''
+    )
+    collect.add_argument(
+        '--profile-cycles',
+        default=3,
+        type=int,
+        help='Number of collection cycles to profile at a time',
+    )
+    collect.add_argument(
+        '--profile-output',
+        default='munificent-profile-{YYYYMMDDHHMM}',
+        help='''
+        Template for profile report paths, filled in like rotated output paths.  Each
+        profile writes a stage timing summary to <path>.txt and a pstats dump per
+        probe to <path>.<probe>.pstats.
+        '''
+    )
+    collect.add_argument(
+        '--snap-stops',
+        action='store_true',
+        default=False,
+        help='''
+        Add the nearest stop on its route to each vehicle location, as nearestStopTag
+        and nearestStopDistance (in meters), using the stops in the reference database
+        '''
+    )
+    collect.add_argument(
+        '--snap-max-distance',
+        default=1000.0,
+        type=float,
+        help='Only snap vehicle locations to stops within this many meters (default: 1000)',
+    )
+    collect.add_argument(
+        '--raw-archive',
+        metavar='DIR',
+        help='''
+        Also archive every raw API result, compressed and indexed, to this directory,
+        so that the output can be regenerated later with 'reprocess'.  With --workers,
+        each worker writes its own archive, named like the output files.
+        '''
+    )
     collect.add_argument(
         '--target',
         nargs='+',
@@ -68,6 +425,215 @@ def build_parser():
     )
     collect.set_defaults(func=run_collection)
 
+    # reprocess
+    reprocess = subparsers.add_parser(
+        'reprocess',
+        help='Regenerate output from a raw archive written by collect --raw-archive',
+    )
+    reprocess.add_argument('archive', help='Raw archive directory')
+    reprocess.add_argument(
+        'output_dir',
+        help='Directory to write output to, one file per archive segment (hour), named after the segment',
+    )
+    reprocess.add_argument(
+        '--workers',
+        type=int,
+        help='Number of processes to parse segments in (default: one per CPU)',
+    )
+    reprocess.add_argument(
+        '--start',
+        type=parse_timestamp,
+        help='Only reprocess results from this UTC time on (YYYY-MM-DD[THH:MM[:SS]] or epoch seconds)',
+    )
+    reprocess.add_argument(
+        '--end',
+        type=parse_timestamp,
+        help='Only reprocess results from before this UTC time',
+    )
+    reprocess.add_argument(
+        '--probe',
+        action='append',
+        dest='probes',
+        help="Only reprocess results of probes matching this pattern, e.g. 'predictions:*'.  May be repeated.",
+    )
+    reprocess.add_argument('--compact-records', action='store_true', default=False)
+    reprocess.add_argument('--format', default='jsonl', choices=['jsonl', 'parquet'])
+    reprocess.add_argument('--gzip', action='store_true', default=False)
+    reprocess.set_defaults(func=reprocess_archive)
+
+    # query
+    query = subparsers.add_parser(
+        'query',
+        help='Print collected records matching filters as JSON lines',
+        description='''
+        Read collected JSON lines output, plain, gzipped, or rotated into a directory
+        of files, and print the records matching every filter given.  Files and blocks
+        of rotated output that can't hold a match are skipped using their metadata.
+        ''',
+    )
+    query.add_argument('inputs', nargs='+', help='Output files, or directories of them')
+    query.add_argument(
+        '--type', action='append', dest='types', help="Record type, e.g. 'prediction'.  May be repeated.")
+    query.add_argument('--route', action='append', dest='routes', help='Route tag.  May be repeated.')
+    query.add_argument('--stop', action='append', dest='stops', help='Stop tag.  May be repeated.')
+    query.add_argument('--vehicle', action='append', dest='vehicles', help='Vehicle ID.  May be repeated.')
+    query.add_argument(
+        '--start',
+        type=parse_timestamp,
+        help='Only records requested from this UTC time on (YYYY-MM-DD[THH:MM[:SS]] or epoch seconds)',
+    )
+    query.add_argument('--end', type=parse_timestamp, help='Only records requested before this UTC time')
+    query.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of processes to decode files in, when reading more than one',
+    )
+    query.add_argument('--limit', type=int, help='Stop after this many records')
+    query.add_argument(
+        '--count', action='store_true', default=False, help='Print the number of matching records instead')
+    query.set_defaults(func=query_output)
+
+    # compact
+    compact = subparsers.add_parser(
+        'compact',
+        help='Merge collected output into sorted, recompressed files, one per time window',
+        description='''
+        Merge collected JSON lines output into one file per time window, with records
+        sorted by request time, route and stop, compressed with a stronger codec and
+        indexed with metadata sidecars.  Input files are left in place.
+        ''',
+    )
+    compact.add_argument('inputs', nargs='+', help='Output files, or directories of them')
+    compact.add_argument('--output-dir', required=True, help='Directory to write compacted files to')
+    compact.add_argument('--window', default=3600, type=int, help='Seconds of records per compacted file')
+    compact.add_argument(
+        '--template',
+        help='''
+        Template for compacted file names, without extension, filled in for the start
+        of each window like rotated output paths.  Each window must get a different
+        name.  By default 'compacted-{YYYYMMDDHH}' for windows of whole hours, and
+        otherwise 'compacted-{YYYYMMDDHHMM}'.
+        ''',
+    )
+    compact.add_argument('--codec', default='xz', choices=['xz', 'gzip'])
+    compact.add_argument('--level', type=int, help='Compression level (default: 6 for xz, 9 for gzip)')
+    compact.add_argument(
+        '--dedupe', action='store_true', default=False, help='Drop records identical to another record')
+    compact.add_argument('--workers', type=int, help='Number of processes to use (default: one per CPU)')
+    compact.add_argument(
+        '--run-size',
+        default='64M',
+        type=parse_size,
+        help='Bytes of records each process sorts in memory at a time, with a K, M or G suffix',
+    )
+    compact.add_argument(
+        '--block-size',
+        default='16M',
+        type=parse_size,
+        help='Uncompressed bytes per independently readable block of compacted files',
+    )
+    compact.set_defaults(func=compact_output)
+
+    # arrivals
+    arrivals = subparsers.add_parser(
+        'arrivals',
+        help='Reconstruct arrivals from collected predictions and measure prediction errors (requires numpy)',
+    )
+    arrivals.add_argument(
+        'inputs',
+        nargs='+',
+        help='''
+        Prediction output (JSON lines, optionally gzipped, or Parquet) or directories of
+        it, in collection order
+        ''',
+    )
+    arrivals.add_argument(
+        '--arrivals-output',
+        help='File to write arrivals to, as Parquet if it ends in .parquet, otherwise JSON lines',
+    )
+    arrivals.add_argument(
+        '--errors-output',
+        help='File to write each prediction and its error to, as Parquet or JSON lines',
+    )
+    arrivals.add_argument(
+        '--gap',
+        default=600,
+        type=float,
+        help='Seconds without predictions after which a trip is taken to have arrived at a stop',
+    )
+    arrivals.add_argument(
+        '--max-lead',
+        default=180,
+        type=float,
+        help='''
+        Predictions that disappear while the arrival is more than this many seconds away
+        are not counted as arrivals
+        ''',
+    )
+    arrivals.add_argument('--batch-size', default=500000, type=int, help='Predictions to process at a time')
+    arrivals.set_defaults(func=reconstruct_arrivals)
+
+    # bench
+    bench = subparsers.add_parser(
+        'bench',
+        help='Measure collection throughput against a local stand-in for the NextBus API',
+    )
+    bench.add_argument('--routes', default=8, type=int, help='Number of synthetic routes')
+    bench.add_argument('--stops-per-route', default=30, type=int, help='Number of stops per synthetic route')
+    bench.add_argument(
+        '--predictions-per-stop', default=3, type=int, help='Predictions per stop in synthetic responses')
+    bench.add_argument(
+        '--vehicles-per-route', default=10, type=int, help='Vehicles per route in synthetic responses')
+    bench.add_argument(
+        '--fixture',
+        action='append',
+        dest='fixtures',
+        help='''
+        Recorded predictionsForMultiStops or vehicleLocations response (JSON) to serve
+        instead of synthetic data for its command.  May be given more than once.
+        '''
+    )
+    bench.add_argument('--latency', default=0.05, type=float, help='Seconds the fake API takes to respond')
+    bench.add_argument('--jitter', default=0.0, type=float, help='Random extra seconds of latency, up to this')
+    bench.add_argument('--error-rate', default=0.0, type=float, help='Fraction of requests that fail with a 503')
+    bench.add_argument('--seed', type=int, help='Seed for synthetic data and errors')
+    bench.add_argument('--cycles', default=10, type=int, help='Number of collection cycles to run')
+    bench.add_argument(
+        '--paced',
+        action='store_true',
+        default=False,
+        help='''
+        Spread each cycle's probes over --period as collect does, instead of running
+        cycles back to back as fast as they go
+        '''
+    )
+    bench.add_argument(
+        '--period',
+        default=1.0,
+        type=parse_positive_float,
+        help='Collection period with --paced, in seconds.  Concurrent probes must finish within it either way.',
+    )
+    bench.add_argument('--concurrency', default=1, type=int)
+    bench.add_argument(
+        '--overrun', default=PhasedScheduler.COALESCE, choices=PhasedScheduler.OVERRUN_POLICIES)
+    bench.add_argument('--no-locations', action='store_true', default=False, help='Only collect predictions')
+    bench.add_argument('--compact-records', action='store_true', default=False)
+    bench.add_argument('--stream', action='store_true', default=False)
+    bench.add_argument('--stops-per-request', type=int)
+    bench.add_argument('--format', default='jsonl', choices=OUTPUT_FORMATS)
+    bench.add_argument('--gzip', action='store_true', default=False)
+    bench.add_argument('--buffered', action='store_true', default=False)
+    bench.add_argument('--batch-size', default=1000, type=int)
+    bench.add_argument('--flush-interval', default=1.0, type=float)
+    bench.add_argument('--queue-size', default=10000, type=int)
+    bench.add_argument(
+        '--output-dir',
+        help='Directory to keep the collected output in; by default it is written to a temporary directory',
+    )
+    bench.add_argument('--json', action='store_true', default=False, help='Print results as JSON')
+    bench.set_defaults(func=run_benchmark, rotate_size=None, rotate_interval=None)
+
     return parser
 
 def print_version_info(args):
@@ -81,47 +647,494 @@ def list_targets(args):
         print("+ {}".format(target))
 
 
+def populate_reference_db(args):
+    from munificent import db
+    from munificent.nextbus import DEFAULT_AGENCY_TAGS, populate_db
+    agency_tags = args.agencies or DEFAULT_AGENCY_TAGS
+    if args.reload:
+        db.reload_db(agency_tags)
+    else:
+        db.migrate_db()
+        populate_db(agency_tags)
+
+
+def migrate_reference_db(args):
+    from munificent import db
+    created = db.migrate_db()
+    for name in created:
+        LOG.info("Created index {}".format(name))
+    print("Created {} indexes".format(len(created)))
+
+
+def search_reference_db(args):
+    import json
+    from munificent.search import get_search_index
+    results = get_search_index().search(' '.join(args.query), kinds=args.kinds, agency=args.agency, limit=args.limit)
+    for result in results:
+        entry = result.entry
+        if args.json:
+            print(json.dumps(dict(entry._asdict(), score=result.score), sort_keys=True))
+        else:
+            print("{:<5}  {:<12}  {:<8}  {}{}".format(
+                entry.kind, entry.agency, entry.tag, entry.title, ' ({})'.format(entry.code) if entry.code else ''))
+
+
 COLLECTION_TARGETS = [
     'sfmuni-train-predictions',
     'sfmuni-train-locations',
+    'sfmuni-predictions',
+    'sfmuni-locations',
+    ]
+
+
+OUTPUT_FORMATS = [
+    'jsonl',
+    'parquet',
+    'db',
     ]
 
 
-def get_target_probes(target):
-    api = NextBusAPI()
-    if target == 'sfmuni-train-predictions':
-        return munificent.collect.get_muni_train_prediction_probes(api)
-    if target == 'sfmuni-train-locations':
-        return munificent.collect.get_muni_train_location_probes(api)
-    raise ValueError("Unrecognized collection target: {}".format(target))
+def get_target_probes(target, api=None, compact=False, stream=False, stops_per_request=None, cache_dir=None):
+    from munificent.collect import MUNI_TRAIN_ROUTES, get_location_probes, get_prediction_probes, load_probe_plan
+    from munificent.nextbus import NextBusAPI
+    api = api or NextBusAPI()
+    if target in ('sfmuni-train-predictions', 'sfmuni-train-locations'):
+        plan = load_probe_plan(MUNI_TRAIN_ROUTES, cache_dir=cache_dir)
+    elif target in ('sfmuni-predictions', 'sfmuni-locations'):
+        plan = load_probe_plan(agency='sf-muni', cache_dir=cache_dir)
+    else:
+        raise ValueError("Unrecognized collection target: {}".format(target))
+
+    if target.endswith('-predictions'):
+        return get_prediction_probes(
+            api, plan, compact=compact, stream=stream, stops_per_request=stops_per_request)
+    return get_location_probes(api, plan, stream=stream)
+
+
+def parse_size(value):
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    suffix = value[-1:].upper()
+    if suffix in multipliers:
+        return int(float(value[:-1]) * multipliers[suffix])
+    return int(value)
+
+
+def parse_positive_float(value):
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError("Expected a positive number: {}".format(value))
+    return number
+
+
+def parse_command_timeout(value):
+    command, _, timeouts = value.partition('=')
+    timeouts = [float(t) for t in timeouts.split(',')]
+    if not command or len(timeouts) not in (1, 2):
+        raise argparse.ArgumentTypeError("Expected COMMAND=READ or COMMAND=CONNECT,READ: {}".format(value))
+    return command, tuple(timeouts)
+
+
+def parse_timestamp(value):
+    import calendar
+    import datetime
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("Expected YYYY-MM-DD[THH:MM[:SS]] or epoch seconds: {}".format(value))
 
 
 def get_file_opener(args):
+    from munificent.io import open_file_gzip, open_file_normal, open_file_rotating
     output_path = args.output_path
+    if args.rotate_size or args.rotate_interval:
+        return open_file_rotating(
+            output_path,
+            compress=args.gzip,
+            max_bytes=args.rotate_size,
+            interval=args.rotate_interval,
+            target='+'.join(args.target),
+        )
     opener = open_file_normal
     if args.gzip:
         opener = open_file_gzip
     return opener(output_path)
 
 
-def run_collection(args):
-    probes = [p for t in args.target for p in get_target_probes(t)]
+def build_emitter(args):
+    if args.format == 'parquet':
+        if args.rotate_size:
+            raise ValueError("Size-based rotation is not supported for parquet output")
+        if args.buffered:
+            raise ValueError("--buffered is not supported for parquet output")
+        from munificent.columnar import DEFAULT_INTERVAL, DEFAULT_MAX_RECORDS, ColumnarEmitter
+        return ColumnarEmitter(
+            args.output_path,
+            max_records=DEFAULT_MAX_RECORDS,
+            interval=args.rotate_interval or DEFAULT_INTERVAL,
+        )
+    if args.format == 'db':
+        if args.rotate_size or args.rotate_interval or getattr(args, 'delta', False):
+            raise ValueError("Output rotation and --delta are not supported for db output")
+        from munificent.dbemitter import DatabaseEmitter
+        return DatabaseEmitter(
+            args.output_path,
+            batch_size=args.batch_size,
+            commit_interval=args.flush_interval,
+            max_queue=args.queue_size,
+        )
+
+    from munificent.io import BufferedEmitter, Emitter
 
     opener = get_file_opener(args)
-    emitter = Emitter(opener)
-    collector = Collector(probes, emitter=emitter, period=args.period)
+    if args.buffered:
+        return BufferedEmitter(
+            opener,
+            batch_size=args.batch_size,
+            flush_interval=args.flush_interval,
+            max_queue=args.queue_size,
+        )
+    return Emitter(opener)
+
+
+def build_api(args):
+    from munificent.nextbus import NextBusAPI, ResponseCache, build_session
+    response_cache = None
+    if args.skip_unchanged or args.incremental_locations:
+        response_cache = ResponseCache(
+            skip_unchanged=args.skip_unchanged,
+            incremental_locations=args.incremental_locations,
+        )
+
+    batch_concurrency = 4
+    # Batched sub-requests are sent from the API's own pool of batch_concurrency threads
+    pool_size = args.pool_size or max(args.concurrency, batch_concurrency if args.stops_per_request else 1)
+    session = build_session(
+        pool_size=pool_size,
+        retries=args.retries,
+        backoff_factor=args.retry_backoff,
+        accept_encoding=args.accept_encoding,
+    )
+    timeout = (args.connect_timeout, args.read_timeout)
+    command_timeouts = {
+        command: timeouts if len(timeouts) == 2 else (args.connect_timeout,) + timeouts
+        for command, timeouts in args.command_timeouts or []
+    }
+    return NextBusAPI(
+        response_cache=response_cache,
+        batch_concurrency=batch_concurrency,
+        session=session,
+        timeout=timeout,
+        command_timeouts=command_timeouts,
+    )
+
+
+def attach_change_trackers(args, probes):
+    from munificent.delta import ChangeTracker
+    for probe in probes:
+        partial = args.incremental_locations and probe.request.params.get('command') == 'vehicleLocations'
+        probe.tracker = ChangeTracker(
+            probe.name,
+            keyframe_interval=args.keyframe_interval,
+            ttl=args.delta_ttl,
+            max_entries=args.delta_max_entries,
+            partial=partial,
+        )
+
+
+def run_collection(args):
+    if args.workers > 1:
+        from munificent.supervisor import Supervisor
+        LOG.info("Running collection in {} workers on PID: {}".format(args.workers, os.getpid()))
+        Supervisor(functools.partial(run_collection_shard, args), args.workers).run()
+    else:
+        collect_targets(args)
+
+
+def run_collection_shard(args, shard):
+    from munificent.supervisor import shard_path
+    args = argparse.Namespace(**vars(args))
+    if args.format != 'db':  # Workers share the database
+        args.output_path = shard_path(args.output_path, shard)
+    if args.metrics_port:
+        args.metrics_port += shard
+    if args.stats_file:
+        args.stats_file = shard_path(args.stats_file, shard)
+    if args.raw_archive:
+        args.raw_archive = shard_path(args.raw_archive, shard)
+    args.profile_output = shard_path(args.profile_output, shard)
+    collect_targets(args, shard=shard)
+
+
+def build_probes(args, shard=None):
+    api = build_api(args)
+    probes = [
+        p for t in args.target
+        for p in get_target_probes(
+            t, api=api, compact=args.compact_records, stream=args.stream,
+            stops_per_request=args.stops_per_request,
+            cache_dir=None if args.no_probe_cache else config.CACHE_DIR,
+        )
+    ]
+    if shard is not None:
+        from munificent.supervisor import shard_probes
+        probes = shard_probes(probes, shard, args.workers, args.shard_by)
+    if args.delta:
+        attach_change_trackers(args, probes)
+    if args.snap_stops:
+        snap_vehicle_locations(probes, args.snap_max_distance)
+    return probes
+
+
+def attach_raw_archive(args, probes):
+    '''
+    Open the raw archive in `args`, if there is one, for `probes` to archive their
+    results to, returning it so that it can be closed.
+    '''
+    if not args.raw_archive:
+        return None
+    from munificent.archive import RawArchive
+    raw_archive = RawArchive(args.raw_archive)
+    for probe in probes:
+        probe.raw_archive = raw_archive
+    return raw_archive
+
+
+def snap_vehicle_locations(probes, max_distance=None):
+    '''
+    Make vehicle location probes snap their records to the nearest stop on their
+    route, with a stop index per agency.
+    '''
+    from munificent.spatial import StopIndex
+    indexes = {}
+    for probe in probes:
+        if probe.request.params.get('command') != 'vehicleLocations':
+            continue
+        agency = probe.request.params.get('a')
+        if agency not in indexes:
+            indexes[agency] = StopIndex.from_db(agency=agency)
+        probe.record_parser = indexes[agency].snapping(probe.record_parser, max_distance)
+
+
+def collect_targets(args, shard=None):
+    '''
+    Run collection for the targets in `args` in this process, or with a `shard`, for
+    that worker's share of their probes.
+    '''
+    import munificent.collect
+    from munificent.profiling import CollectionProfiler
+    probes = build_probes(args, shard)
+    if not probes:
+        LOG.warning("No probes to collect{}".format("" if shard is None else " in worker {}".format(shard)))
+        return
+
+    raw_archive = attach_raw_archive(args, probes)
+    emitter = build_emitter(args)
+    scheduler = PhasedScheduler(args.period, overrun=args.overrun)
+    profiler = CollectionProfiler(args.profile_output, cycles=args.profile_cycles)
+    if args.profile:
+        profiler.start()
+    collector = munificent.collect.Collector(
+        probes,
+        emitter=emitter,
+        period=args.period,
+        concurrency=args.concurrency,
+        scheduler=scheduler,
+        profiler=profiler,
+    )
 
     def hup(*args):
         LOG.info("Received HUP signal, flushing emitter")
-        emitter.flush()
+        emitter.request_flush()
+
+    def term(*args):
+        LOG.info("Received TERM signal, finishing collection")
+        scheduler.stop()
+
+    def usr1(*args):
+        LOG.info("Received USR1 signal, profiling the next {} cycles".format(profiler.cycles))
+        profiler.start()
 
     signal.signal(signal.SIGHUP, hup)
+    signal.signal(signal.SIGTERM, term)
+    signal.signal(signal.SIGUSR1, usr1)
 
+    stats_writer = start_metrics(args)
     try:
         LOG.info("Running collection on PID: {}".format(os.getpid()))
         collector.run()
     finally:
-        emitter.flush()
+        emitter.close()
+        if raw_archive:
+            raw_archive.close()
+        if stats_writer:
+            stats_writer.stop()
+
+
+def reprocess_archive(args):
+    from munificent.archive import reprocess
+    entries = records = 0
+    results = reprocess(
+        args.archive,
+        args.output_dir,
+        workers=args.workers,
+        output_format=args.format,
+        compress=args.gzip,
+        compact=args.compact_records,
+        start=args.start,
+        end=args.end,
+        probes=args.probes,
+    )
+    for segment, output_path, segment_entries, segment_records in results:
+        LOG.info("Reprocessed {} results from {} into {} records in {}".format(
+            segment_entries, segment, segment_records, output_path))
+        entries += segment_entries
+        records += segment_records
+    print("Reprocessed {} results into {} records".format(entries, records))
+
+
+def query_output(args):
+    import errno
+    import itertools
+    from munificent.io import read_records, serialize_records
+    records = read_records(
+        args.inputs,
+        types=args.types,
+        routes=args.routes,
+        stops=args.stops,
+        vehicles=args.vehicles,
+        start=args.start,
+        end=args.end,
+        workers=args.workers,
+    )
+    records = itertools.islice(records, args.limit)
+    if args.count:
+        print(sum(1 for _ in records))
+        return
+
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        while True:
+            batch = list(itertools.islice(records, 1000))
+            if not batch:
+                break
+            output.write(serialize_records(batch))
+        output.flush()
+    except IOError as e:
+        # Stop quietly when piped into e.g. head
+        if e.errno != errno.EPIPE:
+            raise
+
+
+def compact_output(args):
+    from munificent.compact import compact
+    from munificent.io import iter_output_files
+    input_bytes = sum(os.path.getsize(path) for path in iter_output_files(args.inputs))
+    records = duplicates = output_bytes = 0
+    results = compact(
+        args.inputs,
+        args.output_dir,
+        window=args.window,
+        template=args.template,
+        codec=args.codec,
+        compresslevel=args.level,
+        dedupe=args.dedupe,
+        workers=args.workers,
+        run_bytes=args.run_size,
+        block_size=args.block_size,
+    )
+    for result in results:
+        LOG.info("Compacted {} records into {}".format(result.records, result.path))
+        records += result.records
+        duplicates += result.duplicates
+        output_bytes += os.path.getsize(result.path)
+    print("Compacted {} records ({} duplicates dropped) from {} to {} bytes".format(
+        records, duplicates, input_bytes, output_bytes))
+
+
+def reconstruct_arrivals(args):
+    from munificent import analysis
+    writers = [analysis.ColumnsWriter(path) if path else None for path in (args.arrivals_output, args.errors_output)]
+    summary = analysis.ErrorSummary()
+    batches = analysis.iter_prediction_batches(args.inputs, batch_size=args.batch_size)
+    try:
+        for arrivals, errors in analysis.reconstruct_arrivals(batches, gap=args.gap, max_lead=args.max_lead):
+            summary.add(arrivals, errors)
+            for writer, columns in zip(writers, (arrivals, errors)):
+                if writer:
+                    writer.write(columns)
+    finally:
+        for writer in writers:
+            if writer:
+                writer.close()
+
+    print("{} arrivals".format(summary.arrivals))
+    header = ['lead', 'predictions', 'mean |error|'] + ['p{}'.format(p) for p in analysis.PERCENTILES]
+    print(''.join('{:>14}'.format(column) for column in header))
+    for row in summary.rows():
+        print('{:>14}{:>14}'.format(*row[:2]) + ''.join('{:>13.1f}s'.format(value) for value in row[2:]))
+
+
+def run_benchmark(args):
+    import json
+    import shutil
+    import tempfile
+    from munificent.bench import FakeNextBusServer, format_report, load_recorded, run_bench, synthetic_plan
+    from munificent.nextbus import NextBusAPI, build_session
+
+    server = FakeNextBusServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        predictions_per_stop=args.predictions_per_stop,
+        vehicles_per_route=args.vehicles_per_route,
+        recorded=load_recorded(args.fixtures or []),
+        seed=args.seed,
+    ).start_process()
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='munificent-bench-')
+    extension = {'parquet': '.parquet', 'db': '.db'}.get(args.format, '.jsonl.gz' if args.gzip else '.jsonl')
+    args.output_path = os.path.join(output_dir, 'bench' + extension)
+    args.target = ['bench']
+    try:
+        api = NextBusAPI(json_feed_url=server.url, session=build_session(pool_size=max(args.concurrency, 4), retries=0))
+        results = run_bench(
+            api,
+            synthetic_plan(args.routes, args.stops_per_route),
+            build_emitter(args),
+            cycles=args.cycles,
+            period=args.period,
+            paced=args.paced,
+            concurrency=args.concurrency,
+            overrun=args.overrun,
+            compact=args.compact_records,
+            stream=args.stream,
+            stops_per_request=args.stops_per_request,
+            locations=not args.no_locations,
+        )
+    finally:
+        server.stop()
+        if not args.output_dir:
+            shutil.rmtree(output_dir)
+    print(json.dumps(results, sort_keys=True) if args.json else format_report(results))
+
+
+def start_metrics(args):
+    '''
+    Start exposing metrics as configured in `args`, returning the stats file writer
+    if there is one.
+    '''
+    from munificent.metrics import StatsFileWriter, serve_metrics
+    if args.metrics_port:
+        serve_metrics(args.metrics_port, host=args.metrics_host)
+        LOG.info("Serving metrics on http://{}:{}/metrics".format(args.metrics_host, args.metrics_port))
+    if args.stats_file:
+        return StatsFileWriter(args.stats_file, interval=args.stats_interval).start()
+    return None
 
 
 def main(raw_args=None):
@@ -1,55 +1,237 @@
 # -*- coding: utf-8 -*-
+import collections
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import hashlib
+import json
+from json.encoder import encode_basestring
 import logging
-import time
+import operator
+import os
 
-from munificent import db
-from munificent.nextbus import NextBusAPIRequestBuilder
+from munificent import config as app_config, db, metrics, profiling
+from munificent.jsonstream import materialize
+from munificent.nextbus import result_meta
+from munificent.schedule import PhasedScheduler, monotonic
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
 
-Session = db.configured_session()
 LOG = logging.getLogger(__name__)
 
 
 class Collector(object):
 
-    def __init__(self, probes, emitter, period=60.0):
+    def __init__(self, probes, emitter, period=60.0, concurrency=1, scheduler=None, profiler=None):
         self.probes = probes
         self.period = period
         self.emitter = emitter
+        self.concurrency = concurrency
+        self.scheduler = scheduler or PhasedScheduler(period)
+        self.profiler = profiler
+
+    def run(self, cycles=None):
+        if self.concurrency > 1:
+            records = self._generate_records_concurrent(cycles)
+        else:
+            records = self._generate_records(cycles)
 
-    def run(self):
-        def generate_records():
-            per_request_period = self.period / float(len(self.probes))
-            cycle = 0
-            while True:
-                cycle += 1
-                cycle_start = time.time()
-                for probe in self.probes:
-                    request_start = time.time()
-                    try:
-                        for record in probe.collect():
-                            yield record
-                    except Exception as e:
-                        LOG.exception(e)
-                    finally:
-                        request_elapsed = time.time() - request_start
-                        request_period_remaining = per_request_period - request_elapsed
-                        time.sleep(max(request_period_remaining, 0))
-                cycle_end = time.time()
-                LOG.info("Finished cycle {} in {} seconds".format(cycle, cycle_end - cycle_start))
-
-        for record in generate_records():
+        for record in records:
             self.emitter.emit(record)
 
+    def _generate_records(self, cycles):
+        for tick in self._ticks(cycles):
+            probe = self.probes[tick.slot]
+            count = 0
+            try:
+                records = probe.collect() if self.profiler is None else self.profiler.collect(probe)
+                for record in records:
+                    count += 1
+                    yield record
+            except Exception as e:
+                metrics.PROBE_ERRORS.inc(probe=probe.name)
+                LOG.exception(e)
+            metrics.PROBE_RECORDS.inc(count, probe=probe.name)
+
+    def _generate_records_concurrent(self, cycles):
+        '''
+        Submit each probe to a pool of at most `concurrency` threads as its tick comes
+        up, giving it until the same slot in the next cycle to finish.  Results are
+        yielded in submission order so that only the calling thread writes to the
+        emitter.
+        '''
+        clock = self.scheduler.clock
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        pending = collections.deque()
+        try:
+            for tick in self._ticks(cycles):
+                probe = self.probes[tick.slot]
+                deadline = tick.scheduled + self.period
+                future = pool.submit(collect_before_deadline, probe, deadline, clock, self.profiler)
+                pending.append((probe, future, deadline))
+                for record in self._drain(pending, block=False):
+                    yield record
+            for record in self._drain(pending, block=True):
+                yield record
+        finally:
+            pool.shutdown(wait=False)
+
+    def _drain(self, pending, block):
+        clock = self.scheduler.clock
+        while pending:
+            probe, future, deadline = pending[0]
+            if not (block or future.done() or clock() >= deadline):
+                break
+            pending.popleft()
+            try:
+                records = future.result(timeout=max(deadline - clock(), 0))
+            except FutureTimeoutError:
+                future.cancel()
+                metrics.PROBE_DEADLINES_MISSED.inc(probe=probe.name)
+                LOG.warning("Probe missed its deadline: {}".format(probe))
+                continue
+            except Exception as e:
+                metrics.PROBE_ERRORS.inc(probe=probe.name)
+                LOG.exception(e)
+                continue
+            metrics.PROBE_RECORDS.inc(len(records), probe=probe.name)
+            for record in records:
+                yield record
+
+    def _ticks(self, cycles):
+        '''
+        Yield the scheduler's ticks, closing out each cycle (see `_end_cycle`) once its
+        last tick has been handled, or once a later cycle's tick comes up or the ticks
+        run out, if its last tick was skipped.
+        '''
+        last = None
+        for tick in self.scheduler.ticks(len(self.probes), cycles):
+            if last is not None and last.cycle != tick.cycle:
+                self._end_cycle(last)
+            last = tick
+            yield tick
+            if tick.slot == len(self.probes) - 1:
+                self._end_cycle(tick)
+                last = None
+        if last is not None:
+            self._end_cycle(last)
+
+    def _end_cycle(self, tick):
+        '''
+        Log and record metrics for the cycle whose last handled tick was `tick`.
+        '''
+        if self.profiler is not None:
+            self.profiler.end_cycle()
+        scheduler = self.scheduler
+        cycle_start = tick.scheduled - tick.slot * self.period / float(len(self.probes))
+        metrics.CYCLE_SECONDS.observe(scheduler.clock() - cycle_start)
+        metrics.CYCLES.inc()
+        LOG.info("Finished cycle {} (lag {:.3f}s, max lag {:.3f}s, {} overruns, {} ticks skipped)".format(
+            tick.cycle + 1, scheduler.last_lag, scheduler.max_lag, scheduler.overruns, scheduler.ticks_skipped,
+        ))
+
+
+def collect_before_deadline(probe, deadline, clock=monotonic, profiler=None):
+    '''
+    Run a probe with its request timeout capped to the time remaining before
+    `deadline`, returning the collected records as a list.
+    '''
+    remaining = deadline - clock()
+    if remaining <= 0:
+        raise ProbeDeadlineExceeded("No time left to run probe: {}".format(probe))
+    timeout = cap_timeout(probe.request_timeout, remaining)
+    if profiler is not None:
+        return list(profiler.collect(probe, timeout=timeout))
+    return list(probe.collect(timeout=timeout))
+
+
+def cap_timeout(timeout, limit):
+    '''
+    Cap a requests timeout, either a number of seconds or a `(connect, read)` pair, to
+    at most `limit` seconds.
+    '''
+    if timeout is None:
+        return limit
+    if isinstance(timeout, tuple):
+        return tuple(min(t, limit) for t in timeout)
+    return min(timeout, limit)
+
+
+class ProbeDeadlineExceeded(Exception):
+    pass
+
 
 class CollectionProbe(object):
-    def __init__(self, api, request, record_parser):
+    def __init__(self, api, request, record_parser, timeout=None, stream=False, name=None, tracker=None,
+                 raw_archive=None):
         self.api = api
         self.request = request
         self.record_parser = record_parser
+        self.timeout = timeout
+        self.stream = stream
+        self.name = name or request.params.get('command')
+        self.tracker = tracker
+        self.raw_archive = raw_archive
 
     def collect(self, **request_args):
-        result = self.api.perform_request(self.request, timeout=10)
-        return self.record_parser(result)
+        '''
+        Perform the probe's request and parse the result into records.  Streaming
+        probes decode the response as the returned records are consumed, so they need
+        a generator parser (e.g. `iter_prediction_points`) to keep memory bounded.
+
+        With a `raw_archive` (see `munificent.archive.RawArchive`), the result is
+        archived before it is parsed.  Streamed results have to be read in full to be
+        archived, so archiving gives up streaming's memory bound.
+        '''
+        request_args.setdefault('timeout', self.request_timeout)
+        perform_request = self.api.stream_request if self.stream else self.api.perform_request
+        with metrics.PROBE_REQUEST_SECONDS.time(probe=self.name):
+            result = perform_request(self.request, **request_args)
+        if result is None:  # Unchanged since the last request
+            # Keyframes still come due, so that readers can start from any file
+            return self.tracker.unchanged(result_meta()) if self.tracker else []
+        if self.raw_archive is not None:
+            if self.stream:
+                result = materialize(result)
+            with profiling.stage('archive'):
+                self.raw_archive.append(self.name, self.request.params.get('command'), result)
+        try:
+            with metrics.PROBE_PARSE_SECONDS.time(probe=self.name), profiling.stage('parse'):
+                records = self.record_parser(result)
+        except Exception:
+            self._parse_failed()
+            raise
+        if self.stream:
+            records = self._forget_on_error(records)
+        if self.tracker:
+            records = self.tracker.diff(records, result['_meta'])
+        return records
+
+    def _forget_on_error(self, records):
+        try:
+            for record in records:
+                yield record
+        except Exception:
+            self._parse_failed()
+            raise
+
+    def _parse_failed(self):
+        # Otherwise the same response would be skipped as unchanged next time
+        self.api.forget(self.request)
+
+    @property
+    def request_timeout(self):
+        '''
+        The probe's own `timeout` if it has one, otherwise the API's timeout for its
+        request.
+        '''
+        if self.timeout is not None:
+            return self.timeout
+        return self.api.timeout_for(self.request)
+
+    def __repr__(self):
+        return 'CollectionProbe({})'.format(self.name)
 
 
 MUNI_TRAIN_ROUTES = [
@@ -64,24 +246,117 @@ MUNI_TRAIN_ROUTES = [
     ]
 
 
-def get_muni_train_prediction_probes(api):
-    route_titles = MUNI_TRAIN_ROUTES
-    routes = (Session.query(db.Route).filter(db.Route.title.in_(route_titles)).all())
-    reqbuilder = NextBusAPIRequestBuilder()
-    requests = [reqbuilder.get_predictions_for_route(route) for route in routes]
-    probes = [CollectionProbe(api, req, parse_prediction_points) for req in requests]
+def get_muni_train_prediction_probes(api, compact=False, stream=False, plan=None, stops_per_request=None):
+    plan = load_probe_plan(MUNI_TRAIN_ROUTES) if plan is None else plan
+    return get_prediction_probes(api, plan, compact=compact, stream=stream, stops_per_request=stops_per_request)
+
+
+def get_muni_train_location_probes(api, stream=False, plan=None):
+    plan = load_probe_plan(MUNI_TRAIN_ROUTES) if plan is None else plan
+    return get_location_probes(api, plan, stream=stream)
+
+
+def get_prediction_probes(api, plan, compact=False, stream=False, stops_per_request=None):
+    '''
+    Build a prediction probe, named 'predictions:<route tag>', for each route in a
+    probe plan (see `build_probe_plan`).
+    '''
+    reqbuilder = api.request_builder
+    if stream:
+        parser = iter_prediction_points_compact if compact else iter_prediction_points
+    else:
+        parser = parse_prediction_points_compact if compact else parse_prediction_points
+    probes = [
+        CollectionProbe(
+            api,
+            reqbuilder.get_batched_multistop_predictions(route['agency'], route['stop_codes'], stops_per_request),
+            parser,
+            stream=stream,
+            name='predictions:{}'.format(route['route']),
+        )
+        for route in plan
+    ]
     return probes
 
 
-def get_muni_train_location_probes(api):
-    route_titles = MUNI_TRAIN_ROUTES
-    routes = (Session.query(db.Route).filter(db.Route.title.in_(route_titles)).all())
-    reqbuilder = NextBusAPIRequestBuilder()
-    requests = [reqbuilder.get_vehicle_locations_for_route(route) for route in routes]
-    probes = [CollectionProbe(api, req, parse_vehicle_locations) for req in requests]
+def get_location_probes(api, plan, stream=False):
+    '''
+    Build a vehicle location probe, named 'locations:<route tag>', for each route in a
+    probe plan (see `build_probe_plan`).
+    '''
+    reqbuilder = api.request_builder
+    parser = iter_vehicle_locations if stream else parse_vehicle_locations
+    probes = [
+        CollectionProbe(
+            api,
+            reqbuilder.get_vehicle_locations(route['agency'], route['route']),
+            parser,
+            stream=stream,
+            name='locations:{}'.format(route['route']),
+        )
+        for route in plan
+    ]
     return probes
 
 
+def load_probe_plan(route_titles=None, session=None, cache_dir=None, version=None, agency=None):
+    '''
+    Return the probe plan for `route_titles` and `agency` (see `build_probe_plan`).  With a
+    `cache_dir`, the plan is cached on disk keyed by the reference data version
+    (`db.reference_version` by default), so that while the reference data is
+    unchanged the plan is loaded without touching the database.
+    '''
+    version = db.reference_version(session) if version is None else version
+    if not cache_dir or version is None:
+        return build_probe_plan(route_titles, session, agency)
+
+    titles = None if route_titles is None else sorted(route_titles)
+    cache_key = json.dumps([app_config.SQLALCHEMY_DBURI, version, agency, titles])
+    cache_path = os.path.join(cache_dir, 'probe-plan-{}.json'.format(
+        hashlib.sha1(cache_key.encode('utf-8')).hexdigest()))
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        pass
+
+    plan = build_probe_plan(route_titles, session, agency)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(plan, f)
+    os.rename(tmp_path, cache_path)
+    return plan
+
+
+def build_probe_plan(route_titles=None, session=None, agency=None):
+    '''
+    Look up everything needed to build collection probes for the routes titled
+    `route_titles` (or every route) of `agency` (or any agency) in a single query.
+    The plan is a list with an entry for each route of the form
+    `{'agency': 'sf-muni', 'route': 'N', 'stop_codes': ['N|5240', ...]}`.
+    '''
+    session = session or db.get_session()
+    rows = (session.query(db.Agency.tag, db.Route.tag, db.Stop.tag)
+        .select_from(db.Route)
+        .join(db.Agency, db.Route.agency_id == db.Agency.id)
+        .outerjoin(db.RouteStop, db.RouteStop.route_id == db.Route.id)
+        .outerjoin(db.Stop, db.RouteStop.stop_id == db.Stop.id))
+    if route_titles is not None:
+        rows = rows.filter(db.Route.title.in_(route_titles))
+    if agency is not None:
+        rows = rows.filter(db.Agency.tag == agency)
+    rows = rows.order_by(db.Route.id, db.Stop.id)
+
+    plan = collections.OrderedDict()
+    for agency_tag, route_tag, stop_tag in rows:
+        route = plan.setdefault((agency_tag, route_tag), {'agency': agency_tag, 'route': route_tag, 'stop_codes': []})
+        if stop_tag is not None:
+            route['stop_codes'].append('{}|{}'.format(route_tag, stop_tag))
+    return list(plan.values())
+
+
 def get_prediction_results(api, requests):
     '''
     Gather prediction results once for the given requests.
@@ -95,33 +370,18 @@ def get_prediction_results(api, requests):
 
 
 def parse_prediction_points(prediction_result):
-    points = []
+    return list(iter_prediction_points(prediction_result))
+
+
+def iter_prediction_points(prediction_result):
+    '''
+    Generator version of `parse_prediction_points`, for consuming streamed results.
+    '''
     request_id = prediction_result['_meta']['request_id']
     request_timestamp = prediction_result['_meta']['timestamp']
     for prediction in prediction_result['predictions']:
-        direction = prediction.get('direction')
-
-        # Sometimes, no predictions are available because e.g. a tunnel is shut down
-        if not direction:
-            continue
-
-        # 'direction' can be a scalar or a list (single/multi prediction)
-        if type(direction) is list:
-            prediction_records = direction
-        else:
-            prediction_records = [direction]
-
-        # Coalesce the many options into a standardized list of prdiction points
-        raw_points = []
-        for prediction_rec in prediction_records:
-            rec_points = prediction_rec.get('prediction', [])
-            if type(rec_points) is dict:   # Single prediction
-                raw_points.append(rec_points)
-            else:
-                raw_points.extend(rec_points)
-
-        for prediction_point in raw_points:
-            points.append(dict(
+        for prediction_point in raw_prediction_points(prediction):
+            yield dict(
                 # Context data
                 type='prediction',
                 request_id=str(request_id),
@@ -144,36 +404,240 @@ def parse_prediction_points(prediction_result):
                     prediction_point.get('affectedByLayover', 'false'),
                     true_values=['true'],
                 ),
-            ))
+            )
+
+
+def raw_prediction_points(prediction):
+    '''
+    Flatten the raw prediction points for one route/stop out of a predictions result.
+    '''
+    direction = prediction.get('direction')
+
+    # Sometimes, no predictions are available because e.g. a tunnel is shut down
+    if not direction:
+        return []
+
+    # 'direction' can be a scalar or a list (single/multi prediction)
+    if type(direction) is list:
+        prediction_records = direction
+    else:
+        prediction_records = [direction]
+
+    # Coalesce the many options into a standardized list of prdiction points
+    raw_points = []
+    for prediction_rec in prediction_records:
+        rec_points = prediction_rec.get('prediction', [])
+        if type(rec_points) is dict:   # Single prediction
+            raw_points.append(rec_points)
+        else:
+            raw_points.extend(rec_points)
+    return raw_points
 
-    return points
+
+def parse_prediction_points_compact(prediction_result):
+    '''
+    Faster equivalent of `parse_prediction_points` that returns `PredictionPoint`s,
+    which share a single `PredictionContext` per route/stop instead of copying the
+    context into every record.
+    '''
+    return list(iter_prediction_points_compact(prediction_result))
+
+
+def iter_prediction_points_compact(prediction_result):
+    request_id = str(prediction_result['_meta']['request_id'])
+    request_timestamp = prediction_result['_meta']['timestamp']
+    for prediction in prediction_result['predictions']:
+        raw_points = raw_prediction_points(prediction)
+        if not raw_points:
+            continue
+
+        context = PredictionContext(
+            request_id,
+            request_timestamp,
+            prediction['routeTag'],
+            prediction['stopTag'],
+            prediction['routeTitle'],
+            prediction['stopTitle'],
+        )
+        for point in raw_points:
+            is_departure = point['isDeparture']
+            yield PredictionPoint(
+                context,
+                int(point['epochTime']),
+                int(point['seconds']),
+                int(point['minutes']),
+                is_departure == 'true' or is_departure.lower().strip() == 'true',
+                point.get('block'),
+                point.get('vehicle'),
+                point.get('dirTag'),
+                point.get('tripTag'),
+                point.get('affectedByLayover') == 'true',
+            )
+
+
+class PredictionContext(object):
+    PREDICTION_CONTEXT_FIELDS = (
+        'request_id', 'request_timestamp', 'routeTag', 'stopTag', 'routeTitle', 'stopTitle',
+    )
+    __slots__ = PREDICTION_CONTEXT_FIELDS + ('_json_prefix',)
+
+    def __init__(self, request_id, request_timestamp, routeTag, stopTag, routeTitle, stopTitle):
+        self.request_id = request_id
+        self.request_timestamp = request_timestamp
+        self.routeTag = routeTag
+        self.stopTag = stopTag
+        self.routeTitle = routeTitle
+        self.stopTitle = stopTitle
+        self._json_prefix = None
+
+    def json_prefix(self, encode):
+        '''
+        The encoded context fields of a prediction record, without the closing brace,
+        computed once and shared by every point with this context.
+        '''
+        if self._json_prefix is None:
+            fields = [('type', 'prediction')] + [(f, getattr(self, f)) for f in self.PREDICTION_CONTEXT_FIELDS]
+            self._json_prefix = encode(dict(fields))[:-1]
+        return self._json_prefix
+
+
+class PredictionPoint(Mapping):
+    '''
+    Compact, read-only prediction record.  It is a mapping with the same keys, in the
+    same order, as the dicts built by `parse_prediction_points`, and serializes to the
+    same JSON through `to_dict`.
+    '''
+    PREDICTION_POINT_FIELDS = (
+        'epochTime', 'seconds', 'minutes', 'isDeparture', 'block', 'vehicle', 'dirTag', 'tripTag',
+        'affectedByLayover',
+    )
+    __slots__ = ('context',) + PREDICTION_POINT_FIELDS
+    type = 'prediction'
+
+    FIELDS = ('type',) + PredictionContext.PREDICTION_CONTEXT_FIELDS + PREDICTION_POINT_FIELDS
+    _GETTERS = {f: operator.attrgetter('context.' + f) for f in PredictionContext.PREDICTION_CONTEXT_FIELDS}
+    _GETTERS.update((f, operator.attrgetter(f)) for f in ('type',) + PREDICTION_POINT_FIELDS)
+
+    def __init__(self, context, epochTime, seconds, minutes, isDeparture, block, vehicle, dirTag, tripTag,
+                 affectedByLayover):
+        self.context = context
+        self.epochTime = epochTime
+        self.seconds = seconds
+        self.minutes = minutes
+        self.isDeparture = isDeparture
+        self.block = block
+        self.vehicle = vehicle
+        self.dirTag = dirTag
+        self.tripTag = tripTag
+        self.affectedByLayover = affectedByLayover
+
+    def __getitem__(self, key):
+        try:
+            getter = self._GETTERS[key]
+        except (KeyError, TypeError):
+            raise KeyError(key)
+        return getter(self)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def to_json(self, encode):
+        '''
+        Encode this record with `encode` (a `json.JSONEncoder.encode` that doesn't
+        escape non-ASCII characters), producing the same output as encoding `to_dict()`
+        but reusing the shared context's encoding.
+        '''
+        return self._JSON_TEMPLATE.format(
+            self.context.json_prefix(encode),
+            self.epochTime,
+            self.seconds,
+            self.minutes,
+            'true' if self.isDeparture else 'false',
+            _encode_string(self.block, encode),
+            _encode_string(self.vehicle, encode),
+            _encode_string(self.dirTag, encode),
+            _encode_string(self.tripTag, encode),
+            'true' if self.affectedByLayover else 'false',
+        )
+
+    _JSON_TEMPLATE = (
+        '{}, "epochTime": {}, "seconds": {}, "minutes": {}, "isDeparture": {}, "block": {}, "vehicle": {}, '
+        '"dirTag": {}, "tripTag": {}, "affectedByLayover": {}}}'
+    )
+
+    def to_dict(self):
+        context = self.context
+        return dict(
+            type='prediction',
+            request_id=context.request_id,
+            request_timestamp=context.request_timestamp,
+            routeTag=context.routeTag,
+            stopTag=context.stopTag,
+            routeTitle=context.routeTitle,
+            stopTitle=context.stopTitle,
+            epochTime=self.epochTime,
+            seconds=self.seconds,
+            minutes=self.minutes,
+            isDeparture=self.isDeparture,
+            block=self.block,
+            vehicle=self.vehicle,
+            dirTag=self.dirTag,
+            tripTag=self.tripTag,
+            affectedByLayover=self.affectedByLayover,
+        )
+
+    def __repr__(self):
+        return 'PredictionPoint({!r})'.format(self.to_dict())
+
+
+def _encode_string(value, encode):
+    if value is None:
+        return 'null'
+    if type(value) is str:
+        return encode_basestring(value)
+    return encode(value)
 
 
 def parse_vehicle_locations(location_result):
-    locations = []
+    return list(iter_vehicle_locations(location_result))
+
+
+def iter_vehicle_locations(location_result):
+    '''
+    Generator version of `parse_vehicle_locations`, for consuming streamed results.
+    '''
     request_id = location_result['_meta']['request_id']
     request_timestamp = location_result['_meta']['timestamp']
-    try:
-        for location in location_result.get('vehicle', []):
-            location.update(dict(
-                # Context data
-                type='vehicle_location',
-                request_id=request_id,
-                request_timestamp=request_timestamp,
-
-                # Location data
-                vehicle=location['id'],
-                lat=float(location['lat']),
-                lon=float(location['lon']),
-                heading=int(location['heading']),
-                predictable=parse_bool_string(location['predictable']),
-                secsSinceReport=int(location['secsSinceReport']),
-            ))
-            locations.append(location)
-    except Exception as e:
-        import ipdb; ipdb.set_trace();
-
-    return locations
+    for location in location_result.get('vehicle', []):
+        location.update(dict(
+            # Context data
+            type='vehicle_location',
+            request_id=request_id,
+            request_timestamp=request_timestamp,
+
+            # Location data
+            vehicle=location['id'],
+            lat=float(location['lat']),
+            lon=float(location['lon']),
+            heading=int(location['heading']),
+            predictable=parse_bool_string(location['predictable']),
+            secsSinceReport=int(location['secsSinceReport']),
+        ))
+        yield location
+
+
+def get_record_parser(command, compact=False):
+    '''
+    The parser for results of an API command, e.g. for reprocessing archived results.
+    '''
+    if command in ('predictions', 'predictionsForMultiStops'):
+        return parse_prediction_points_compact if compact else parse_prediction_points
+    if command == 'vehicleLocations':
+        return parse_vehicle_locations
+    raise ValueError("No record parser for command: {}".format(command))
 
 
 def parse_bool_string(s, true_values=None):
@@ -0,0 +1,226 @@
+'''
+Columnar output for collected records, written as Parquet files with pyarrow.
+Install with `pip install munificent[parquet]`.
+'''
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from munificent import metrics
+from munificent.io import unique_path
+
+DICT_STRING = pa.dictionary(pa.int32(), pa.string())
+# How often collection finalizes its Parquet files, bounding what a crash loses
+DEFAULT_INTERVAL = 3600
+DEFAULT_MAX_RECORDS = 1000000
+
+SCHEMAS = {
+    'prediction': pa.schema([
+        ('type', DICT_STRING),
+        ('request_id', DICT_STRING),
+        ('request_timestamp', pa.int64()),
+        ('routeTag', DICT_STRING),
+        ('stopTag', DICT_STRING),
+        ('routeTitle', DICT_STRING),
+        ('stopTitle', DICT_STRING),
+        ('epochTime', pa.int64()),
+        ('seconds', pa.int32()),
+        ('minutes', pa.int32()),
+        ('isDeparture', pa.bool_()),
+        ('block', DICT_STRING),
+        ('vehicle', DICT_STRING),
+        ('dirTag', DICT_STRING),
+        ('tripTag', pa.string()),
+        ('affectedByLayover', pa.bool_()),
+    ]),
+    'vehicle_location': pa.schema([
+        ('type', DICT_STRING),
+        ('request_id', DICT_STRING),
+        ('request_timestamp', pa.int64()),
+        ('vehicle', DICT_STRING),
+        ('routeTag', DICT_STRING),
+        ('dirTag', DICT_STRING),
+        ('lat', pa.float64()),
+        ('lon', pa.float64()),
+        ('heading', pa.int32()),
+        ('predictable', pa.bool_()),
+        ('secsSinceReport', pa.int32()),
+        ('speedKmHr', pa.int32()),
+        ('leadingVehicleId', DICT_STRING),
+        ('nearestStopTag', DICT_STRING),
+        ('nearestStopDistance', pa.float64()),
+    ]),
+    'tombstone': pa.schema([
+        ('type', DICT_STRING),
+        ('record_type', DICT_STRING),
+        ('scope', DICT_STRING),
+        ('request_id', DICT_STRING),
+        ('request_timestamp', pa.int64()),
+        ('stopTag', DICT_STRING),
+        ('tripTag', pa.string()),
+        ('vehicle', DICT_STRING),
+    ]),
+    'keyframe': pa.schema([
+        ('type', DICT_STRING),
+        ('scope', DICT_STRING),
+        ('request_id', DICT_STRING),
+        ('request_timestamp', pa.int64()),
+        ('records', pa.int64()),
+    ]),
+}
+
+
+def type_path(path, record_type):
+    '''
+    Render the output path for a record type, either by filling in a '{type}' field
+    or by inserting the type before the file extension ('out.parquet' becomes
+    'out.prediction.parquet').
+    '''
+    if '{type}' in path:
+        return path.format(type=record_type)
+    directory, filename = os.path.split(path)
+    stem, dot, extension = filename.partition('.')
+    return os.path.join(directory, '{}.{}.{}'.format(stem, record_type, extension or 'parquet'))
+
+
+class ColumnBuffer(object):
+    '''
+    Accumulates records of one type as typed columns, ready to be written out as a
+    row group.  Fields that aren't part of the schema are dropped.
+    '''
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._converters = [(field.name, _converter(field.type)) for field in schema]
+        self._columns = {name: [] for name, _ in self._converters}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, record):
+        for name, convert in self._converters:
+            value = record.get(name)
+            if value is not None and convert is not None:
+                value = convert(value)
+            self._columns[name].append(value)
+        self._size += 1
+
+    def drain(self):
+        table = pa.Table.from_arrays(
+            [pa.array(self._columns[field.name], type=field.type) for field in self.schema],
+            schema=self.schema,
+        )
+        for column in self._columns.values():
+            del column[:]
+        self._size = 0
+        return table
+
+
+def _converter(arrow_type):
+    if pa.types.is_integer(arrow_type):
+        return int
+    if pa.types.is_floating(arrow_type):
+        return float
+    return None
+
+
+class ColumnarEmitter(object):
+    '''
+    Emitter that writes records to one Parquet file per record type, buffering up to
+    `row_group_size` records of a type into typed, dictionary-encoded columns before
+    writing them out as a row group.
+
+    Files are written under a hidden temporary name and renamed into place when the
+    emitter is flushed, since a Parquet file isn't readable until its footer has been
+    written.  Records emitted after a flush go to new files.  Anything not yet
+    flushed is lost if the process dies, so the emitter also flushes itself once
+    `max_records` records have been emitted since the last flush, or when the clock
+    crosses a multiple of `interval` seconds.
+    '''
+
+    def __init__(self, path, row_group_size=100000, compression='zstd', max_records=None, interval=None,
+                 clock=time.time):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.max_records = max_records
+        self.interval = interval
+        self.clock = clock
+        self._buffers = {}
+        self._writers = {}
+        self._flush_requested = False
+        self._records = 0
+        self._ends_at = None
+
+    def emit(self, record):
+        if self._flush_requested or self._flush_due():
+            self._flush_requested = False
+            self.flush()
+
+        record_type = record['type']
+        if record_type not in self._buffers:
+            if record_type not in SCHEMAS:
+                raise ValueError("No columnar schema for record type: {}".format(record_type))
+            self._buffers[record_type] = ColumnBuffer(SCHEMAS[record_type])
+
+        buffer = self._buffers[record_type]
+        buffer.append(record)
+        self._records += 1
+        if self.interval and self._ends_at is None:
+            now = self.clock()
+            self._ends_at = now - now % self.interval + self.interval
+        if len(buffer) >= self.row_group_size:
+            self._write_row_group(record_type)
+
+    def flush(self):
+        '''
+        Write out all buffered records and finalize the current output files.
+        '''
+        for record_type, buffer in self._buffers.items():
+            if len(buffer):
+                self._write_row_group(record_type)
+        for writer, tmp_path, final_path in self._writers.values():
+            writer.close()
+            os.rename(tmp_path, unique_path(final_path))
+        self._writers.clear()
+        self._records = 0
+        self._ends_at = None
+
+    def request_flush(self):
+        self._flush_requested = True
+
+    def abort(self):
+        '''
+        Discard buffered records and remove the files being written, leaving only
+        those finalized by earlier flushes.
+        '''
+        for writer, tmp_path, _ in self._writers.values():
+            writer.close()
+            os.remove(tmp_path)
+        self._writers.clear()
+        self._buffers.clear()
+
+    def close(self):
+        self.flush()
+
+    def _flush_due(self):
+        if self.max_records and self._records >= self.max_records:
+            return True
+        return self._ends_at is not None and self.clock() >= self._ends_at
+
+    def _write_row_group(self, record_type):
+        if record_type not in self._writers:
+            final_path = type_path(self.path, record_type)
+            directory, filename = os.path.split(final_path)
+            tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(filename, os.getpid()))
+            writer = pq.ParquetWriter(tmp_path, SCHEMAS[record_type], compression=self.compression)
+            self._writers[record_type] = (writer, tmp_path, final_path)
+
+        writer = self._writers[record_type][0]
+        with metrics.WRITE_SECONDS.time():
+            table = self._buffers[record_type].drain()
+            writer.write_table(table, row_group_size=self.row_group_size)
+        metrics.RECORDS_EMITTED.inc(table.num_rows)
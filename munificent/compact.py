@@ -0,0 +1,259 @@
+'''
+Compaction of collected output: merges the records in a set of output files into
+one file per time window, sorted by (request_timestamp, routeTag, stopTag),
+optionally without exact duplicates, and re-compressed with a stronger codec in
+larger blocks, each with a metadata sidecar (see `munificent.io.RotatingFile`).
+
+Windows are sorted with an external merge sort, so memory stays bounded however
+much output there is.  Input files are read in groups, whose records are sorted
+into runs per window of at most `run_bytes`, and then each window's runs are merged
+into its output file.  Groups of input files, and then windows, are processed in
+parallel.
+'''
+import collections
+import heapq
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from munificent.io import RotatingFile, decode_lines, iter_lines, iter_output_files, render_path_template
+
+LOG = logging.getLogger(__name__)
+
+CODECS = {
+    'gzip': '.jsonl.gz',
+    'xz': '.jsonl.xz',
+}
+DEFAULT_WINDOW = 3600
+# Bytes of records sorted in memory at a time, by each process
+DEFAULT_RUN_BYTES = 64 * 1024 * 1024
+# Compacted files are indexed in larger blocks than live output
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+# Most runs merged at once, to stay well within open file limits
+MAX_MERGE_RUNS = 256
+# Rough ratio of uncompressed to compressed output size, for grouping input files
+COMPRESSION_RATIO = 8
+
+WindowResult = collections.namedtuple('WindowResult', ['window_start', 'path', 'records', 'duplicates'])
+
+
+def default_template(window):
+    '''
+    The default compacted file name for windows of `window` seconds: the start of the
+    window, to the hour for windows of whole hours, and otherwise to the minute.
+    '''
+    return 'compacted-{YYYYMMDDHH}' if window % 3600 == 0 else 'compacted-{YYYYMMDDHHMM}'
+
+
+def check_window_paths(output_path, window_starts):
+    '''
+    Raise a ValueError if the `output_path` template renders to the same path for
+    more than one of `window_starts`, which would mix windows up.
+    '''
+    windows = {}
+    for window_start in sorted(window_starts):
+        path = render_path_template(output_path, window_start)
+        if path in windows:
+            raise ValueError(
+                "Windows starting at {} and {} would both be written to {}; use a template that tells them apart, "
+                "e.g. with {{YYYYMMDDHHMM}} or {{time:%Y%m%d%H%M%S}}".format(windows[path], window_start, path))
+        windows[path] = window_start
+
+
+def sort_key(record):
+    '''
+    A byte string that sorts records by (request_timestamp, routeTag, stopTag, type)
+    when compared as bytes, and that holds what the metadata of the compacted file
+    needs to know about the record.
+    '''
+    get = record.get
+    return '{:017.6f}\0{}\0{}\0{}\t'.format(
+        get('request_timestamp') or 0, get('routeTag') or '', get('stopTag') or '', get('type') or '',
+    ).encode('utf-8')
+
+
+def parse_sort_key(key):
+    timestamp, route, stop, record_type = key.decode('utf-8').split('\0')
+    timestamp = float(timestamp)
+    return {
+        'request_timestamp': int(timestamp) if timestamp.is_integer() else timestamp,
+        'routeTag': route or None,
+        'stopTag': stop or None,
+        'type': record_type or None,
+    }
+
+
+def group_files(paths, run_bytes):
+    '''
+    Group output files into lists holding about `run_bytes` of records each, so that
+    many small files are sorted together rather than each making runs of their own.
+    '''
+    group, size = [], 0
+    for path in paths:
+        group.append(path)
+        size += os.path.getsize(path) * (COMPRESSION_RATIO if path.endswith(('.gz', '.xz')) else 1)
+        if size >= run_bytes:
+            yield group
+            group, size = [], 0
+    if group:
+        yield group
+
+
+def split_runs(paths, run_dir, window=DEFAULT_WINDOW, run_bytes=DEFAULT_RUN_BYTES):
+    '''
+    Sort the records in the output files at `paths` into runs, one or more per window
+    of `window` seconds, each of at most about `run_bytes`.  Each run is a file in
+    `run_dir` of records in sort order, prefixed with their `sort_key`.  Returns a
+    list of (window start, run path) pairs.
+    '''
+    runs = []
+    buffers = collections.defaultdict(list)
+    buffered = 0
+    for path, lines in iter_line_batches(paths):
+        records, lines = decode_lines(path, lines)
+        for record, line in zip(records, lines):
+            window_start = int((record.get('request_timestamp') or 0) // window * window)
+            buffers[window_start].append(sort_key(record) + line + b'\n')
+        buffered += sum(len(line) for line in lines)
+        if buffered >= run_bytes:
+            runs.extend(write_runs(buffers, run_dir))
+            buffered = 0
+    runs.extend(write_runs(buffers, run_dir))
+    return runs
+
+
+def iter_line_batches(paths, batch_size=10000):
+    '''
+    Yield (path, lines) pairs of up to `batch_size` stripped, non-empty lines from
+    each of the output files at `paths`.  Truncated file ends are skipped.
+    '''
+    for path in paths:
+        lines = []
+        for line in iter_lines(path):
+            line = line.strip()
+            if line:
+                lines.append(line)
+                if len(lines) >= batch_size:
+                    yield path, lines
+                    lines = []
+        if lines:
+            yield path, lines
+
+
+def write_runs(buffers, run_dir):
+    runs = []
+    for window_start, lines in buffers.items():
+        lines.sort()
+        runs.append((window_start, write_run(lines, window_start, run_dir)))
+    buffers.clear()
+    return runs
+
+
+def write_run(lines, window_start, run_dir):
+    fd, run_path = tempfile.mkstemp(prefix='{}-'.format(window_start), suffix='.run', dir=run_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.writelines(lines)
+    return run_path
+
+
+def reduce_runs(window_start, run_paths, max_runs=MAX_MERGE_RUNS):
+    '''
+    Merge runs `max_runs` at a time until there are at most `max_runs` left.
+    '''
+    run_paths = list(run_paths)
+    while len(run_paths) > max_runs:
+        group, run_paths = run_paths[:max_runs], run_paths[max_runs:]
+        runs = [open(path, 'rb') for path in group]
+        try:
+            merged = write_run(heapq.merge(*runs), window_start, os.path.dirname(group[0]))
+        finally:
+            for run in runs:
+                run.close()
+        for path in group:
+            os.remove(path)
+        run_paths.append(merged)
+    return run_paths
+
+
+def merge_runs(window_start, run_paths, output_path, codec='xz', compresslevel=None, dedupe=False,
+               block_size=DEFAULT_BLOCK_SIZE, batch_size=1000):
+    '''
+    Merge the sorted runs of one window into a compacted file rendered from the
+    `output_path` template for the window's start, dropping exact duplicate records
+    if `dedupe` is set.  Returns a `WindowResult`.
+    '''
+    writer = RotatingFile(
+        output_path, compress=codec, block_size=block_size, compresslevel=compresslevel, clock=lambda: window_start)
+    runs = [open(path, 'rb') for path in reduce_runs(window_start, run_paths)]
+    records = duplicates = 0
+    previous = None
+    lines, keys = [], []
+    try:
+        for line in heapq.merge(*runs):
+            # Identical records have identical sort keys, so sort next to each other
+            if dedupe and line == previous:
+                duplicates += 1
+                continue
+            previous = line
+            key, _, record_line = line.partition(b'\t')
+            lines.append(record_line)
+            keys.append(parse_sort_key(key))
+            if len(lines) >= batch_size:
+                writer.write_records(b''.join(lines), keys)
+                records += len(lines)
+                lines, keys = [], []
+        if lines:
+            writer.write_records(b''.join(lines), keys)
+            records += len(lines)
+        writer.close()
+    finally:
+        for run in runs:
+            run.close()
+    return WindowResult(window_start, writer.paths[-1] if writer.paths else None, records, duplicates)
+
+
+def compact(inputs, output_dir, window=DEFAULT_WINDOW, template=None, codec='xz', compresslevel=None,
+            dedupe=False, workers=None, run_bytes=DEFAULT_RUN_BYTES, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Compact the output files in `inputs` (files or directories of them) into one
+    file per `window` seconds in `output_dir`, named by rendering `template` (see
+    `munificent.io.render_path_template`, and by default `default_template`) for the
+    window's start, with the codec's extension.  Each window must render to a
+    different name.  Input files and then windows are processed in a pool of
+    `workers` processes (by default, one per CPU).  Yields a `WindowResult` for each
+    window as it finishes, in order.  The input files are left in place.
+    '''
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    output_path = os.path.join(output_dir, (template or default_template(window)) + CODECS[codec])
+    # Leaving out earlier compacted files when the output directory is under an input
+    paths = [path for path in iter_output_files(inputs) if not is_in_directory(path, output_dir)]
+    run_dir = tempfile.mkdtemp(prefix='.compact-', dir=output_dir)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            runs = collections.defaultdict(list)
+            groups = list(group_files(paths, run_bytes))
+            split = [pool.submit(split_runs, group, run_dir, window, run_bytes) for group in groups]
+            for group, future in zip(groups, split):
+                for window_start, run_path in future.result():
+                    runs[window_start].append(run_path)
+                LOG.info("Sorted {} files into runs".format(len(group)))
+            # Windows in parallel merges must not share a name: only clashes with earlier
+            # compactions are left to unique_path
+            check_window_paths(output_path, runs)
+
+            merged = [
+                pool.submit(
+                    merge_runs, window_start, runs[window_start], output_path, codec, compresslevel, dedupe, block_size)
+                for window_start in sorted(runs)
+            ]
+            for future in merged:
+                yield future.result()
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def is_in_directory(path, directory):
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(directory)
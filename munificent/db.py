@@ -1,6 +1,9 @@
+import threading
+import uuid
+
 from sqlalchemy import (
-    create_engine,
-    Column, ForeignKey, Integer, String, Float,
+    create_engine, exc, inspect, select,
+    BigInteger, Boolean, Column, ForeignKey, Index, Integer, String, Float,
 )
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -8,6 +11,9 @@ import sqlalchemy.dialects.sqlite  # noqa
 
 from munificent import config as app_config
 
+_shared = {}
+_shared_lock = threading.Lock()
+
 
 def configured_engine(config=None):
     config = config or app_config
@@ -20,12 +26,71 @@ def configured_session(config=None):
     return scoped_session(sessionmaker(bind=engine))
 
 
+def get_engine():
+    '''
+    Return the engine for the configured database, creating it on first use.  The
+    engine and its connection pool are shared by everything in the process.
+    '''
+    with _shared_lock:
+        if 'engine' not in _shared:
+            _shared['engine'] = configured_engine()
+        return _shared['engine']
+
+
+def get_session():
+    '''
+    Return the process-wide scoped session, bound to the shared engine and created on
+    first use.
+    '''
+    engine = get_engine()
+    with _shared_lock:
+        if 'session' not in _shared:
+            _shared['session'] = scoped_session(sessionmaker(bind=engine))
+        return _shared['session']
+
+
+def reference_version(session=None):
+    '''
+    Return the version of the reference data, a token that `populate_db` replaces
+    whenever it loads it, for invalidating caches derived from it.  Tokens are
+    unique, so a version is never seen again after the database is reloaded or
+    recreated.  The version is read over a connection of its own, so a transaction
+    left open in `session` can't hide a newer one.  Returns None for databases that
+    don't record a version yet (see `migrate_db`), or haven't been loaded.
+    '''
+    engine = session.get_bind() if session is not None else get_engine()
+    table = ReferenceVersion.__table__
+    try:
+        with engine.connect() as connection:
+            return connection.execute(select(table.c.version)).scalar()
+    except exc.DBAPIError:
+        return None
+
+
+def bump_reference_version(session):
+    '''
+    Give the reference data a new version, as part of `session`'s transaction.
+    '''
+    table = ReferenceVersion.__table__
+    version = uuid.uuid4().hex
+    if not session.execute(table.update().values(version=version)).rowcount:
+        session.execute(table.insert().values(id=1, version=version))
+
+
 def search_routes(q):
-    Session = configured_session()
-    return (Session.query(Route)
+    return (get_session().query(Route)
         .filter(Route.tag.like('%{}%'.format(q))))
 
 
+def search_route_entries(q, limit=10, session=None):
+    '''
+    Return the routes best matching `q` by tag or title, ranked, as
+    `munificent.search` entries (see `search.SearchIndex`).
+    '''
+    from munificent.search import get_search_index
+    return [result.entry for result in get_search_index(session).search(q, kinds=['route'], limit=limit)]
+
+
 Base = declarative_base()
 
 
@@ -49,8 +114,8 @@ class Stop(Base):
     agency_id = Column(Integer, ForeignKey('agencies.id'))
     lat = Column(Float)
     lon = Column(Float)
-    stopID = Column(Integer)
-    tag = Column(String)
+    stopID = Column(Integer, index=True)
+    tag = Column(String, index=True)
     title = Column(String)
     # sqlite_autoincrement=True,
 
@@ -66,8 +131,8 @@ class Route(Base):
 
     id = Column(Integer, primary_key=True)
     agency_id = Column(Integer, ForeignKey('agencies.id'))
-    tag = Column(String)
-    title = Column(String)
+    tag = Column(String, index=True)
+    title = Column(String, index=True)
     # sqlite_autoincrement=True,
 
     agency = relationship('Agency')
@@ -77,10 +142,21 @@ class Route(Base):
         return 'Route({}: {})'.format(self.id, self.title)
 
 
+class ReferenceVersion(Base):
+    '''
+    A single row identifying the last load of the reference data (see
+    `reference_version`).
+    '''
+    __tablename__ = 'reference_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(String(32), nullable=False)
+
+
 class RouteStop(Base):
     __tablename__ = 'route_stops'
 
-    agency_id = Column(Integer, ForeignKey('agencies.id'))
+    agency_id = Column(Integer, ForeignKey('agencies.id'), index=True)
     route_id = Column('route_id', Integer, ForeignKey('routes.id'), primary_key=True)
     stop_id = Column('stop_id', Integer, ForeignKey('stops.id'), primary_key=True)
 
@@ -96,15 +172,85 @@ class RouteStop(Base):
         return 'RouteStop({}: {})'.format(self.route.tag, self.stop.title)
 
 
-def reload_db():
-    from munificent.nextbus import populate_db
+# Observations are kept apart from the reference data, so that reloading the
+# reference data (see `reload_db`) doesn't drop them.
+ObservationBase = declarative_base()
+
+
+class Prediction(ObservationBase):
+    __tablename__ = 'predictions'
+    __table_args__ = (
+        Index('ix_predictions_route_stop_time', 'routeTag', 'stopTag', 'request_timestamp'),
+        Index('ix_predictions_vehicle_time', 'vehicle', 'request_timestamp'),
+        Index('ix_predictions_time', 'request_timestamp'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    request_id = Column(String)
+    request_timestamp = Column(Integer)
+    routeTag = Column(String)
+    stopTag = Column(String)
+    routeTitle = Column(String)
+    stopTitle = Column(String)
+    epochTime = Column(BigInteger)
+    seconds = Column(Integer)
+    minutes = Column(Integer)
+    isDeparture = Column(Boolean)
+    block = Column(String)
+    vehicle = Column(String)
+    dirTag = Column(String)
+    tripTag = Column(String)
+    affectedByLayover = Column(Boolean)
+
+    def __repr__(self):
+        return 'Prediction({}|{}, vehicle={}, seconds={})'.format(
+            self.routeTag, self.stopTag, self.vehicle, self.seconds)
+
+
+class VehicleLocation(ObservationBase):
+    __tablename__ = 'vehicle_locations'
+    __table_args__ = (
+        Index('ix_vehicle_locations_vehicle_time', 'vehicle', 'request_timestamp'),
+        Index('ix_vehicle_locations_route_time', 'routeTag', 'request_timestamp'),
+        Index('ix_vehicle_locations_time', 'request_timestamp'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    request_id = Column(String)
+    request_timestamp = Column(Integer)
+    vehicle = Column(String)
+    routeTag = Column(String)
+    dirTag = Column(String)
+    lat = Column(Float)
+    lon = Column(Float)
+    heading = Column(Integer)
+    predictable = Column(Boolean)
+    secsSinceReport = Column(Integer)
+    speedKmHr = Column(Integer)
+    leadingVehicleId = Column(String)
+    nearestStopTag = Column(String)
+    nearestStopDistance = Column(Float)
+
+    def __repr__(self):
+        return 'VehicleLocation({}, lat={}, lon={})'.format(self.vehicle, self.lat, self.lon)
+
+
+# Observation table for each type of collected record
+OBSERVATION_TABLES = {
+    'prediction': Prediction.__table__,
+    'vehicle_location': VehicleLocation.__table__,
+}
+
+
+def reload_db(agency_tags=None):
+    from munificent.nextbus import DEFAULT_AGENCY_TAGS, populate_db
     drop_db()
     create_db()
-    populate_db()
+    populate_db(agency_tags or DEFAULT_AGENCY_TAGS)
 
 
 def drop_db(engine=None):
-    engine = engine or configured_engine()
+    engine = engine or get_engine()
     for entity in reversed(Base.metadata.sorted_tables):
         try:
             entity.drop(engine)
@@ -114,6 +260,41 @@ def drop_db(engine=None):
 
 
 def create_db(engine=None):
-    engine = engine or configured_engine()
+    engine = engine or get_engine()
     for entity in Base.metadata.sorted_tables:
         entity.create(engine)
+
+
+def migrate_db(engine=None):
+    '''
+    Bring an existing reference database up to date with the schema, creating any
+    missing tables and indexes.  Returns the names of the indexes it created.
+    '''
+    engine = engine or get_engine()
+    Base.metadata.create_all(engine)
+    existing = set()
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing.update(index['name'] for index in inspector.get_indexes(table.name))
+    created = []
+    for table in Base.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    return created
+
+
+def create_observation_tables(engine, attempts=5):
+    '''
+    Create any observation tables, and their indexes, that don't exist yet.  Other
+    processes sharing the database (e.g. collect workers) may be creating them at the
+    same time, so creation that fails is retried, checking again for what exists.
+    '''
+    for attempt in range(attempts):
+        try:
+            ObservationBase.metadata.create_all(engine)
+            return
+        except exc.DBAPIError:
+            if attempt == attempts - 1:
+                raise
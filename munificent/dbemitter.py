@@ -0,0 +1,105 @@
+'''
+Database output for collected records, written to the observation tables in
+`munificent.db` (`predictions` and `vehicle_locations`) with batched inserts.
+'''
+import collections
+import logging
+
+from sqlalchemy import BigInteger, Boolean, Float, Integer, create_engine, event
+from sqlalchemy.engine.url import make_url
+
+from munificent import db, metrics, profiling
+from munificent.io import BufferedEmitter
+
+LOG = logging.getLogger(__name__)
+
+# Seconds a SQLite connection waits for another writer, e.g. another worker
+SQLITE_BUSY_TIMEOUT = 30
+
+
+def observation_engine(url):
+    '''
+    Create an engine for the observation database at `url`, which may also be the
+    path of a SQLite database file.  SQLite databases are switched to write-ahead
+    logging, so that readers don't block the collector and vice versa.
+    '''
+    if '://' not in url:
+        url = 'sqlite:///' + url
+    if make_url(url).get_backend_name() != 'sqlite':
+        return create_engine(url)
+
+    engine = create_engine(url, connect_args={'timeout': SQLITE_BUSY_TIMEOUT})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+    return engine
+
+
+class DatabaseEmitter(BufferedEmitter):
+    '''
+    Emitter that inserts records into the observation tables from a background
+    writer thread.  Records are queued and inserted with one executemany per table in
+    a transaction per batch, which is committed once `batch_size` records are
+    waiting, or `commit_interval` seconds after the first of them was emitted.  The
+    tables are created if they don't exist yet.
+
+    As with `BufferedEmitter`, `emit` blocks while `max_queue` records are waiting,
+    and errors raised by the writer are re-raised on the next call to `emit` or
+    `flush`.
+    '''
+
+    def __init__(self, url, batch_size=1000, commit_interval=1.0, max_queue=10000, engine=None):
+        self.engine = engine or observation_engine(url)
+        db.create_observation_tables(self.engine)
+        self._columns = {
+            record_type: [(column.name, _converter(column.type)) for column in table.columns if column.name != 'id']
+            for record_type, table in db.OBSERVATION_TABLES.items()
+        }
+        super(DatabaseEmitter, self).__init__(
+            None, batch_size=batch_size, flush_interval=commit_interval, max_queue=max_queue)
+
+    def emit(self, record):
+        if record['type'] not in self._columns:
+            raise ValueError("No observation table for record type: {}".format(record['type']))
+        super(DatabaseEmitter, self).emit(record)
+
+    def close(self):
+        super(DatabaseEmitter, self).close()
+        self.engine.dispose()
+
+    def _write_records(self, records):
+        rows = collections.defaultdict(list)
+        for record in records:
+            rows[record['type']].append(self._row(record))
+        try:
+            with metrics.WRITE_SECONDS.time(), profiling.stage('write'):
+                with self.engine.begin() as connection:
+                    for record_type, table_rows in rows.items():
+                        connection.execute(db.OBSERVATION_TABLES[record_type].insert(), table_rows)
+        except Exception:
+            metrics.EMITTER_ERRORS.inc()
+            raise
+        metrics.RECORDS_EMITTED.inc(len(records))
+
+    def _row(self, record):
+        row = {}
+        for name, convert in self._columns[record['type']]:
+            value = record.get(name)
+            if value is not None and convert is not None:
+                value = convert(value)
+            row[name] = value
+        return row
+
+
+def _converter(column_type):
+    if isinstance(column_type, (Integer, BigInteger)):
+        return int
+    if isinstance(column_type, Float):
+        return float
+    if isinstance(column_type, Boolean):
+        return bool
+    return None
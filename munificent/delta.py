@@ -0,0 +1,137 @@
+'''
+Change-only emission.  Rather than every probe result in full, a `ChangeTracker`
+passes on only the records that changed since the probe's previous result, plus
+tombstones for records that disappeared and a periodic keyframe of the full state.
+
+A reader rebuilds a probe's state from its last 'keyframe' record and the records
+that follow it: a keyframe marker is followed by `records` records making up the
+whole state, later records replace the state entry with the same key, and a
+'tombstone' record removes one.
+'''
+import collections
+import time
+
+# Fields identifying the same prediction or vehicle across results
+KEY_FIELDS = {
+    'prediction': ('stopTag', 'tripTag', 'vehicle'),
+    'vehicle_location': ('vehicle',),
+}
+
+# Fields that change on every poll even when the underlying data hasn't
+VOLATILE_FIELDS = {
+    'prediction': frozenset(['request_id', 'request_timestamp', 'seconds', 'minutes']),
+    'vehicle_location': frozenset(['request_id', 'request_timestamp', 'secsSinceReport']),
+}
+
+IndexEntry = collections.namedtuple('IndexEntry', ['record', 'fingerprint', 'last_seen'])
+
+
+class ChangeTracker(object):
+    '''
+    Tracks the last-seen state of one probe's records, keyed by `KEY_FIELDS`.
+
+    Each result normally replaces the whole state, so keys missing from it are
+    tombstoned.  With `partial`, results only contain what was updated (see
+    `ResponseCache.incremental_locations`), so keys are only tombstoned once they
+    haven't been seen for `ttl` seconds.  Either way, when the index holds more than
+    `max_entries` keys, the least recently seen are tombstoned and dropped.
+    '''
+
+    def __init__(self, scope, keyframe_interval=600, ttl=None, max_entries=100000, partial=False,
+                 clock=time.time):
+        self.scope = scope
+        self.keyframe_interval = keyframe_interval
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.partial = partial
+        self.clock = clock
+        self._index = collections.OrderedDict()
+        self._next_keyframe = None
+
+    def diff(self, records, meta):
+        '''
+        Yield the records from one result (whose `_meta` is `meta`) that changed since
+        the previous result, followed by tombstones for records that disappeared.
+        Once every `keyframe_interval` seconds, yields a keyframe marker and the full
+        state instead of the changes.
+        '''
+        now = self.clock()
+        keyframe = self._next_keyframe is None or now >= self._next_keyframe
+        seen = set()
+        for record in records:
+            key = record_key(record)
+            seen.add(key)
+            if self._update(key, record, now) and not keyframe:
+                yield record
+
+        for tombstone in self._evict(seen, now, meta):
+            yield tombstone
+
+        if keyframe:
+            self._next_keyframe = now + self.keyframe_interval
+            yield {
+                'type': 'keyframe',
+                'scope': self.scope,
+                'request_id': meta['request_id'],
+                'request_timestamp': meta['timestamp'],
+                'records': len(self._index),
+            }
+            for entry in self._index.values():
+                yield entry.record
+
+    def unchanged(self, meta):
+        '''
+        Like `diff`, for a result that is unchanged since the previous one (e.g. a
+        skipped duplicate response), whose `_meta` is `meta`: yields nothing but the
+        keyframe when one is due, from the last known state, and expired records'
+        tombstones.
+        '''
+        records = [] if self.partial else [entry.record for entry in self._index.values()]
+        return self.diff(records, meta)
+
+    def _update(self, key, record, now):
+        '''
+        Store the latest version of a record, returning whether it changed.
+        '''
+        fingerprint = record_fingerprint(record)
+        previous = self._index.pop(key, None)
+        self._index[key] = IndexEntry(record, fingerprint, now)
+        return previous is None or previous.fingerprint != fingerprint
+
+    def _evict(self, seen, now, meta):
+        expired = []
+        for key, entry in self._index.items():
+            if not self.partial and key not in seen:
+                expired.append(key)
+            elif self.ttl is not None and now - entry.last_seen > self.ttl:
+                expired.append(key)
+
+        overflow = len(self._index) - len(expired) - self.max_entries
+        if overflow > 0:
+            expired_keys = set(expired)
+            expired.extend([key for key in self._index if key not in expired_keys][:overflow])
+
+        for key in expired:
+            yield tombstone(self._index.pop(key).record, self.scope, meta)
+
+
+def record_key(record):
+    return (record['type'],) + tuple(record.get(f) for f in KEY_FIELDS[record['type']])
+
+
+def record_fingerprint(record):
+    volatile = VOLATILE_FIELDS[record['type']]
+    return tuple(sorted((k, v) for k, v in record.items() if k not in volatile))
+
+
+def tombstone(record, scope, meta):
+    removed = {
+        'type': 'tombstone',
+        'record_type': record['type'],
+        'scope': scope,
+        'request_id': meta['request_id'],
+        'request_timestamp': meta['timestamp'],
+    }
+    for field in KEY_FIELDS[record['type']]:
+        removed[field] = record.get(field)
+    return removed
@@ -1,5 +1,37 @@
+import collections
+import datetime
+import errno
 import gzip
 import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from munificent import metrics, profiling
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+try:
+    from lzma import LZMAError
+except ImportError:  # Python 2
+    LZMAError = zlib.error
+
+LOG = logging.getLogger(__name__)
+
+# Output files are indexed in blocks of about this many uncompressed bytes
+BLOCK_SIZE = 4 * 1024 * 1024
+# Suffix of the metadata sidecar written next to each rotated output file
+METADATA_SUFFIX = '.meta.json'
+# Files in an output directory that readers pick up
+JSON_LINES_EXTENSIONS = ('.jsonl', '.jsonl.gz', '.jsonl.xz', '.json', '.json.gz', '.json.xz')
+# Files being written are named '.<final name>.<writer PID>.tmp'
+TEMPORARY_FILE_PATTERN = re.compile(r'^\.(.+)\.(\d+)\.tmp$')
 
 
 def open_file_normal(path):
@@ -10,15 +42,460 @@ def open_file_gzip(path):
     return lambda mode: gzip.open(path, mode)
 
 
+def open_file_rotating(template, compress=False, max_bytes=None, interval=None, block_size=BLOCK_SIZE, **fields):
+    return lambda mode: RotatingFile(
+        template,
+        compress=compress,
+        max_bytes=max_bytes,
+        interval=interval,
+        block_size=block_size,
+        fields=fields,
+    )
+
+
+def open_output_file(path, mode='rb'):
+    '''
+    Open an output file, decompressing it if its name ends in '.gz' or '.xz'.
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    if path.endswith('.xz'):
+        import lzma
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+
+def decompress_block(path, data):
+    '''
+    Decompress a block (see `OutputMetadata`) read from the output file at `path`.
+    '''
+    if path.endswith('.gz'):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if path.endswith('.xz'):
+        import lzma
+        return lzma.decompress(data)
+    return data
+
+
+# Errors reading a compressed output file cut short, e.g. by a crash mid-write
+TRUNCATION_ERRORS = (EOFError, zlib.error, LZMAError, getattr(gzip, 'BadGzipFile', IOError))
+
+
+def iter_lines(path):
+    '''
+    Yield the lines of an output file, plain or compressed.  A truncated or corrupt
+    compressed tail, as left by a crash, is logged and skipped.
+    '''
+    with open_output_file(path) as f:
+        try:
+            for line in f:
+                yield line
+        except TRUNCATION_ERRORS as e:
+            LOG.warning("Skipping truncated end of {}: {}".format(path, e))
+
+
+def decode_line(path, line):
+    '''
+    Decode a JSON line from the output file at `path`, or log it and return None if
+    it can't be decoded, like a line torn by a crash.
+    '''
+    try:
+        return json.loads(line.decode('utf-8'))
+    except ValueError:
+        LOG.warning("Skipping undecodable line in {}: {!r}".format(path, line[:200]))
+        return None
+
+
+def decode_lines(path, lines):
+    '''
+    Decode a batch of stripped, non-empty JSON lines from the output file at `path`.
+    Returns lists of the records and of the lines they came from, leaving out (and
+    logging) lines that can't be decoded.
+    '''
+    try:
+        # Decoding the lines as one JSON array is much faster than one at a time
+        return json.loads(b''.join([b'[', b','.join(lines), b']']).decode('utf-8')), lines
+    except ValueError:
+        pass
+    decoded = [(decode_line(path, line), line) for line in lines]
+    decoded = [(record, line) for record, line in decoded if record is not None]
+    return [record for record, _ in decoded], [line for _, line in decoded]
+
+
+class RotatingFile(object):
+    '''
+    Write-only file that rolls over to a new file once `max_bytes` have been written
+    to it, or when the wall clock crosses a multiple of `interval` seconds.  File names
+    are rendered from `template` with `str.format`, using `fields` plus the file's
+    start time as `time` (a UTC datetime) and as the `YYYYMMDD`, `YYYYMMDDHH` and
+    `YYYYMMDDHHMM` shorthands.  With an interval, the start time is the start of the
+    interval, e.g. '{target}-{YYYYMMDDHH}.jsonl.gz' gives one file per hour.
+
+    Each file is written under a hidden temporary name and renamed into place only
+    once it is complete, so readers never see a partially written file.  Rollover
+    happens between writes, so a record written in a single call is never split.
+    If the process dies before then (e.g. a crash or SIGKILL), a whole file's worth
+    of records (up to `max_bytes`, or `interval` seconds of them) is left under the
+    temporary name, and whatever hadn't been flushed from the compressor and file
+    buffers is lost.  The next `RotatingFile` to open a file in the same directory
+    renames such leftovers into place (see `recover_temporary_files`); readers skip
+    their torn ends.
+
+    Records written with `write_records` are summarized in a metadata sidecar written
+    next to each file (see `OutputMetadata`), which lets readers skip files and blocks
+    of about `block_size` uncompressed bytes that can't hold what they are looking
+    for.  Compressed files start a new gzip member (or with `compress='xz'`, xz
+    stream) for each block, so that a block can be decompressed on its own.
+    `compresslevel` defaults to 9 for gzip and 6 for xz.
+    '''
+
+    def __init__(self, template, compress=False, max_bytes=None, interval=None, fields=None, clock=time.time,
+                 block_size=BLOCK_SIZE, compresslevel=None):
+        self.template = template
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.fields = fields or {}
+        self.clock = clock
+        self.block_size = block_size
+        self.closed = False
+        # Files written so far, in order
+        self.paths = []
+        self._raw = None
+        self._handle = None
+        self._recovered_directories = set()
+
+    def write(self, data):
+        self._write(data)
+        # Nothing is known about what was written, so no metadata can be kept
+        self._metadata = None
+
+    def write_records(self, data, records):
+        '''
+        Write `data`, the serialization of `records`, and add the records to the
+        file's metadata.
+        '''
+        self._write(data)
+        if self._metadata is not None:
+            self._block_metadata.update(records)
+        if self.block_size and self._block_bytes >= self.block_size:
+            self._end_block()
+
+    def _write(self, data):
+        if self._raw and self._rollover_due():
+            self._finalize()
+        if not self._raw:
+            self._open()
+        if not self._handle:
+            self._start_block()
+        self._handle.write(data)
+        self._block_bytes += len(data)
+
+    def flush(self):
+        if self._handle:
+            self._handle.flush()
+
+    def close(self):
+        self._finalize()
+        self.closed = True
+
+    def _rollover_due(self):
+        if self.max_bytes and self._raw.tell() >= self.max_bytes:
+            return True
+        return self._ends_at is not None and self.clock() >= self._ends_at
+
+    def _open(self):
+        now = self.clock()
+        self._ends_at = None
+        if self.interval:
+            now = now - now % self.interval
+            self._ends_at = now + self.interval
+
+        self._final_path = render_path_template(self.template, now, **self.fields)
+        directory, filename = os.path.split(self._final_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if directory not in self._recovered_directories:
+            recover_temporary_files(directory)
+            self._recovered_directories.add(directory)
+        self._tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(filename, os.getpid()))
+        self._raw = open(self._tmp_path, 'wb')
+        self._metadata = OutputMetadata()
+
+    def _start_block(self):
+        self._block_offset = self._raw.tell()
+        self._block_bytes = 0
+        self._block_metadata = OutputMetadata()
+        self._handle = self._raw
+        if self.compress == 'xz':
+            import lzma
+            preset = 6 if self.compresslevel is None else self.compresslevel
+            self._handle = lzma.LZMAFile(self._raw, mode='wb', preset=preset)
+        elif self.compress:
+            filename = os.path.basename(self._final_path)
+            compresslevel = 9 if self.compresslevel is None else self.compresslevel
+            self._handle = gzip.GzipFile(filename=filename, mode='wb', compresslevel=compresslevel, fileobj=self._raw)
+
+    def _end_block(self):
+        if self._handle is not self._raw:
+            self._handle.close()
+        self._handle = None
+        if self._metadata is not None:
+            self._block_metadata.offset = self._block_offset
+            self._block_metadata.length = self._raw.tell() - self._block_offset
+            self._metadata.add_block(self._block_metadata)
+
+    def _finalize(self):
+        if not self._raw:
+            return
+        if self._handle:
+            self._end_block()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        self._raw = None
+        final_path = unique_path(self._final_path)
+        if self._metadata is not None:
+            write_metadata(final_path, self._metadata)
+        os.rename(self._tmp_path, final_path)
+        self.paths.append(final_path)
+
+
+class OutputMetadata(object):
+    '''
+    Summary of the records in an output file, or in a block of one: how many there
+    are, their record types and routes, and the range of their request timestamps.
+    A file's metadata also lists its blocks, each with its byte `offset` and `length`
+    in the file.
+    '''
+
+    def __init__(self, records=0, min_timestamp=None, max_timestamp=None, types=(), routes=(), blocks=(),
+                 offset=None, length=None):
+        self.records = records
+        self.min_timestamp = min_timestamp
+        self.max_timestamp = max_timestamp
+        self.types = set(types)
+        self.routes = set(routes)
+        self.blocks = list(blocks)
+        self.offset = offset
+        self.length = length
+
+    def update(self, records):
+        timestamps = set()
+        for record in records:
+            self.records += 1
+            self.types.add(record.get('type'))
+            timestamps.add(record.get('request_timestamp'))
+            route = record.get('routeTag')
+            if route is not None:
+                self.routes.add(route)
+        timestamps.discard(None)
+        if timestamps:
+            self._extend(min(timestamps), max(timestamps))
+
+    def _extend(self, min_timestamp, max_timestamp):
+        if self.min_timestamp is None or min_timestamp < self.min_timestamp:
+            self.min_timestamp = min_timestamp
+        if self.max_timestamp is None or max_timestamp > self.max_timestamp:
+            self.max_timestamp = max_timestamp
+
+    def add_block(self, block):
+        self.blocks.append(block)
+        self.records += block.records
+        self.types |= block.types
+        self.routes |= block.routes
+        if block.min_timestamp is not None:
+            self._extend(block.min_timestamp, block.max_timestamp)
+
+    def to_dict(self):
+        metadata = {
+            'records': self.records,
+            'min_timestamp': self.min_timestamp,
+            'max_timestamp': self.max_timestamp,
+            'types': sorted(t for t in self.types if t is not None),
+            'routes': sorted(self.routes),
+        }
+        if self.offset is not None:
+            metadata.update(offset=self.offset, length=self.length)
+        else:
+            metadata['blocks'] = [block.to_dict() for block in self.blocks]
+        return metadata
+
+    @classmethod
+    def from_dict(cls, metadata):
+        blocks = [cls.from_dict(block) for block in metadata.get('blocks', ())]
+        return cls(
+            metadata['records'], metadata['min_timestamp'], metadata['max_timestamp'], metadata['types'],
+            metadata['routes'], blocks, metadata.get('offset'), metadata.get('length'),
+        )
+
+
+def metadata_path(path):
+    return path + METADATA_SUFFIX
+
+
+def write_metadata(path, metadata):
+    '''
+    Write the metadata sidecar for the output file at `path`.
+    '''
+    final_path = metadata_path(path)
+    directory, filename = os.path.split(final_path)
+    tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(filename, os.getpid()))
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata.to_dict(), f, sort_keys=True)
+    os.rename(tmp_path, final_path)
+
+
+def read_metadata(path):
+    '''
+    Read the metadata sidecar for the output file at `path`, or return None if it
+    doesn't have one.
+    '''
+    try:
+        with open(metadata_path(path)) as f:
+            return OutputMetadata.from_dict(json.load(f))
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def render_path_template(template, timestamp, **fields):
+    dt = datetime.datetime.utcfromtimestamp(timestamp)
+    return template.format(
+        time=dt,
+        YYYYMMDD=dt.strftime('%Y%m%d'),
+        YYYYMMDDHH=dt.strftime('%Y%m%d%H'),
+        YYYYMMDDHHMM=dt.strftime('%Y%m%d%H%M'),
+        **fields
+    )
+
+
+def recover_temporary_files(directory):
+    '''
+    Rename output files that were left under their temporary names in `directory`
+    (see `RotatingFile`) by processes that are no longer running into place, under
+    unique names.  Their last records may be torn.  Returns the recovered paths.
+    '''
+    recovered = []
+    for filename in sorted(os.listdir(directory or os.curdir)):
+        match = TEMPORARY_FILE_PATTERN.match(filename)
+        if not match or not is_output_file(match.group(1)) or is_running(int(match.group(2))):
+            continue
+        path = unique_path(os.path.join(directory, match.group(1)))
+        try:
+            os.rename(os.path.join(directory, filename), path)
+        except OSError:  # Recovered by another process first
+            continue
+        LOG.warning("Recovered output left by process {} as {}".format(match.group(2), path))
+        recovered.append(path)
+    return recovered
+
+
+def is_running(pid):
+    '''
+    Whether a process with ID `pid` is running.  Always true on Windows, where there's
+    no safe way to ask.
+    '''
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def unique_path(path):
+    '''
+    Return `path`, or if it already exists, the first of 'name-1.ext', 'name-2.ext',
+    etc. that doesn't.  Ordered by `output_order`, the names sort in the order they
+    were handed out.
+    '''
+    directory, filename = os.path.split(path)
+    stem, dot, extension = filename.partition('.')
+    candidate, n = path, 0
+    while os.path.exists(candidate):
+        n += 1
+        candidate = os.path.join(directory, '{}-{}{}{}'.format(stem, n, dot, extension))
+    return candidate
+
+
+def output_order(filename):
+    '''
+    Sort key putting output file names in the order they were written: by the name
+    before the extension, with numbers in it compared as numbers, so that 'name.ext'
+    comes before 'name-1.ext' (see `unique_path`) and 'name-2.ext' before
+    'name-10.ext'.
+    '''
+    stem, _, extension = os.path.basename(filename).partition('.')
+    parts = re.split(r'(\d+)', stem)
+    return [(0, int(part)) if part.isdigit() else (1, part) for part in parts if part], extension
+
+
+def serialize_records(records):
+    '''
+    Serialize records to newline-delimited JSON in a single UTF-8 encoded chunk.
+    '''
+    encode = _RECORD_ENCODER.encode
+    lines = [encode(record) if type(record) is dict else encode_record(record, encode) for record in records]
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def encode_record(record, encode):
+    '''
+    Encode records that aren't plain dicts, using their own `to_json` where they have
+    one (see `munificent.collect.PredictionPoint`).
+    '''
+    to_json = getattr(record, 'to_json', None)
+    if to_json is not None:
+        return to_json(encode)
+    return encode(record)
+
+
+def record_to_dict(record):
+    '''
+    Convert compact record types such as `munificent.collect.PredictionPoint` into
+    plain dicts for serialization.
+    '''
+    to_dict = getattr(record, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError("Object of type {} is not JSON serializable".format(type(record).__name__))
+    return to_dict()
+
+
+_RECORD_ENCODER = json.JSONEncoder(ensure_ascii=False, default=record_to_dict)
+
+
 class Emitter(object):
 
     def __init__(self, file_opener):
         self._open_file = file_opener
+        self._flush_requested = False
 
     def emit(self, record):
-        f = self._output_handle
-        f.write(json.dumps(record, ensure_ascii=False).encode('utf-8'))
-        f.write(b'\n')
+        if self._flush_requested:
+            self._flush_requested = False
+            self.flush()
+        self._write_records([record])
+
+    def _write_records(self, records):
+        try:
+            with metrics.WRITE_SECONDS.time():
+                with profiling.stage('serialize'):
+                    data = serialize_records(records)
+                with profiling.stage('write'):
+                    handle = self._output_handle
+                    write_records = getattr(handle, 'write_records', None)
+                    if write_records is not None:
+                        write_records(data, records)
+                    else:
+                        handle.write(data)
+        except Exception:
+            metrics.EMITTER_ERRORS.inc()
+            raise
+        metrics.RECORDS_EMITTED.inc(len(records))
+        metrics.BYTES_WRITTEN.inc(len(data))
 
     @property
     def _output_handle(self):
@@ -37,5 +514,288 @@ class Emitter(object):
                 output_handle.close()
             del self._output_handle_
 
+    def request_flush(self):
+        '''
+        Ask for a `flush` before the next record is written.  Unlike calling `flush`
+        directly, this is safe from a signal handler that may interrupt a write.
+        '''
+        self._flush_requested = True
+
+    def close(self):
+        self.flush()
+
     def __del__(self):
         self.flush()
+
+
+class BufferedEmitter(Emitter):
+    '''
+    Emitter that hands records to a background writer thread, which serializes and
+    writes them in batches of up to `batch_size` records, at least every
+    `flush_interval` seconds.  `emit` blocks while `max_queue` records are waiting, so
+    a slow disk applies backpressure to collection instead of growing memory.
+
+    `flush` waits until every record emitted before it has been written and the
+    output handle closed.  Errors raised by the writer are re-raised on the next call
+    to `emit` or `flush`.
+    '''
+    _STOP = object()
+
+    def __init__(self, file_opener, batch_size=1000, flush_interval=1.0, max_queue=10000):
+        super(BufferedEmitter, self).__init__(file_opener)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._flush_event = threading.Event()
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, name='emitter-writer')
+        self._writer.daemon = True
+        self._writer.start()
+        metrics.QUEUE_DEPTH.set_function(self._queue.qsize)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def emit(self, record):
+        self._raise_writer_error()
+        self._queue.put(record)
+
+    def flush(self):
+        if not self._writer.is_alive():
+            super(BufferedEmitter, self).flush()
+        else:
+            done = threading.Event()
+            self._queue.put(done)
+            done.wait()
+        self._raise_writer_error()
+
+    def request_flush(self):
+        self._flush_event.set()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(self._STOP)
+            self._writer.join()
+        self._raise_writer_error()
+
+    def _raise_writer_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _write_loop(self):
+        batch = []
+        deadline = None
+        while True:
+            item = self._next_item(deadline)
+            if item is self._STOP:
+                self._write_batch(batch, close=True)
+                return
+            if isinstance(item, threading.Event):
+                self._write_batch(batch, close=True)
+                item.set()
+            elif item is not None:
+                batch.append(item)
+
+            if self._batch_due(batch, deadline):
+                self._write_batch(batch, close=self._flush_event.is_set())
+            deadline = self._batch_deadline(batch, deadline)
+
+    def _next_item(self, deadline):
+        timeout = self.flush_interval
+        if deadline is not None:
+            timeout = max(deadline - time.time(), 0)
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _batch_due(self, batch, deadline):
+        if self._flush_event.is_set() or len(batch) >= self.batch_size:
+            return True
+        return deadline is not None and time.time() >= deadline
+
+    def _batch_deadline(self, batch, deadline):
+        if not batch:
+            return None
+        return deadline or time.time() + self.flush_interval
+
+    def _write_batch(self, batch, close=False):
+        try:
+            if batch:
+                self._write_records(batch)
+            if close:
+                self._flush_event.clear()
+                Emitter.flush(self)
+        except Exception as e:
+            LOG.exception(e)
+            self._error = e
+        finally:
+            del batch[:]
+
+
+def iter_output_files(paths, extensions=JSON_LINES_EXTENSIONS):
+    '''
+    Yield the output files in `paths`, which may be files or directories.  Files
+    under a directory, at any depth, are yielded in the order they were written (see
+    `output_order`), skipping temporary files, metadata sidecars and files without
+    one of `extensions`.
+    '''
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort(key=output_order)
+            for filename in sorted(filenames, key=output_order):
+                if is_output_file(filename, extensions):
+                    yield os.path.join(directory, filename)
+
+
+def is_output_file(filename, extensions=JSON_LINES_EXTENSIONS):
+    if filename.startswith('.') or filename.endswith(METADATA_SUFFIX):
+        return False
+    return filename.endswith(tuple(extensions))
+
+
+class RecordFilter(object):
+    '''
+    Selects records by `types`, `routes` (routeTag), `stops` (stopTag) and `vehicles`,
+    each a collection of values to accept, and by request timestamp, from `start`
+    up to but not including `end`.  Criteria that are None accept anything.
+    '''
+
+    def __init__(self, types=None, routes=None, stops=None, vehicles=None, start=None, end=None):
+        self.start = start
+        self.end = end
+        self.fields = [
+            (field, set(values))
+            for field, values in (('type', types), ('routeTag', routes), ('stopTag', stops), ('vehicle', vehicles))
+            if values is not None
+        ]
+        # A line can only hold a match if it contains an encoded value of each field,
+        # as written (see `serialize_records`) or with non-ASCII characters escaped
+        self._tokens = [
+            set(json.dumps(value, ensure_ascii=ensure_ascii).encode('utf-8')
+                for value in values for ensure_ascii in (False, True))
+            for _, values in self.fields
+        ]
+        self.types = set(types) if types is not None else None
+        self.routes = set(routes) if routes is not None else None
+
+    def matches(self, record):
+        for field, values in self.fields:
+            if record.get(field) not in values:
+                return False
+        if self.start is None and self.end is None:
+            return True
+        timestamp = record.get('request_timestamp')
+        if timestamp is None:
+            return False
+        return (self.start is None or timestamp >= self.start) and (self.end is None or timestamp < self.end)
+
+    def matches_line(self, line):
+        '''
+        Cheap test of whether a serialized record could match, before decoding it.
+        '''
+        for tokens in self._tokens:
+            if not any(token in line for token in tokens):
+                return False
+        return True
+
+    def matches_metadata(self, metadata):
+        '''
+        Whether the file or block described by an `OutputMetadata` could hold a match.
+        '''
+        if not metadata.records:
+            return False
+        if self.types is not None and not self.types & metadata.types:
+            return False
+        if self.routes is not None and not self.routes & metadata.routes:
+            return False
+        if self.start is None and self.end is None:
+            return True
+        if metadata.min_timestamp is None:
+            return False
+        if self.start is not None and metadata.max_timestamp < self.start:
+            return False
+        return self.end is None or metadata.min_timestamp < self.end
+
+
+def read_file(path, record_filter=None):
+    '''
+    Lazily yield the records in a JSON lines output file, plain or compressed, that
+    match `record_filter`.  Files and blocks whose metadata sidecar shows that they
+    hold no matches aren't read, and lines that can't match aren't decoded.
+    '''
+    record_filter = record_filter or RecordFilter()
+    metadata = read_metadata(path)
+    if metadata is not None and not record_filter.matches_metadata(metadata):
+        return
+    if metadata is not None and metadata.blocks:
+        lines = _iter_block_lines(path, metadata, record_filter)
+    else:
+        lines = iter_lines(path)
+    for line in lines:
+        if line.strip() and record_filter.matches_line(line):
+            record = decode_line(path, line.strip())
+            if record is not None and record_filter.matches(record):
+                yield record
+
+
+def _iter_block_lines(path, metadata, record_filter):
+    with open(path, 'rb') as f:
+        for block in metadata.blocks:
+            if not record_filter.matches_metadata(block):
+                continue
+            f.seek(block.offset)
+            for line in decompress_block(path, f.read(block.length)).splitlines():
+                yield line
+
+
+def read_records(paths, types=None, routes=None, stops=None, vehicles=None, start=None, end=None, workers=1):
+    '''
+    Lazily yield the records in collected output matching the given criteria (see
+    `RecordFilter`), file by file.  `paths` are output files or directories of them,
+    such as a set of rotated or sharded files.  With more than one worker and more
+    than one file, files are decoded in a pool of `workers` processes, a few files
+    ahead of the records being consumed.
+    '''
+    record_filter = RecordFilter(types, routes, stops, vehicles, start, end)
+    files = list(iter_output_files(paths))
+    if workers > 1 and len(files) > 1:
+        batches = _read_in_pool(files, record_filter, workers)
+    else:
+        batches = (read_file(path, record_filter) for path in files)
+    for batch in batches:
+        for record in batch:
+            yield record
+
+
+def _read_in_pool(files, record_filter, workers):
+    '''
+    Yield the lists of matching records in `files`, in order, read by a pool of
+    `workers` processes.
+    '''
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    files = iter(files)
+    try:
+        while True:
+            while len(pending) < 2 * workers:
+                path = next(files, None)
+                if path is None:
+                    break
+                pending.append(executor.submit(_read_file_matches, path, record_filter))
+            if not pending:
+                return
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def _read_file_matches(path, record_filter):
+    return list(read_file(path, record_filter))
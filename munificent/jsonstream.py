@@ -0,0 +1,152 @@
+'''
+Incremental decoding of JSON objects whose bulk is a single array, such as NextBus
+prediction and vehicle location responses.
+'''
+import codecs
+import json
+import re
+import types
+
+WHITESPACE = re.compile(r'\s*')
+
+
+class StreamingResult(dict):
+    '''
+    A decoded JSON object whose streamed member is a generator of array elements.
+    Members that follow the streamed array in the document are only filled in once
+    the generator has been exhausted.
+    '''
+
+
+def materialize(result):
+    '''
+    Consume the streamed members of `result`, returning a plain dict with lists in
+    place of their generators, and any members that followed them filled in.
+    '''
+    items = {key: list(value) for key, value in list(result.items()) if isinstance(value, types.GeneratorType)}
+    materialized = dict(result)
+    materialized.update(items)
+    return materialized
+
+
+def stream_object(chunks, item_key, encoding='utf-8'):
+    '''
+    Decode a JSON object from an iterable of byte chunks, returning a
+    `StreamingResult` in which the array under `item_key` is a generator that decodes
+    one element at a time as it is consumed.  If the value under `item_key` is a
+    single object rather than an array, the generator yields just that object.
+
+    Members before `item_key` are decoded up front, so at most one array element,
+    plus one chunk of input, needs to be held in memory at a time.
+    '''
+    scanner = JSONScanner(chunks, encoding)
+    result = StreamingResult()
+    scanner.expect('{')
+    if _read_members(scanner, result, stop_at=item_key):
+        result[item_key] = _stream_items(scanner, result)
+    return result
+
+
+def _read_members(scanner, result, stop_at=None):
+    '''
+    Decode `"key": value` members into `result` until the end of the object, or until
+    the key `stop_at` is reached, in which case its value is left unread.
+    '''
+    while True:
+        char = scanner.peek()
+        if char == '}':
+            scanner.advance()
+            return False
+        if char == ',':
+            scanner.advance()
+            continue
+        key = scanner.value()
+        scanner.expect(':')
+        if key == stop_at:
+            return True
+        result[key] = scanner.value()
+
+
+def _stream_items(scanner, result):
+    if scanner.peek() != '[':
+        yield scanner.value()
+    else:
+        scanner.advance()
+        while scanner.peek() != ']':
+            if scanner.peek() == ',':
+                scanner.advance()
+                continue
+            yield scanner.value()
+        scanner.advance()
+    _read_members(scanner, result)
+
+
+class JSONScanner(object):
+    '''
+    Reads JSON tokens and values from a stream of byte chunks, keeping only the
+    unconsumed part of the input buffered.
+    '''
+
+    def __init__(self, chunks, encoding='utf-8'):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def peek(self):
+        '''
+        Return the next non-whitespace character without consuming it.
+        '''
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def advance(self):
+        self._pos += 1
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected {!r} in JSON stream, found {!r}".format(char, found))
+        self.advance()
+
+    def value(self):
+        '''
+        Decode and consume the next complete JSON value.
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the very end of the buffer may continue in the next chunk
+            if end < len(self._buffer) or not self._fill():
+                self._pos = end
+                return value
+
+    def _fill(self):
+        '''
+        Append the next chunk of input to the buffer, dropping the consumed part.
+        Returns False once the input is exhausted.
+        '''
+        text = ''
+        while not text and not self._eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                text = self._decoder.decode(b'', True)
+            else:
+                text = self._decoder.decode(chunk)
+        if not text:
+            return False
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
@@ -0,0 +1,308 @@
+'''
+Collector metrics, kept in a process-wide `REGISTRY` and exposed in the Prometheus
+text format, either over HTTP (`serve_metrics`) or by periodically writing a stats
+file (`StatsFileWriter`), e.g. for node_exporter's textfile collector.
+
+Metrics are updated once per request, probe result or write rather than once per
+record, so instrumentation stays cheap at high record rates.
+'''
+import bisect
+import logging
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+LOG = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metric(object):
+    '''
+    A named metric with a value for each combination of its label values.
+    '''
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("Expected labels {} for {}, got {}".format(self.labels, self.name, sorted(labels)))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        '''
+        Yield (name suffix, label pairs, value) for each sample of the metric.
+        '''
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            yield '', list(zip(self.labels, key)), value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    '''
+    A value that can go up and down.  With `set_function`, the value for a set of
+    labels is read from a callable whenever the metric is collected.
+    '''
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, fn, **labels):
+        self.set(fn, **labels)
+
+    def value(self, **labels):
+        value = self._values.get(self._key(labels), 0)
+        return value() if callable(value) else value
+
+    def samples(self):
+        for suffix, labels, value in super(Gauge, self).samples():
+            yield suffix, labels, value() if callable(value) else value
+
+
+class Histogram(Metric):
+    '''
+    Counts observations into cumulative `buckets` by upper bound, along with their
+    count and sum.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        return Timer(lambda elapsed: self.observe(elapsed, **labels))
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels)) or ([0], 0.0)
+        return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in sorted(values):
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', labels + [('le', format_value(bound))], cumulative
+            yield '_count', labels, cumulative
+            yield '_sum', labels, total
+
+
+class Timer(object):
+    '''
+    Context manager that passes the seconds spent inside it to `callback`.
+    '''
+
+    def __init__(self, callback, clock=time.time):
+        self.callback = callback
+        self.clock = clock
+
+    def __enter__(self):
+        self.start = self.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = self.clock() - self.start
+        self.callback(self.elapsed)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        Render every metric in the Prometheus text exposition format.
+        '''
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(metric.name, suffix, format_labels(labels), format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    ))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+# NextBus API
+REQUEST_SECONDS = REGISTRY.histogram(
+    'munificent_request_seconds', 'Time to receive NextBus API response headers', ['command'])
+RESPONSE_BYTES = REGISTRY.counter(
+    'munificent_response_bytes_total', 'Bytes of (decompressed) NextBus API responses read', ['command'])
+REQUESTS = REGISTRY.counter(
+    'munificent_requests_total', 'NextBus API requests by response status', ['command', 'status'])
+REQUEST_ERRORS = REGISTRY.counter(
+    'munificent_request_errors_total', 'NextBus API requests that failed without a response', ['command'])
+RESPONSES_UNCHANGED = REGISTRY.counter(
+    'munificent_responses_unchanged_total', 'NextBus API responses skipped as unchanged', ['command'])
+
+# Probes
+PROBE_REQUEST_SECONDS = REGISTRY.histogram(
+    'munificent_probe_request_seconds', 'Time for a probe to perform its request', ['probe'])
+PROBE_PARSE_SECONDS = REGISTRY.histogram(
+    'munificent_probe_parse_seconds', 'Time for a probe to parse a result (excludes lazily parsed records)',
+    ['probe'])
+PROBE_RECORDS = REGISTRY.counter(
+    'munificent_probe_records_total', 'Records collected from a probe', ['probe'])
+PROBE_ERRORS = REGISTRY.counter(
+    'munificent_probe_errors_total', 'Probe runs that raised an error', ['probe'])
+PROBE_DEADLINES_MISSED = REGISTRY.counter(
+    'munificent_probe_deadlines_missed_total', 'Probe runs dropped for missing their deadline', ['probe'])
+
+# Collector and scheduler
+CYCLE_SECONDS = REGISTRY.histogram(
+    'munificent_cycle_seconds', 'Time from the start of a collection cycle until its last probe tick is handled',
+    buckets=(1, 2.5, 5, 10, 15, 30, 60, 120, 300))
+CYCLES = REGISTRY.counter('munificent_cycles_total', 'Collection cycles completed')
+TICK_LAG = REGISTRY.histogram('munificent_tick_lag_seconds', 'Lateness of probe ticks')
+OVERRUNS = REGISTRY.counter('munificent_overruns_total', 'Times collection fell a whole slot behind')
+TICKS_SKIPPED = REGISTRY.counter('munificent_ticks_skipped_total', 'Probe ticks skipped or coalesced after overruns')
+
+# Emitters
+RECORDS_EMITTED = REGISTRY.counter('munificent_records_emitted_total', 'Records written by the emitter')
+BYTES_WRITTEN = REGISTRY.counter(
+    'munificent_bytes_written_total', 'Bytes of serialized records written by the emitter (before compression)')
+WRITE_SECONDS = REGISTRY.histogram('munificent_write_seconds', 'Time to serialize and write a batch of records')
+EMITTER_ERRORS = REGISTRY.counter('munificent_emitter_errors_total', 'Errors writing records')
+QUEUE_DEPTH = REGISTRY.gauge('munificent_emitter_queue_depth', 'Records waiting to be written by the emitter')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_metrics(port, host='127.0.0.1', registry=REGISTRY):
+    '''
+    Serve the registry's metrics at http://host:port/metrics from a background
+    thread, returning the server.
+    '''
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOG.debug(format, *args)
+
+    server = _ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class StatsFileWriter(object):
+    '''
+    Writes the registry's metrics to `path` every `interval` seconds from a
+    background thread.  Each write replaces the file atomically.
+    '''
+
+    def __init__(self, path, interval=15.0, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stats-writer')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+    def write(self):
+        directory, filename = os.path.split(self.path)
+        tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(filename, os.getpid()))
+        with open(tmp_path, 'w') as f:
+            f.write(self.registry.render())
+        os.rename(tmp_path, self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                LOG.exception(e)
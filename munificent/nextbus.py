@@ -1,38 +1,279 @@
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
 import datetime
+import hashlib
+import random
+import threading
 import uuid
 
 import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import bindparam
+from urllib3.util.retry import Retry
 
-from munificent import db
-Session = db.configured_session()
+from munificent import db, metrics, profiling
+from munificent.jsonstream import StreamingResult, stream_object
 
 
 DEFAULT_JSON_FEED_URL = 'http://webservices.nextbus.com/service/publicJSONFeed'
 
+# The member of each command's response that holds the bulk of its data
+STREAMING_ITEM_KEYS = {
+    'predictions': 'predictions',
+    'predictionsForMultiStops': 'predictions',
+    'vehicleLocations': 'vehicle',
+}
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class JitteredRetry(Retry):
+    '''
+    Retry policy with "full jitter": each backoff is drawn uniformly between zero and
+    the exponential backoff time, so that collectors that failed together don't all
+    retry together.
+    '''
+
+    def get_backoff_time(self):
+        return random.uniform(0, super(JitteredRetry, self).get_backoff_time())
+
+
+def build_session(pool_size=10, retries=2, backoff_factor=0.5, accept_encoding='gzip, deflate'):
+    '''
+    Create a `requests.Session` that keeps up to `pool_size` connections per host
+    alive for reuse, retries failed connections, reads and `RETRY_STATUSES` responses
+    up to `retries` times with jittered exponential backoff, and asks for compressed
+    responses with `accept_encoding`.
+    '''
+    retry = JitteredRetry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if accept_encoding:
+        session.headers['Accept-Encoding'] = accept_encoding
+    return session
+
+
+class BatchedRequest(object):
+    '''
+    A request split into several sub-requests (see
+    `NextBusAPIRequestBuilder.get_batched_multistop_predictions`), which the API
+    performs in parallel and merges into a single result.  `item_key` is the member
+    of each sub-request's result that is concatenated into the merged result.
+    '''
+
+    def __init__(self, requests, item_key):
+        self.requests = requests
+        self.item_key = item_key
+        self._last_results = [None] * len(requests)
+
+    @property
+    def method(self):
+        return self.requests[0].method
+
+    @property
+    def url(self):
+        return self.requests[0].url
+
+    @property
+    def params(self):
+        return self.requests[0].params
+
+    def __repr__(self):
+        return 'BatchedRequest({} x {})'.format(len(self.requests), self.params.get('command'))
 
-class NextBusAPI(object):
 
-    def __init__(self, json_feed_url=DEFAULT_JSON_FEED_URL):
+class NextBusAPI(object):
+    '''
+    Client for the NextBus JSON feed.  Requests go through `session` (by default one
+    from `build_session`), whose connection pool should be shared by everything
+    polling the API.  Requests made without an explicit `timeout` use the
+    `(connect, read)` timeout in `command_timeouts` for their command, or `timeout`.
+    '''
+
+    def __init__(self, json_feed_url=DEFAULT_JSON_FEED_URL, response_cache=None, batch_concurrency=4,
+                 session=None, timeout=(3.05, 10), command_timeouts=None):
         self.request_builder = NextBusAPIRequestBuilder(json_feed_url)
-        self.session = requests.Session()
+        self.session = session or build_session()
+        self.response_cache = response_cache
+        self.timeout = timeout
+        self.command_timeouts = command_timeouts or {}
+        self.batch_concurrency = batch_concurrency
+        self._batch_pool = None
+        self._batch_pool_lock = threading.Lock()
         self._build_proxy_methods()
 
-    def perform_request(self, request, **kwargs):
+    def perform_request(self, request, use_cache=True, **kwargs):
         '''
         Perform the provided request, returning a JSON result.  This is typically
         used in situations where prebuilt queries (e.g. from a request builder object)
         are being performed against the API generically.
+
+        With a response cache configured, returns None when the response is unchanged
+        since the last time the same request was performed.
         '''
-        request_id = str(uuid.uuid4())
-        res = self.session.send(request.prepare(), **kwargs)
-        res.raise_for_status()
-        result = res.json()
-        result['_meta'] = {
-            'timestamp': to_epoch_time(datetime.datetime.utcnow()),
-            'request_id': request_id,
-        }
+        kwargs.setdefault('timeout', self.timeout_for(request))
+        if isinstance(request, BatchedRequest):
+            return self._perform_batched(request, **kwargs)
+        cache = self.response_cache if use_cache else None
+        key, prepared = self._prepare(request, cache)
+        command = request.params.get('command')
+        with profiling.stage('request'):
+            res = self._send(prepared, command, **kwargs)
+            content = res.content
+        metrics.RESPONSE_BYTES.inc(len(content), command=command)
+        if cache and cache.is_unchanged(key, res, content):
+            metrics.RESPONSES_UNCHANGED.inc(command=command)
+            return None
+        with profiling.stage('decode'):
+            result = res.json()
+        if cache:
+            cache.update(key, result)
+        result['_meta'] = result_meta()
         return result
 
+    def stream_request(self, request, use_cache=True, **kwargs):
+        '''
+        Like `perform_request`, but decodes the response incrementally.  The result's
+        main list (e.g. 'predictions' or 'vehicle') is a generator that decodes one
+        element at a time from the response stream as it is consumed, so memory use is
+        bounded by the size of a single element rather than the whole response.
+        '''
+        kwargs.setdefault('timeout', self.timeout_for(request))
+        if isinstance(request, BatchedRequest):
+            return self._stream_batched(request, **kwargs)
+        cache = self.response_cache if use_cache else None
+        key, prepared = self._prepare(request, cache)
+        command = request.params.get('command')
+        with profiling.stage('request'):
+            res = self._send(prepared, command, stream=True, **kwargs)
+        if cache and cache.is_unchanged(key, res):
+            metrics.RESPONSES_UNCHANGED.inc(command=command)
+            res.close()
+            return None
+        item_key = STREAMING_ITEM_KEYS.get(command)
+        chunks = iter_response_chunks(res, command=command)
+        result = stream_object(chunks, item_key, encoding=res.encoding or 'utf-8')
+        if cache and item_key in result:
+            result[item_key] = run_after(result[item_key], lambda: cache.update(key, result))
+        elif cache:
+            cache.update(key, result)
+        result['_meta'] = result_meta()
+        return result
+
+    def forget(self, request):
+        '''
+        Forget what the response cache has recorded for `request` (each sub-request of
+        a batch), e.g. after its result failed to parse, so that the next response is
+        handled in full rather than skipped as unchanged.
+        '''
+        if self.response_cache is None:
+            return
+        for r in request.requests if isinstance(request, BatchedRequest) else [request]:
+            self.response_cache.forget(request_key(r))
+
+    def _prepare(self, request, cache):
+        '''
+        Prepare `request` with the session, so that it carries the session's headers
+        (e.g. `Accept-Encoding`), through `cache` if there is one.
+        '''
+        if cache is None:
+            return None, self.session.prepare_request(request)
+        return cache.prepare(request, self.session)
+
+    def _send(self, prepared, command, **kwargs):
+        try:
+            with metrics.REQUEST_SECONDS.time(command=command):
+                res = self.session.send(prepared, **kwargs)
+        except requests.RequestException:
+            metrics.REQUEST_ERRORS.inc(command=command)
+            raise
+        metrics.REQUESTS.inc(command=command, status=res.status_code)
+        res.raise_for_status()
+        return res
+
+    def timeout_for(self, request):
+        return self.command_timeouts.get(request.params.get('command'), self.timeout)
+
+    def _perform_batched(self, batch, **kwargs):
+        '''
+        Perform a batch's sub-requests in parallel and merge their results under one
+        `_meta`.  Sub-requests that are unchanged since the last time are filled in
+        from their previous result, so the merged result is always complete; it is
+        None only if every sub-request is unchanged.
+        '''
+        futures = [
+            self._submit_batched(self._perform_sub_request, batch, i, **kwargs)
+            for i in range(len(batch.requests))
+        ]
+        # Let every sub-request finish, so none is still running when a failure is raised
+        futures_wait(futures)
+        results = [future.result() for future in futures]
+        if not any(changed for changed, _ in results):
+            return None
+        results = [result for _, result in results]
+
+        merged = dict(results[0])
+        merged[batch.item_key] = [item for result in results for item in as_list(result.get(batch.item_key, []))]
+        merged['_meta'] = result_meta()
+        return merged
+
+    def _perform_sub_request(self, batch, i, **kwargs):
+        '''
+        Perform a batch's `i`th sub-request, returning whether it changed and its
+        result, which is recorded as soon as it arrives so that a sibling failing
+        doesn't lose it.  An unchanged sub-request with no recorded result (e.g. one
+        whose response was cached but never decoded) is fetched again in full.
+        '''
+        request = batch.requests[i]
+        result = self.perform_request(request, **kwargs)
+        changed = result is not None
+        if not changed:
+            result = batch._last_results[i]
+        if result is None:
+            result = self.perform_request(request, use_cache=False, **kwargs)
+            changed = True
+        batch._last_results[i] = result
+        return changed, result
+
+    def _stream_batched(self, batch, **kwargs):
+        '''
+        Send a batch's sub-requests in parallel and stream their items one response
+        after another.  Streamed responses can't be replayed, so sub-requests bypass
+        the response cache and are always fetched in full.
+        '''
+        futures = [
+            self._submit_batched(self.stream_request, r, use_cache=False, **kwargs)
+            for r in batch.requests
+        ]
+        merged = StreamingResult()
+        merged[batch.item_key] = self._chain_streamed(futures, batch.item_key, merged)
+        merged['_meta'] = result_meta()
+        return merged
+
+    @staticmethod
+    def _chain_streamed(futures, item_key, merged):
+        for future in futures:
+            result = future.result()
+            for item in result.get(item_key, []):
+                yield item
+            for key, value in result.items():
+                if key not in (item_key, '_meta'):
+                    merged.setdefault(key, value)
+
+    def _submit_batched(self, fn, *args, **kwargs):
+        with self._batch_pool_lock:
+            if self._batch_pool is None:
+                self._batch_pool = ThreadPoolExecutor(max_workers=self.batch_concurrency)
+        return self._batch_pool.submit(fn, *args, **kwargs)
+
     def _build_proxy_methods(self):
         '''
         Creates wrapped methods corresponding to all request builder methods that
@@ -62,6 +303,110 @@ class NextBusAPI(object):
             setattr(self, attr, build_proxy_method(attr, value))
 
 
+class ResponseCache(object):
+    '''
+    Remembers what the API has returned for each request, so that data that hasn't
+    changed since the last poll can be skipped before it is parsed and emitted:
+
+    * with `skip_unchanged`, `ETag` and `Last-Modified` validators are sent back as
+      `If-None-Match` and `If-Modified-Since`, and a 304 response counts as unchanged
+    * with `skip_unchanged`, response bodies are hashed, and a body identical to the
+      previous one for the same request counts as a duplicate
+    * with `incremental_locations`, vehicle location requests pass the previous
+      response's `lastTime` as `t`, so that only vehicles which have reported since
+      are returned
+
+    Body hashing needs the whole body, so it doesn't apply to streamed requests.
+    A response's validators and digest are only kept once it has been decoded (see
+    `update`), and a request whose result then fails to parse should be forgotten
+    (see `forget`), so that the same response isn't skipped the next time.
+    '''
+
+    def __init__(self, skip_unchanged=True, incremental_locations=False):
+        self.skip_unchanged = skip_unchanged
+        self.incremental_locations = incremental_locations
+        self.not_modified = 0
+        self.duplicates_skipped = 0
+        self._validators = {}
+        self._digests = {}
+        self._last_times = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def prepare(self, request, session):
+        '''
+        Return a key identifying `request` and a copy of it prepared by `session`, with
+        conditional headers and incremental parameters added.
+        '''
+        key = request_key(request)
+        params = dict(request.params)
+        if self.incremental_locations and params.get('command') == 'vehicleLocations':
+            params['t'] = self._last_times.get(key, 0)
+        headers = dict(request.headers or {})
+        headers.update(self._validators.get(key, {}))
+        prepared = session.prepare_request(
+            requests.Request(request.method, request.url, params=params, headers=headers))
+        return key, prepared
+
+    def is_unchanged(self, key, res, body=None):
+        if not self.skip_unchanged:
+            return False
+        if res.status_code == 304:
+            with self._lock:
+                self.not_modified += 1
+            return True
+
+        validators = {
+            header: res.headers[validator]
+            for validator, header in [('ETag', 'If-None-Match'), ('Last-Modified', 'If-Modified-Since')]
+            if validator in res.headers
+        }
+        digest = None
+        if body is not None:
+            digest = hashlib.sha1(body).digest()
+            if self._digests.get(key) == digest:
+                with self._lock:
+                    self.duplicates_skipped += 1
+                return True
+        # Kept aside until the response has been decoded
+        self._pending[key] = (validators, digest)
+        return False
+
+    def update(self, key, result):
+        '''
+        Record the decoded `result` of the request identified by `key`, keeping the
+        validators and digest of the response it came from.
+        '''
+        if key in self._pending:
+            self._validators[key], digest = self._pending.pop(key)
+            if digest is not None:
+                self._digests[key] = digest
+        last_time = result.get('lastTime')
+        if isinstance(last_time, dict) and 'time' in last_time:
+            self._last_times[key] = last_time['time']
+
+    def forget(self, key):
+        '''
+        Forget everything recorded for the request identified by `key`, so that its
+        next response is fetched and handled in full.
+        '''
+        for recorded in (self._validators, self._digests, self._last_times, self._pending):
+            recorded.pop(key, None)
+
+
+def request_key(request):
+    '''
+    Identify a request by its method, URL and parameters, ignoring the incremental
+    vehicle location time.
+    '''
+    params = sorted(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in request.params.items()
+        if name != 't'
+    )
+    return (request.method, request.url, tuple(params))
+
+
 class NextBusAPIRequestBuilder(object):
 
     def __init__(self, json_feed_url=DEFAULT_JSON_FEED_URL):
@@ -108,6 +453,18 @@ class NextBusAPIRequestBuilder(object):
             'stops': stops,
             })
 
+    def get_batched_multistop_predictions(self, agency, stops, batch_size=None):
+        '''
+        Like `get_multistop_predictions`, but split into sub-requests for at most
+        `batch_size` stops each, which the API performs in parallel and merges.
+        '''
+        if not batch_size or len(stops) <= batch_size:
+            return self.get_multistop_predictions(agency, stops)
+        return BatchedRequest([
+            self.get_multistop_predictions(agency, stops[i:i + batch_size])
+            for i in range(0, len(stops), batch_size)
+        ], item_key='predictions')
+
     def get_messages(self, agency, routes=[]):
         return requests.Request('GET', self.feed_url, params={
             'command': 'messages',
@@ -124,9 +481,9 @@ class NextBusAPIRequestBuilder(object):
             })
 
     # Higher-level requests
-    def get_predictions_for_route(self, route):
+    def get_predictions_for_route(self, route, batch_size=None):
         stop_codes = [r.route_stop_code for r in route.stops]
-        return self.get_multistop_predictions(route.agency.tag, stop_codes)
+        return self.get_batched_multistop_predictions(route.agency.tag, stop_codes, batch_size)
 
     def get_predictions_for_stop(self, stop):
         stop_codes = [r.route_stop_code for r in stop.routes]
@@ -136,58 +493,144 @@ class NextBusAPIRequestBuilder(object):
         return self.get_vehicle_locations(route.agency.tag, route.tag)
 
 
+def run_after(items, callback):
+    '''
+    Yield from `items`, then call `callback` once they are exhausted.
+    '''
+    for item in items:
+        yield item
+    callback()
+
+
+def iter_response_chunks(res, chunk_size=STREAMING_CHUNK_SIZE, command=None):
+    size = 0
+    try:
+        for chunk in res.iter_content(chunk_size):
+            size += len(chunk)
+            yield chunk
+    finally:
+        res.close()
+        metrics.RESPONSE_BYTES.inc(size, command=command)
+
+
+def result_meta():
+    '''
+    A new `_meta` for a result: when it was received and a unique request ID.
+    '''
+    return {
+        'timestamp': to_epoch_time(datetime.datetime.utcnow()),
+        'request_id': str(uuid.uuid4()),
+    }
+
+
 def to_epoch_time(dt):
     EPOCH_START = datetime.datetime(1970, 1, 1)
     return int((dt - EPOCH_START).total_seconds())
 
 
-def populate_db():
-    api = NextBusAPI()
-    for agency in api.list_agencies()['agency']:
-        Session.add(db.Agency(**agency))
-    Session.commit()
-
-    agencies = (Session.query(db.Agency)
-        .filter(db.Agency.tag.in_(['sf-muni'])))
-
-    for agency in agencies:
-        route_config_result = api.get_route_config(agency.tag)
-        routes = route_config_result['route']
-        for route in routes:
-            route_obj = db.Route(
-                agency_id=agency.id,
-                tag=route['tag'],
-                title=route['title'],
-            )
-            Session.add(route_obj)
-
-            for stop in route['stop']:
-                stop_obj = (Session.query(db.Stop)
-                    .filter(db.Stop.stopID == int(stop['stopId']))
-                    .one_or_none())
-
-                if not stop_obj:
-                    stop_obj = db.Stop(
-                        agency=agency,
-                        lat=float(stop['lat']),
-                        lon=float(stop['lon']),
-                        stopID=stop['stopId'],
-                        tag=stop['tag'],
-                        title=stop['title'],
-                    )
-                    Session.add(stop_obj)
-
-                route_stop_obj = (Session.query(db.RouteStop)
-                    .filter(db.RouteStop.route_id == route_obj.id)
-                    .filter(db.RouteStop.stop_id == stop_obj.id)
-                    .one_or_none())
-
-                if not route_stop_obj:
-                    route_stop_obj = db.RouteStop(
-                        agency_id=agency.id,
-                        route_id=route_obj.id,
-                        stop_id=stop_obj.id,
-                    )
-                    Session.add(route_stop_obj)
-
-    Session.commit()
+DEFAULT_AGENCY_TAGS = ['sf-muni']
+
+
+def populate_db(agency_tags=DEFAULT_AGENCY_TAGS, api=None, session=None, concurrency=4):
+    '''
+    Load every agency, and the routes and stops of the agencies in `agency_tags`, from
+    the API into the database.  Route configs are fetched for the agencies in
+    parallel, stops shared between routes are deduplicated in memory, and all rows are
+    inserted or updated with bulk statements in a single transaction, so the load can
+    be re-run to refresh existing reference data.
+    '''
+    api = api or NextBusAPI()
+    session = session or db.get_session()
+
+    agencies = as_list(api.list_agencies()['agency'])
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        route_configs = list(pool.map(api.get_route_config, agency_tags))
+    finally:
+        pool.shutdown()
+
+    try:
+        agency_ids = sync_rows(session, db.Agency.__table__, ['tag'], [
+            {c: agency.get(c) for c in ['tag', 'title', 'shortTitle', 'regionTitle']}
+            for agency in agencies
+        ])
+        for agency_tag, route_config in zip(agency_tags, route_configs):
+            load_route_config(session, agency_ids[(agency_tag,)], as_list(route_config['route']))
+        db.bump_reference_version(session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def load_route_config(session, agency_id, routes):
+    route_ids = sync_rows(session, db.Route.__table__, ['agency_id', 'tag'], [
+        {'agency_id': agency_id, 'tag': route['tag'], 'title': route['title']}
+        for route in routes
+    ])
+
+    stops = {}
+    for route in routes:
+        for stop in as_list(route.get('stop', [])):
+            stops[stop['tag']] = {
+                'agency_id': agency_id,
+                'tag': stop['tag'],
+                'title': stop.get('title'),
+                'lat': float(stop['lat']),
+                'lon': float(stop['lon']),
+                'stopID': int(stop['stopId']) if 'stopId' in stop else None,
+            }
+    stop_ids = sync_rows(session, db.Stop.__table__, ['agency_id', 'tag'], list(stops.values()))
+
+    route_stops = db.RouteStop.__table__
+    existing = set(session.query(route_stops.c.route_id, route_stops.c.stop_id)
+        .filter(route_stops.c.agency_id == agency_id))
+    new_route_stops = {}
+    for route in routes:
+        route_id = route_ids[(agency_id, route['tag'])]
+        for stop in as_list(route.get('stop', [])):
+            stop_id = stop_ids[(agency_id, stop['tag'])]
+            if (route_id, stop_id) not in existing:
+                new_route_stops[(route_id, stop_id)] = {
+                    'agency_id': agency_id,
+                    'route_id': route_id,
+                    'stop_id': stop_id,
+                }
+    if new_route_stops:
+        session.execute(route_stops.insert(), list(new_route_stops.values()))
+
+
+def sync_rows(session, table, key_columns, rows):
+    '''
+    Bring `table` in line with `rows`, identifying rows by `key_columns`: missing rows
+    are inserted and rows whose values differ are updated, each with a single bulk
+    statement.  Returns a mapping from each row's key tuple to its id.
+    '''
+    def existing_rows():
+        return {tuple(row[c] for c in key_columns): row for row in session.execute(table.select()).mappings()}
+
+    def row_key(row):
+        return tuple(row[c] for c in key_columns)
+
+    existing = existing_rows()
+    new, changed = [], []
+    for row in rows:
+        current = existing.get(row_key(row))
+        if current is None:
+            new.append(row)
+        elif any(current[c] != value for c, value in row.items()):
+            changed.append(dict(row, _id=current['id']))
+
+    if new:
+        session.execute(table.insert(), new)
+        existing = existing_rows()
+    if changed:
+        session.execute(table.update().where(table.c.id == bindparam('_id')), changed)
+    return {row_key(row): existing[row_key(row)]['id'] for row in rows}
+
+
+def as_list(value):
+    '''
+    NextBus returns a bare object instead of a list when there is only one element.
+    '''
+    return value if isinstance(value, list) else [value]
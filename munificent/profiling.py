@@ -0,0 +1,212 @@
+'''
+Opt-in profiling of the collection hot path.  While a `CollectionProfiler` is
+armed, each probe run is profiled with cProfile, and the stages of collection
+(request, decode, parse, serialize, write) are timed, both grouped by probe.  After
+the configured number of cycles it writes a report and goes back to sleep, so a
+profile can be captured from a live collector (e.g. on SIGUSR1) without stopping
+it.
+
+The `stage` hooks in the hot path cost one global lookup when no profiler is
+armed.
+'''
+import cProfile
+import collections
+import io
+import logging
+import pstats
+import re
+import threading
+import time
+
+from munificent.metrics import Timer
+
+LOG = logging.getLogger(__name__)
+
+# Probe name used for work done outside of any probe, such as emitting records
+EMITTER = '(emitter)'
+
+_armed = None
+_local = threading.local()
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def stage(name):
+    '''
+    Context manager timing a stage of collection for the armed profiler, if any.
+    '''
+    profiler = _armed
+    if profiler is None:
+        return _NULL_TIMER
+    return profiler.stage(name)
+
+
+StageStats = collections.namedtuple('StageStats', ['calls', 'seconds'])
+
+
+class CollectionProfiler(object):
+    '''
+    Profiles `cycles` collection cycles each time it is started, then writes a
+    report to `output_path`, a template rendered like rotating output file names
+    (see `munificent.io.RotatingFile`).  The report is a text summary of stage
+    timings and the most expensive functions per probe, at '<output>.txt', and a
+    pstats dump per probe at '<output>.<probe>.pstats' for `python -m pstats`.
+
+    Only probe runs are profiled with cProfile.  Records written by a background
+    writer thread (`BufferedEmitter`) appear in the stage timings only.
+    '''
+
+    def __init__(self, output_path, cycles=3, top_functions=25, clock=time.time):
+        self.output_path = output_path
+        self.cycles = cycles
+        self.top_functions = top_functions
+        self.clock = clock
+        self.reports = []
+        self._start_requested = False
+        self._lock = threading.Lock()
+        self._reset()
+
+    @property
+    def active(self):
+        return _armed is self
+
+    def start(self):
+        '''
+        Ask for profiling to start with the next probe run.  Safe to call from a
+        signal handler.
+        '''
+        self._start_requested = True
+
+    def probe(self, name):
+        '''
+        Context manager profiling a probe run, or a no-op while not profiling.
+        '''
+        if self._start_requested:
+            self._arm()
+        if not self.active:
+            return _NULL_TIMER
+        return _ProbeRun(self, name)
+
+    def collect(self, probe, **request_args):
+        '''
+        Run `probe.collect`, profiling it and collecting its records eagerly while
+        profiling is armed.
+        '''
+        run = self.probe(probe.name)
+        if run is _NULL_TIMER:
+            return probe.collect(**request_args)
+        with run:
+            return list(probe.collect(**request_args))
+
+    def stage(self, name):
+        probe = getattr(_local, 'probe', EMITTER)
+
+        def record(elapsed):
+            with self._lock:
+                calls, seconds = self._stages.get((probe, name), (0, 0.0))
+                self._stages[(probe, name)] = StageStats(calls + 1, seconds + elapsed)
+        return Timer(record)
+
+    def end_cycle(self):
+        '''
+        Called by the collector at the end of each cycle; writes the report once
+        enough cycles have been profiled.
+        '''
+        if not self.active:
+            return
+        self._cycles_profiled += 1
+        if self._cycles_profiled >= self.cycles:
+            self._disarm()
+            try:
+                self.reports.append(self.write_report())
+            except Exception as e:
+                LOG.exception(e)
+            self._reset()
+
+    def write_report(self):
+        from munificent.io import render_path_template, unique_path  # munificent.io uses this module
+        path = unique_path(render_path_template(self.output_path + '.txt', self._started_at))
+        base = path[:-len('.txt')]
+        with open(path, 'w') as f:
+            f.write(self.render_summary())
+        for name, profile in self._profiles.items():
+            profile.dump_stats('{}.{}.pstats'.format(base, re.sub(r'[^\w.-]+', '_', name)))
+        LOG.info("Wrote profile of {} cycles to {}".format(self._cycles_profiled, path))
+        return path
+
+    def render_summary(self):
+        lines = [
+            "Profile of {} collection cycles over {:.1f}s".format(
+                self._cycles_profiled, self.clock() - self._started_at),
+            "",
+            "{:<40} {:<10} {:>8} {:>10} {:>10}".format('probe', 'stage', 'calls', 'total (s)', 'mean (ms)'),
+        ]
+        for (probe, name), stats in sorted(self._stages.items()):
+            lines.append("{:<40} {:<10} {:>8} {:>10.3f} {:>10.3f}".format(
+                probe, name, stats.calls, stats.seconds, stats.seconds * 1e3 / stats.calls,
+            ))
+        for name, profile in sorted(self._profiles.items()):
+            stream = io.StringIO() if str is not bytes else io.BytesIO()
+            lines.extend(["", "=" * 80, name, "=" * 80])
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(self.top_functions)
+            lines.append(stream.getvalue())
+        return '\n'.join(lines)
+
+    def _arm(self):
+        global _armed
+        with self._lock:
+            if self._start_requested and _armed is None:
+                self._reset()
+                self._started_at = self.clock()
+                _armed = self
+            self._start_requested = False
+
+    def _disarm(self):
+        global _armed
+        with self._lock:
+            if _armed is self:
+                _armed = None
+
+    def _reset(self):
+        self._profiles = {}
+        self._stages = {}
+        self._cycles_profiled = 0
+        self._started_at = None
+
+
+class _ProbeRun(object):
+    '''
+    Profiles the current thread while a probe runs, attributing stage timings to
+    the probe.
+    '''
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.profile = None
+
+    def __enter__(self):
+        _local.probe = self.name
+        with self.profiler._lock:
+            profile = self.profiler._profiles.setdefault(self.name, cProfile.Profile())
+        try:
+            profile.enable()
+            self.profile = profile
+        except ValueError:  # Another profiler is already active
+            pass
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.disable()
+        _local.probe = EMITTER
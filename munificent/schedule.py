@@ -0,0 +1,101 @@
+import collections
+import time
+
+from munificent import metrics
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+Tick = collections.namedtuple('Tick', ['cycle', 'slot', 'scheduled', 'lag'])
+
+
+class PhasedScheduler(object):
+    '''
+    Generates `slots` evenly spaced ticks per period against a monotonic clock.  Slot
+    `i` always fires at offset `i * period / slots` into its cycle, so each probe keeps
+    a fixed phase and a constant sampling interval no matter how long the others take.
+
+    When the consumer falls a whole slot behind, the overrun policy decides what
+    happens to the overdue ticks: 'skip' fires the overdue tick late and drops the
+    ticks after it whose slots have gone by entirely, resuming at the current tick on
+    the grid; 'coalesce' fires the overdue tick once in place of all the cycles it
+    missed.  Either way the grid itself never moves, so lateness never accumulates,
+    and a slot that follows a slow one is never skipped for it.
+
+    `stop` ends the ticks early, within `MAX_SLEEP` seconds; it is safe to call from a
+    signal handler.
+    '''
+    SKIP = 'skip'
+    COALESCE = 'coalesce'
+    OVERRUN_POLICIES = [SKIP, COALESCE]
+    MAX_SLEEP = 1.0
+
+    def __init__(self, period, overrun=SKIP, clock=monotonic, sleep=time.sleep):
+        if overrun not in self.OVERRUN_POLICIES:
+            raise ValueError("Unrecognized overrun policy: {}".format(overrun))
+        if not period > 0:
+            raise ValueError("Period must be positive: {}".format(period))
+        self.period = period
+        self.overrun = overrun
+        self.clock = clock
+        self.sleep = sleep
+        self.stopped = False
+
+        self.ticks_fired = 0
+        self.ticks_skipped = 0
+        self.overruns = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def ticks(self, slots, cycles=None):
+        '''
+        Yield a `Tick` as each slot comes due, stopping after `cycles` cycles if given.
+        '''
+        interval = self.period / float(slots)
+        origin = self.clock()
+        end = None if cycles is None else cycles * slots
+        index = 0
+        while end is None or index < end:
+            scheduled = origin + index * interval
+            lag = self._sleep_until(scheduled) - scheduled
+            if self.stopped:
+                return
+            skipped = 0
+            if lag >= interval:
+                self.overruns += 1
+                missed = self._missed_ticks(lag, slots, interval)
+                self.ticks_skipped += missed
+                metrics.OVERRUNS.inc()
+                metrics.TICKS_SKIPPED.inc(missed)
+                if self.overrun == self.SKIP:
+                    # The missed ticks are the ones after this one
+                    skipped = missed
+                else:
+                    index += missed
+                    scheduled += missed * interval
+                    lag -= missed * interval
+
+            self.ticks_fired += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            metrics.TICK_LAG.observe(lag)
+            yield Tick(index // slots, index % slots, scheduled, lag)
+            index += 1 + skipped
+
+    def stop(self):
+        self.stopped = True
+
+    def _sleep_until(self, scheduled):
+        now = self.clock()
+        while now < scheduled and not self.stopped:
+            self.sleep(min(scheduled - now, self.MAX_SLEEP))
+            now = self.clock()
+        return now
+
+    def _missed_ticks(self, lag, slots, interval):
+        if self.overrun == self.SKIP:
+            # Ticks after the overdue one that were due a whole interval ago
+            return int(lag // interval) - 1
+        return int(lag // self.period) * slots
+
+    def __repr__(self):
+        return 'PhasedScheduler(period={}, overrun={})'.format(self.period, self.overrun)
@@ -0,0 +1,201 @@
+'''
+In-memory, case-insensitive search over route and stop tags, titles and stop IDs.
+
+Whole-field and per-word prefixes are looked up with a binary search over sorted
+terms, and anything else is matched by trigram similarity, which tolerates typos.
+Building the index from the reference database takes one query per entity, and
+lookups don't touch the database, so they stay fast however many agencies are
+loaded.
+'''
+import bisect
+import collections
+import re
+import threading
+
+from munificent import db
+
+SearchEntry = collections.namedtuple('SearchEntry', ['kind', 'agency', 'tag', 'title', 'code'])
+SearchResult = collections.namedtuple('SearchResult', ['score', 'entry'])
+
+# Scores by how an entry matched
+EXACT = 4.0
+PREFIX = 3.0
+WORD_PREFIX = 2.0
+# Trigram matches score the fraction of the query's trigrams they contain times this
+SIMILAR = 1.0
+MIN_SIMILARITY = 0.5
+
+NON_WORD = re.compile(r'[\W_]+', re.UNICODE)
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def normalize(text):
+    return NON_WORD.sub(' ', text.lower()).strip()
+
+
+def trigrams(text):
+    '''
+    The trigrams of each word in `text`, padded so that word starts count for more.
+    '''
+    grams = set()
+    for word in normalize(text).split():
+        padded = '  {} '.format(word)
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class SearchIndex(object):
+    '''
+    Search index over `SearchEntry`s.  An entry's searchable fields are its tag, its
+    title and its code (a stop's stopID).  The trigram index is only built once a
+    search needs it.
+    '''
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self._fields = collections.defaultdict(list)
+        self._words = collections.defaultdict(list)
+        for entry_id, entry in enumerate(self.entries):
+            values = set(normalize(value) for value in (entry.tag, entry.title, entry.code) if value)
+            for value in values:
+                self._fields[value].append(entry_id)
+            for word in set(word for value in values for word in value.split()):
+                self._words[word].append(entry_id)
+        self._field_terms = sorted(self._fields)
+        self._word_terms = sorted(self._words)
+        self._trigrams = None
+        self._kind_indexes = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_db(cls, session=None):
+        '''
+        Build an index of every route and stop in the reference database.
+        '''
+        session = session or db.get_session()
+        routes = (session.query(db.Agency.tag, db.Route.tag, db.Route.title)
+            .join(db.Agency, db.Route.agency_id == db.Agency.id))
+        stops = (session.query(db.Agency.tag, db.Stop.tag, db.Stop.title, db.Stop.stopID)
+            .join(db.Agency, db.Stop.agency_id == db.Agency.id))
+        entries = [SearchEntry('route', agency, tag, title, None) for agency, tag, title in routes]
+        entries.extend(
+            SearchEntry('stop', agency, tag, title, None if stop_id is None else str(stop_id))
+            for agency, tag, title, stop_id in stops
+        )
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, query, kinds=None, agency=None, limit=10):
+        '''
+        Return up to `limit` `SearchResult`s for `query`, best first, optionally only
+        for entries of the given `kinds` ('route', 'stop') or `agency`.  Entries that
+        match a field exactly come first, then those with a field starting with the
+        query, then those with words starting with each word of the query, and
+        finally those sharing most of the query's trigrams.
+        '''
+        if kinds is not None:
+            return self._kind_index(kinds).search(query, agency=agency, limit=limit)
+        results, seen = [], set()
+        for score, entry_id in self._ranked_matches(normalize(query)):
+            entry = self.entries[entry_id]
+            if entry_id in seen or (agency is not None and entry.agency != agency):
+                continue
+            seen.add(entry_id)
+            results.append(SearchResult(score, entry))
+            if len(results) >= limit:
+                break
+        return results
+
+    def _ranked_matches(self, query):
+        '''
+        Yield (score, entry id) for entries matching `query`, best first.  Matches are
+        generated lazily, so lower tiers are only searched if they are needed.
+        '''
+        if not query:
+            return
+        for entry_id in self._fields.get(query, ()):
+            yield EXACT, entry_id
+        for term in sorted(_prefixed(self._field_terms, query), key=len):
+            if term != query:
+                for entry_id in self._fields[term]:
+                    yield PREFIX, entry_id
+        for entry_id in sorted(self._word_prefix_matches(query.split()), key=self._title_length):
+            yield WORD_PREFIX, entry_id
+        similar = sorted(self._similar(query), key=lambda match: (-match[1], self._title_length(match[0])))
+        for entry_id, similarity in similar:
+            yield SIMILAR * similarity, entry_id
+
+    def _word_prefix_matches(self, query_words):
+        '''
+        Entries with a word starting with each of the query's words.
+        '''
+        matches = None
+        for word in query_words:
+            entry_ids = set()
+            for term in _prefixed(self._word_terms, word):
+                entry_ids.update(self._words[term])
+            matches = entry_ids if matches is None else matches & entry_ids
+            if not matches:
+                return set()
+        return matches
+
+    def _similar(self, query):
+        grams = trigrams(query)
+        index = self._trigram_index()
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(index.get(gram, ()))
+        for entry_id, count in shared.items():
+            similarity = float(count) / len(grams)
+            if similarity >= MIN_SIMILARITY:
+                yield entry_id, similarity
+
+    def _trigram_index(self):
+        with self._lock:
+            if self._trigrams is None:
+                index = collections.defaultdict(list)
+                for term, entry_ids in self._words.items():
+                    for gram in trigrams(term):
+                        index[gram].append(entry_ids)
+                self._trigrams = {
+                    gram: sorted(set(entry_id for ids in postings for entry_id in ids))
+                    for gram, postings in index.items()
+                }
+            return self._trigrams
+
+    def _kind_index(self, kinds):
+        key = tuple(sorted(kinds))
+        with self._lock:
+            if key not in self._kind_indexes:
+                self._kind_indexes[key] = SearchIndex(entry for entry in self.entries if entry.kind in kinds)
+            return self._kind_indexes[key]
+
+    def _title_length(self, entry_id):
+        return len(self.entries[entry_id].title or '')
+
+
+def _prefixed(terms, prefix):
+    '''
+    Yield the terms in sorted `terms` that start with `prefix`.
+    '''
+    for i in range(bisect.bisect_left(terms, prefix), len(terms)):
+        if not terms[i].startswith(prefix):
+            return
+        yield terms[i]
+
+
+def get_search_index(session=None):
+    '''
+    Return the search index for the reference database, built on first use and
+    rebuilt when the reference data version changes (see `db.reference_version`).
+    '''
+    version = db.reference_version(session)
+    with _cache_lock:
+        if 'index' not in _cache or _cache['version'] != version:
+            _cache['index'] = SearchIndex.from_db(session)
+            _cache['version'] = version
+        return _cache['index']
@@ -0,0 +1,262 @@
+'''
+In-memory spatial index over stops, for nearest-stop, radius and bounding box
+queries, and for snapping vehicle locations to the nearest stop on their route.
+
+Coordinates are projected onto a plane (equirectangular, centered on the indexed
+stops), which is accurate to within a fraction of a percent over a city, and stops
+are bucketed into a grid of square cells.  Queries only visit the cells that can
+hold an answer, so they take microseconds rather than a scan over every stop.
+'''
+import collections
+import heapq
+import math
+
+from munificent import db
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+IndexedStop = collections.namedtuple('IndexedStop', ['tag', 'title', 'lat', 'lon', 'routes'])
+
+
+class StopIndex(object):
+    '''
+    Grid index over `stops`, a sequence of `IndexedStop`s, with `cell_size` meter
+    cells, by default sized to hold about one stop each.  Distances are in meters.
+    Snapping a record builds an index of the stops of its route on first use, so
+    later snaps to that route only look at its stops.
+    '''
+
+    def __init__(self, stops, cell_size=None, reference_lat=None):
+        self.stops = list(stops)
+        if reference_lat is None:
+            lats = [stop.lat for stop in self.stops]
+            reference_lat = (min(lats) + max(lats)) / 2 if lats else 0.0
+        self.reference_lat = reference_lat
+        self._x_scale = METERS_PER_DEGREE * math.cos(math.radians(reference_lat))
+        self._route_indexes = {}
+
+        points = [self._project(stop.lat, stop.lon) + (stop,) for stop in self.stops]
+        self.cell_size = float(cell_size or default_cell_size(points))
+        self._cells = collections.defaultdict(list)
+        for x, y, stop in points:
+            self._cells[self._cell(x, y)].append((x, y, stop))
+        cells = list(self._cells) or [(0, 0)]
+        self._min_cell = (min(c[0] for c in cells), min(c[1] for c in cells))
+        self._max_cell = (max(c[0] for c in cells), max(c[1] for c in cells))
+
+    @classmethod
+    def from_db(cls, session=None, agency=None, cell_size=None):
+        '''
+        Build an index of the stops in the reference database, optionally of one
+        `agency`, in a single query.
+        '''
+        session = session or db.get_session()
+        rows = (session.query(db.Stop.id, db.Stop.tag, db.Stop.title, db.Stop.lat, db.Stop.lon, db.Route.tag)
+            .select_from(db.Stop)
+            .outerjoin(db.RouteStop, db.RouteStop.stop_id == db.Stop.id)
+            .outerjoin(db.Route, db.RouteStop.route_id == db.Route.id))
+        if agency is not None:
+            rows = rows.join(db.Agency, db.Stop.agency_id == db.Agency.id).filter(db.Agency.tag == agency)
+
+        stops = collections.OrderedDict()
+        for stop_id, tag, title, lat, lon, route_tag in rows.order_by(db.Stop.id):
+            if lat is None or lon is None:
+                continue
+            tag, title, lat, lon, routes = stops.get(stop_id) or (tag, title, lat, lon, [])
+            if route_tag is not None:
+                routes.append(route_tag)
+            stops[stop_id] = (tag, title, lat, lon, routes)
+        return cls(
+            [IndexedStop(tag, title, lat, lon, tuple(routes)) for tag, title, lat, lon, routes in stops.values()],
+            cell_size=cell_size,
+        )
+
+    def __len__(self):
+        return len(self.stops)
+
+    def nearest(self, lat, lon, n=1, max_distance=None):
+        '''
+        Return up to `n` (distance, stop) pairs for the stops nearest to a point,
+        closest first, optionally only those within `max_distance`.
+        '''
+        qx, qy = self._project(lat, lon)
+        cx, cy = self._cell(qx, qy)
+        best = []
+        for ring in range(self._first_ring(cx, cy), self._last_ring(cx, cy) + 1):
+            # Stops outside the rings searched so far are at least this far away
+            bound = (ring - 1) * self.cell_size if ring else 0.0
+            if len(best) >= n and best[n - 1][0] <= bound:
+                break
+            if max_distance is not None and bound > max_distance:
+                break
+            if 8 * ring > len(self._cells):
+                # Far outside the grid, a ring has more cells than the grid has non-empty
+                # ones, so measuring the distance to every stop is cheaper
+                best = self._scan(qx, qy, n)
+                break
+            for entries in self._ring(cx, cy, ring):
+                for x, y, stop in entries:
+                    best.append((math.hypot(x - qx, y - qy), stop))
+            best.sort(key=_distance)
+            del best[n:]
+        if max_distance is not None:
+            best = [(distance, stop) for distance, stop in best if distance <= max_distance]
+        return best
+
+    def within_radius(self, lat, lon, radius):
+        '''
+        Return (distance, stop) pairs for every stop within `radius` of a point,
+        closest first.
+        '''
+        qx, qy = self._project(lat, lon)
+        x0, y0 = self._cell(qx - radius, qy - radius)
+        x1, y1 = self._cell(qx + radius, qy + radius)
+        found = []
+        for entries in self._cells_between(x0, y0, x1, y1):
+            for x, y, stop in entries:
+                distance = math.hypot(x - qx, y - qy)
+                if distance <= radius:
+                    found.append((distance, stop))
+        found.sort(key=_distance)
+        return found
+
+    def within_bbox(self, south, west, north, east):
+        '''
+        Return the stops inside a bounding box, given by its edges in degrees.
+        '''
+        x0, y0 = self._cell(*self._project(south, west))
+        x1, y1 = self._cell(*self._project(north, east))
+        return [
+            stop
+            for entries in self._cells_between(x0, y0, x1, y1)
+            for _, _, stop in entries
+            if south <= stop.lat <= north and west <= stop.lon <= east
+        ]
+
+    def for_route(self, route):
+        '''
+        Return an index of the stops served by `route`, or None if no stop is.
+        '''
+        index = self._route_indexes.get(route)
+        if index is None and route not in self._route_indexes:
+            stops = [stop for stop in self.stops if route in stop.routes]
+            index = StopIndex(stops, reference_lat=self.reference_lat) if stops else None
+            self._route_indexes[route] = index
+        return index
+
+    def snap(self, record, max_distance=None):
+        '''
+        Add the tag of and distance to the nearest stop on its route to a vehicle
+        location record, as `nearestStopTag` and `nearestStopDistance`.  Both are
+        None if the route has no stops within `max_distance`.
+        '''
+        index = self.for_route(record.get('routeTag'))
+        nearest = index.nearest(record['lat'], record['lon'], 1, max_distance) if index is not None else None
+        if nearest:
+            distance, stop = nearest[0]
+            record['nearestStopTag'] = stop.tag
+            record['nearestStopDistance'] = round(distance, 1)
+        else:
+            record['nearestStopTag'] = record['nearestStopDistance'] = None
+        return record
+
+    def snapping(self, parser, max_distance=None):
+        '''
+        Wrap a vehicle location parser so that it snaps each record it returns.  List
+        parsers (`parse_vehicle_locations`) still return lists, and generator parsers
+        (`iter_vehicle_locations`) snap records as they are consumed.
+        '''
+        def parse_and_snap(result):
+            records = parser(result)
+            if isinstance(records, list):
+                return [self.snap(record, max_distance) for record in records]
+            return (self.snap(record, max_distance) for record in records)
+        return parse_and_snap
+
+    def _scan(self, qx, qy, n):
+        '''
+        The `n` nearest stops to a projected point, found by measuring the distance to
+        every stop.
+        '''
+        return heapq.nsmallest(n, (
+            (math.hypot(x - qx, y - qy), stop) for entries in self._cells.values() for x, y, stop in entries
+        ), key=_distance)
+
+    def _project(self, lat, lon):
+        return lon * self._x_scale, lat * METERS_PER_DEGREE
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def _first_ring(self, cx, cy):
+        # Rings closer to the point than the grid's bounds are empty
+        (min_x, min_y), (max_x, max_y) = self._min_cell, self._max_cell
+        return max(min_x - cx, cx - max_x, min_y - cy, cy - max_y, 0)
+
+    def _last_ring(self, cx, cy):
+        (min_x, min_y), (max_x, max_y) = self._min_cell, self._max_cell
+        return max(cx - min_x, max_x - cx, cy - min_y, max_y - cy, 0)
+
+    def _ring(self, cx, cy, ring):
+        '''
+        Yield the entries of the non-empty cells `ring` cells away from (cx, cy).
+        '''
+        cells = self._cells
+        for key in ring_cells(cx, cy, ring):
+            if key in cells:
+                yield cells[key]
+
+    def _cells_between(self, x0, y0, x1, y1):
+        cells = self._cells
+        x0, y0 = max(x0, self._min_cell[0]), max(y0, self._min_cell[1])
+        x1, y1 = min(x1, self._max_cell[0]), min(y1, self._max_cell[1])
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                if (x, y) in cells:
+                    yield cells[(x, y)]
+
+
+def ring_cells(cx, cy, ring):
+    '''
+    The cells on the edge of the square `ring` cells out from (cx, cy).
+    '''
+    if ring == 0:
+        return [(cx, cy)]
+    cells = []
+    for d in range(-ring, ring + 1):
+        cells.extend([(cx + d, cy - ring), (cx + d, cy + ring)])
+    for d in range(-ring + 1, ring):
+        cells.extend([(cx - ring, cy + d), (cx + ring, cy + d)])
+    return cells
+
+
+def default_cell_size(points, minimum=50.0):
+    '''
+    A cell size giving about one of the projected `points` per cell, if they were
+    spread evenly over their bounding box.
+    '''
+    if len(points) < 2:
+        return minimum
+    width = max(p[0] for p in points) - min(p[0] for p in points)
+    height = max(p[1] for p in points) - min(p[1] for p in points)
+    return max(math.sqrt(max(width, minimum) * max(height, minimum) / len(points)), minimum)
+
+
+def _distance(pair):
+    return pair[0]
+
+
+def brute_force_nearest(stops, lat, lon, n=1, reference_lat=None):
+    '''
+    Nearest stops by comparing the distance to every stop, for testing and
+    benchmarking `StopIndex`.  Pass the index's `reference_lat` to measure distances
+    the same way it does.
+    '''
+    x_scale = METERS_PER_DEGREE * math.cos(math.radians(lat if reference_lat is None else reference_lat))
+    distances = [
+        (math.hypot((stop.lon - lon) * x_scale, (stop.lat - lat) * METERS_PER_DEGREE), stop)
+        for stop in stops
+    ]
+    distances.sort(key=_distance)
+    return distances[:n]
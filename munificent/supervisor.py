@@ -0,0 +1,176 @@
+'''
+Multi-process collection.  A `Supervisor` runs a worker function in several
+processes, each collecting its own shard of the probes into its own output, so
+that parsing and serialization can use more than one core.
+'''
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from munificent.schedule import monotonic
+
+LOG = logging.getLogger(__name__)
+
+SHARD_BY_ROUTE = 'route'
+SHARD_BY_TARGET = 'target'
+SHARD_KEYS = [SHARD_BY_ROUTE, SHARD_BY_TARGET]
+
+
+def shard_for(key, shards):
+    '''
+    Assign `key` to one of `shards` shards by rendezvous hashing: each shard scores
+    the key and the highest score wins.  Assignments don't depend on the other keys,
+    and changing the number of shards only moves the keys that the added or removed
+    shards win.
+    '''
+    def score(shard):
+        return hashlib.md5('{}:{}'.format(shard, key).encode('utf-8')).digest()
+    return max(range(shards), key=score)
+
+
+def probe_shard_key(probe, shard_by=SHARD_BY_ROUTE):
+    '''
+    Shard key of a probe named '<kind>:<route>' (e.g. 'predictions:N').  Sharding by
+    route keeps all of a route's probes in the same worker.
+    '''
+    kind, _, route = probe.name.partition(':')
+    return route if shard_by == SHARD_BY_ROUTE else kind
+
+
+def shard_probes(probes, shard, shards, shard_by=SHARD_BY_ROUTE):
+    return [p for p in probes if shard_for(probe_shard_key(p, shard_by), shards) == shard]
+
+
+def shard_path(path, shard):
+    '''
+    Render the output path for a shard, either by filling in a '{worker}' field or
+    by appending the shard number to the file name ('out.jsonl' becomes
+    'out-w1.jsonl').  Other template fields are left for the emitter to fill in.
+    '''
+    if '{worker}' in path:
+        return path.replace('{worker}', str(shard))
+    directory, filename = os.path.split(path)
+    stem, dot, extension = filename.partition('.')
+    return os.path.join(directory, '{}-w{}{}{}'.format(stem, shard, dot, extension))
+
+
+class Supervisor(object):
+    '''
+    Runs `worker(shard)` in `workers` child processes, one per shard, and keeps them
+    running: a worker that exits with an error is restarted after `restart_delay`
+    seconds, doubling up to `max_restart_delay` while it keeps crashing within a
+    minute of starting.  A worker that exits cleanly isn't restarted.
+
+    SIGHUP and SIGUSR1 are passed on to the workers.  SIGTERM and SIGINT are passed on as SIGTERM,
+    and the supervisor returns once every worker has drained and exited.
+    '''
+    STABLE_AFTER = 60.0
+
+    def __init__(self, worker, workers, restart_delay=1.0, max_restart_delay=60.0, poll_interval=0.5,
+                 clock=monotonic):
+        self.worker = worker
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.restarts = 0
+        self.stopping = False
+        self._processes = {}
+        self._started = {}
+        self._delays = {}
+        self._restart_at = {}
+
+    def run(self):
+        previous_handlers = {
+            signum: signal.signal(signum, handler)
+            for signum, handler in [
+                (signal.SIGHUP, self._forward),
+                (signal.SIGUSR1, self._forward),
+                (signal.SIGTERM, self._terminate),
+                (signal.SIGINT, self._terminate),
+            ]
+        }
+        try:
+            for shard in range(self.workers):
+                self._start(shard)
+            while self._processes:
+                self._check_workers()
+                time.sleep(self.poll_interval)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def stop(self):
+        self.stopping = True
+        self._restart_at.clear()
+        self._signal_workers(signal.SIGTERM)
+
+    def _check_workers(self):
+        now = self.clock()
+        for shard, process in list(self._processes.items()):
+            if process is None:
+                if not self.stopping and now >= self._restart_at[shard]:
+                    self._start(shard)
+                elif self.stopping:
+                    del self._processes[shard]
+                continue
+            if process.is_alive():
+                continue
+
+            process.join()
+            if self.stopping or process.exitcode == 0:
+                LOG.info("Worker {} (PID {}) exited with code {}".format(shard, process.pid, process.exitcode))
+                del self._processes[shard]
+                continue
+
+            delay = self._restart_delay(shard, now)
+            LOG.error("Worker {} (PID {}) exited with code {}, restarting in {:.1f}s".format(
+                shard, process.pid, process.exitcode, delay,
+            ))
+            self._processes[shard] = None
+            self._restart_at[shard] = now + delay
+
+    def _restart_delay(self, shard, now):
+        if now - self._started[shard] >= self.STABLE_AFTER:
+            self._delays[shard] = self.restart_delay
+        else:
+            self._delays[shard] = min(self._delays.get(shard, self.restart_delay / 2.0) * 2, self.max_restart_delay)
+        return self._delays[shard]
+
+    def _start(self, shard):
+        if shard in self._processes:
+            self.restarts += 1
+        process = multiprocessing.Process(
+            target=run_worker, args=(self.worker, shard), name='collector-{}'.format(shard))
+        process.start()
+        LOG.info("Started worker {} on PID {}".format(shard, process.pid))
+        self._processes[shard] = process
+        self._started[shard] = self.clock()
+
+    def _signal_workers(self, signum):
+        for process in self._processes.values():
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    def _forward(self, signum, frame):
+        self._signal_workers(signum)
+
+    def _terminate(self, signum, frame):
+        LOG.info("Received signal {}, stopping workers".format(signum))
+        self.stop()
+
+
+def run_worker(worker, shard):
+    '''
+    Entry point of a worker process, which shouldn't inherit the supervisor's
+    signal handlers.
+    '''
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    worker(shard)
@@ -21,11 +21,16 @@ setup(
     author='David Hughes',
     author_email='d@vidhughes.com',
     url='https://github.com/davehughes/munificent',
-    packages=find_packages(exclude=('tests',)),
+    packages=find_packages(exclude=('tests', 'benchmarks')),
     install_requires=[
         'requests',
         'SqlAlchemy',
+        'futures; python_version < "3"',
         ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        'analysis': ['numpy'],
+    },
     include_package_data=True,
     entry_points={
         'console_scripts': [
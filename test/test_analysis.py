@@ -0,0 +1,149 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from munificent.bench import synthetic_prediction_records
+from munificent.io import Emitter, RotatingFile, serialize_records
+
+try:
+    import numpy as np
+    from munificent import analysis
+except ImportError:
+    np = None
+
+try:
+    from munificent.columnar import ColumnarEmitter
+except ImportError:
+    ColumnarEmitter = None
+
+
+def arrival_tuples(results):
+    arrivals, errors = [], []
+    for batch_arrivals, batch_errors in results:
+        arrivals.extend(zip(*[batch_arrivals[f].tolist() for f in ('tripTag', 'stopTag', 'arrival')]))
+        errors.extend(zip(*[
+            batch_errors[f].tolist() for f in ('tripTag', 'stopTag', 'request_timestamp', 'epochTime', 'error')
+        ]))
+    return sorted(arrivals), sorted(errors)
+
+
+def prediction(request_timestamp, epoch_seconds, trip='T1', stop='S1'):
+    return {
+        'type': 'prediction', 'request_timestamp': request_timestamp, 'epochTime': epoch_seconds * 1000,
+        'isDeparture': False, 'routeTag': 'R', 'stopTag': stop, 'tripTag': trip, 'vehicle': None,
+    }
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestReconstructArrivals(unittest.TestCase):
+
+    def setUp(self):
+        self.records = list(synthetic_prediction_records(12, 20, random.Random(1)))
+
+    def batches(self, batch_size):
+        return [
+            analysis.prediction_columns(self.records[i:i + batch_size])
+            for i in range(0, len(self.records), batch_size)
+        ]
+
+    def test_matches_naive_in_any_batch_size(self):
+        expected_arrivals, expected_errors = analysis.naive_arrivals(self.records)
+        self.assertEqual(12 * 20, len(expected_arrivals))
+        for batch_size in (len(self.records), 1000, 97):
+            arrivals, errors = arrival_tuples(analysis.reconstruct_arrivals(self.batches(batch_size)))
+            self.assertEqual(sorted(expected_arrivals), arrivals)
+            self.assertEqual(sorted(expected_errors), errors)
+
+    def test_last_prediction_is_arrival(self):
+        records = [prediction(0, 300), prediction(60, 250), prediction(120, 200), prediction(150, 170)]
+        arrivals, errors = next(analysis.reconstruct_arrivals([analysis.prediction_columns(records)]))
+        self.assertEqual([170000], arrivals['arrival'].tolist())
+        self.assertEqual([4], arrivals['predictions'].tolist())
+        self.assertEqual([130.0, 80.0, 30.0, 0.0], errors['error'].tolist())
+        self.assertEqual([170.0, 110.0, 50.0, 20.0], errors['lead'].tolist())
+
+    def test_same_trip_on_another_day(self):
+        records = [prediction(0, 60), prediction(30, 50), prediction(86400, 86460), prediction(86430, 86450)]
+        arrivals, _ = arrival_tuples(analysis.reconstruct_arrivals([analysis.prediction_columns(records)]))
+        self.assertEqual([('T1', 'S1', 50000), ('T1', 'S1', 86450000)], arrivals)
+
+    def test_disappearing_far_out_is_not_an_arrival(self):
+        records = [prediction(0, 1200), prediction(30, 1190, stop='S2'), prediction(60, 100, stop='S2')]
+        arrivals, errors = arrival_tuples(analysis.reconstruct_arrivals([analysis.prediction_columns(records)]))
+        self.assertEqual([('T1', 'S2', 100000)], arrivals)
+        self.assertEqual(2, len(errors))
+
+    def test_error_summary(self):
+        summary = analysis.ErrorSummary()
+        for arrivals, errors in analysis.reconstruct_arrivals(self.batches(1000)):
+            summary.add(arrivals, errors)
+        self.assertEqual(12 * 20, summary.arrivals)
+        rows = list(summary.rows())
+        self.assertEqual('0-60s', rows[0][0])
+        self.assertEqual(len(self.records), sum(row[1] for row in rows))
+        # Predictions further out are less accurate
+        self.assertLess(rows[0][2], rows[-1][2])
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestPredictionBatches(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.records = list(synthetic_prediction_records(4, 10, random.Random(1)))
+        self.records.append({'type': 'vehicle_location', 'vehicle': '1000'})
+        self.records.append(dict(self.records[0], tripTag=None))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertLoaded(self, paths):
+        batches = list(analysis.iter_prediction_batches(paths, batch_size=100))
+        self.assertTrue(all(len(batch['epochTime']) <= 100 for batch in batches))
+        loaded = analysis.concat_columns(batches)
+        expected = analysis.prediction_columns(self.records)
+        for field in analysis.PREDICTION_FIELDS:
+            self.assertEqual(expected[field].tolist(), loaded[field].tolist())
+
+    def test_json_lines(self):
+        half = len(self.records) // 2
+        with open(os.path.join(self.tmpdir, 'a.jsonl'), 'wb') as f:
+            f.write(serialize_records(self.records[:half]))
+        with gzip.open(os.path.join(self.tmpdir, 'b.jsonl.gz'), 'wb') as f:
+            f.write(serialize_records(self.records[half:]))
+        self.assertLoaded([self.tmpdir])
+
+    def test_rotated_files_read_in_order(self):
+        records = list(synthetic_prediction_records(12, 20, random.Random(1)))
+        emitter = Emitter(lambda mode: RotatingFile(
+            os.path.join(self.tmpdir, 'out.jsonl'), max_bytes=len(serialize_records(records)) // 11))
+        for record in records:
+            emitter.emit(record)
+        emitter.close()
+        # 'out.jsonl', then 'out-1.jsonl' up to at least 'out-10.jsonl'
+        self.assertIn('out-10.jsonl', os.listdir(self.tmpdir))
+
+        expected_arrivals, _ = analysis.naive_arrivals(records)
+        batches = analysis.iter_prediction_batches([self.tmpdir], batch_size=1000)
+        arrivals, _ = arrival_tuples(analysis.reconstruct_arrivals(batches))
+        self.assertEqual(sorted(expected_arrivals), arrivals)
+
+    @unittest.skipIf(ColumnarEmitter is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        emitter = ColumnarEmitter(os.path.join(self.tmpdir, 'out.parquet'), row_group_size=50)
+        for record in self.records:
+            emitter.emit(record)
+        emitter.close()
+        self.assertLoaded([os.path.join(self.tmpdir, 'out.prediction.parquet')])
+
+    def test_columns_writer(self):
+        arrivals, _ = next(analysis.reconstruct_arrivals([analysis.prediction_columns(self.records)]))
+        path = os.path.join(self.tmpdir, 'arrivals.jsonl.gz')
+        writer = analysis.ColumnsWriter(path)
+        writer.write(arrivals)
+        writer.close()
+        with gzip.open(path, 'rb') as f:
+            self.assertEqual(len(arrivals['arrival']), len(f.readlines()))
@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from munificent.archive import (
+    ColumnarWriter, JSONLinesWriter, RawArchive, iter_entries, list_segments, read_index, reprocess,
+)
+from munificent.bench import FakeNextBusServer, synthetic_plan
+from munificent.collect import get_location_probes, get_prediction_probes, parse_prediction_points
+from munificent.nextbus import NextBusAPI, build_session
+
+from . import utils
+
+try:
+    from munificent.columnar import ColumnarEmitter
+except ImportError:
+    ColumnarEmitter = None
+
+HOUR = 3600
+START = 1500000000 - 1500000000 % HOUR
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def fixture_result(name, timestamp):
+    result = utils.load_json_fixture(name)
+    result['_meta'] = {'timestamp': timestamp, 'request_id': 'request-{}'.format(timestamp)}
+    return result
+
+
+class TestRawArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive_dir = os.path.join(self.tmp_dir, 'archive')
+        self.clock = FakeClock(START)
+        self.archive = RawArchive(self.archive_dir, clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_segments_and_index(self):
+        for offset in [0, 60, HOUR, HOUR + 60]:
+            self.clock.now = START + offset
+            self.archive.append('predictions:N', 'predictionsForMultiStops',
+                                fixture_result('multiprediction.json', START + offset))
+        self.archive.close()
+
+        segments = list_segments(self.archive_dir)
+        self.assertEqual(2, len(segments))
+        self.assertEqual([segments[1]], list_segments(self.archive_dir, start=START + HOUR + 30))
+        self.assertEqual([START, START + 60], [entry['timestamp'] for entry in read_index(segments[0])])
+
+        entries = list(iter_entries(segments[1], start=START + HOUR + 30))
+        self.assertEqual(1, len(entries))
+        self.assertEqual('predictions:N', entries[0]['probe'])
+        self.assertEqual(fixture_result('multiprediction.json', START + HOUR + 60), entries[0]['response'])
+
+    def test_appends_after_reopening(self):
+        self.archive.append('locations:N', 'vehicleLocations', fixture_result('vehicle-locations.json', START))
+        self.archive.close()
+        RawArchive(self.archive_dir, clock=self.clock).append(
+            'locations:N', 'vehicleLocations', fixture_result('vehicle-locations.json', START + 1))
+        timestamps = [e['response']['_meta']['timestamp'] for e in iter_entries(list_segments(self.archive_dir)[0])]
+        self.assertEqual([START, START + 1], timestamps)
+
+    def test_partly_written_index_entry_skipped(self):
+        self.archive.append('locations:N', 'vehicleLocations', fixture_result('vehicle-locations.json', START))
+        self.archive.close()
+        segment = list_segments(self.archive_dir)[0]
+        with open(segment + '.idx', 'a') as f:
+            f.write('{"command": "vehicleLoc')
+        self.assertEqual(1, len(list(iter_entries(segment))))
+
+    def test_reprocess(self):
+        for offset, probe in [(0, 'predictions:N'), (1, 'locations:N'), (HOUR, 'predictions:N')]:
+            self.clock.now = START + offset
+            if probe.startswith('predictions'):
+                result = fixture_result('multiprediction.json', START + offset)
+                self.archive.append(probe, 'predictionsForMultiStops', result)
+            else:
+                self.archive.append(probe, 'vehicleLocations', fixture_result('vehicle-locations.json', START + offset))
+        self.archive.close()
+
+        output_dir = os.path.join(self.tmp_dir, 'output')
+        results = list(reprocess(self.archive_dir, output_dir, workers=2, probes=['predictions:*']))
+        self.assertEqual([1, 1], [entries for _, _, entries, _ in results])
+        self.assertEqual([299, 299], [records for _, _, _, records in results])
+        with open(results[0][1]) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(299, len(records))
+        self.assertEqual('request-{}'.format(START), records[0]['request_id'])
+
+
+class TestOutputWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.records = parse_prediction_points(fixture_result('multiprediction.json', START))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_aborted_json_lines_removed(self):
+        writer = JSONLinesWriter(os.path.join(self.tmp_dir, 'segment.jsonl.gz'), compress=True)
+        writer.write(self.records)
+        writer.abort()
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+    @unittest.skipIf(ColumnarEmitter is None, 'pyarrow is not installed')
+    def test_aborted_parquet_removed(self):
+        writer = ColumnarWriter(ColumnarEmitter(os.path.join(self.tmp_dir, 'segment.parquet'), row_group_size=100))
+        writer.write(self.records)
+        writer.abort()
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+
+class TestProbeCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = FakeNextBusServer(predictions_per_stop=2, vehicles_per_route=3, seed=1).start()
+        self.api = NextBusAPI(json_feed_url=self.server.url, session=build_session(retries=0))
+        self.archive = RawArchive(self.tmp_dir)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def check_capture(self, stream):
+        plan = synthetic_plan(1, 4)
+        probes = get_prediction_probes(self.api, plan, stream=stream) + get_location_probes(self.api, plan, stream)
+        records = []
+        for probe in probes:
+            probe.raw_archive = self.archive
+            records.extend(probe.collect())
+        self.archive.close()
+
+        entries = list(iter_entries(list_segments(self.tmp_dir)[0]))
+        self.assertEqual(['predictions:R0', 'locations:R0'], [entry['probe'] for entry in entries])
+        self.assertEqual(4, len(entries[0]['response']['predictions']))
+        # Captured before parsing, which adds fields to vehicle locations
+        self.assertNotIn('request_id', entries[1]['response']['vehicle'][0])
+        self.assertEqual(8 + 3, len(records))
+
+    def test_capture(self):
+        self.check_capture(stream=False)
+
+    def test_capture_streamed(self):
+        self.check_capture(stream=True)
@@ -0,0 +1,99 @@
+import gzip
+import io
+import json
+import random
+import unittest
+
+from munificent.bench import FakeNextBusServer, UnthrottledScheduler, percentile, run_bench, synthetic_plan
+from munificent.collect import parse_prediction_points, parse_vehicle_locations
+from munificent.nextbus import NextBusAPI, build_session
+
+from .test_collect import ListEmitter
+from .test_schedule import FakeClock
+
+
+class ClosingListEmitter(ListEmitter):
+
+    def close(self):
+        self.closed = True
+
+
+class TestFakeNextBusServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeNextBusServer(predictions_per_stop=2, vehicles_per_route=4, seed=1).start()
+        self.api = NextBusAPI(json_feed_url=self.server.url, session=build_session(retries=0))
+        self.plan = synthetic_plan(2, 5)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_synthetic_predictions(self):
+        request = self.api.request_builder.get_batched_multistop_predictions('sf-muni', self.plan[0]['stop_codes'])
+        points = parse_prediction_points(self.api.perform_request(request))
+        self.assertEqual(10, len(points))
+        self.assertEqual({'R0'}, set(point['routeTag'] for point in points))
+
+    def test_synthetic_vehicle_locations(self):
+        request = self.api.request_builder.get_vehicle_locations('sf-muni', 'R1')
+        self.assertEqual(4, len(parse_vehicle_locations(self.api.perform_request(request))))
+
+    def test_gzip(self):
+        status, headers, body = self.server.respond(
+            '/service/publicJSONFeed?command=vehicleLocations&a=sf-muni&r=R0', 'gzip, deflate')
+        self.assertEqual(200, status)
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        payload = json.loads(gzip.GzipFile(fileobj=io.BytesIO(body)).read().decode('utf-8'))
+        self.assertEqual(4, len(payload['vehicle']))
+
+    def test_errors(self):
+        self.server.error_rate = 1.0
+        status, _, _ = self.server.respond('/service/publicJSONFeed?command=vehicleLocations&a=sf-muni&r=R0')
+        self.assertEqual(503, status)
+
+
+class TestUnthrottledScheduler(unittest.TestCase):
+
+    def test_ticks_without_sleeping(self):
+        clock = FakeClock()
+        scheduler = UnthrottledScheduler(10.0, clock=clock, sleep=self.fail)
+        ticks = list(scheduler.ticks(slots=2, cycles=2))
+        self.assertEqual([(0, 0), (0, 1), (1, 0), (1, 1)], [(t.cycle, t.slot) for t in ticks])
+        self.assertEqual(4, scheduler.ticks_fired)
+
+
+class TestRunBench(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeNextBusServer(predictions_per_stop=1, vehicles_per_route=2, seed=1).start()
+        self.api = NextBusAPI(json_feed_url=self.server.url, session=build_session(retries=0))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_run_bench(self):
+        emitter = ClosingListEmitter()
+        results = run_bench(self.api, synthetic_plan(2, 3), emitter, cycles=2, concurrency=2)
+        self.assertEqual(4, results['probes'])
+        self.assertEqual(2, results['cycles'])
+        self.assertEqual(2 * (2 * 3 + 2 * 2), results['records'])
+        self.assertEqual(results['records'], len(emitter.records))
+        self.assertEqual(0, results['probe_errors'])
+        self.assertEqual(0, results['overruns'])
+        self.assertLessEqual(results['cycle_p50_s'], results['elapsed_s'] / 2)
+        self.assertTrue(emitter.closed)
+
+    def test_paced_runs_every_cycle(self):
+        # Probes take longer than their slots, so the scheduler skips ticks
+        self.server.latency = 0.02
+        results = run_bench(self.api, synthetic_plan(2, 3), ClosingListEmitter(), cycles=3, period=0.01, paced=True)
+        self.assertEqual(3, results['cycles'])
+        self.assertTrue(results['paced'])
+        self.assertGreater(results['overruns'], 0)
+
+    def test_percentile(self):
+        values = sorted(random.Random(1).sample(range(1000), 100))
+        self.assertEqual(values[49], percentile(values, 50))
+        self.assertEqual(values[98], percentile(values, 99))
+        self.assertEqual(values[-1], percentile(values, 100))
+        self.assertIsNone(percentile([], 50))
@@ -0,0 +1,39 @@
+import subprocess
+import sys
+import unittest
+
+from munificent import db
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_cli_import_is_lightweight(self):
+        loaded = subprocess.check_output([sys.executable, '-c', '\n'.join([
+            'import sys',
+            'import munificent.cli',
+            'print(" ".join(m for m in ("sqlalchemy", "requests") if m in sys.modules))',
+        ])])
+        self.assertEqual(b'', loaded.strip())
+
+    def test_session_is_shared(self):
+        self.assertIs(db.get_session(), db.get_session())
+        self.assertIs(db.get_engine(), db.get_session().get_bind())
+
+
+class TestArguments(unittest.TestCase):
+
+    def test_period_must_be_positive(self):
+        from munificent import cli
+        parser = cli.build_parser()
+        args = parser.parse_args(['collect', 'out.jsonl', '--period', '0.5', '--target', 'sfmuni-predictions'])
+        self.assertEqual(0.5, args.period)
+        for period in ('0', '-1'):
+            with self.assertRaises(SystemExit):
+                parser.parse_args(['bench', '--period', period])
+
+    def test_parquet_output_is_not_buffered(self):
+        from munificent import cli
+        args = cli.build_parser().parse_args(
+            ['collect', 'out.parquet', '--format', 'parquet', '--buffered', '--target', 'sfmuni-predictions'])
+        with self.assertRaises(ValueError):
+            cli.build_emitter(args)
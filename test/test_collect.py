@@ -1,9 +1,93 @@
 from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
-from munificent.collect import parse_prediction_points, parse_vehicle_locations
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from munificent import db
+from munificent.collect import (
+    Collector, build_probe_plan, cap_timeout, load_probe_plan,
+    parse_prediction_points, parse_prediction_points_compact, parse_vehicle_locations,
+)
+from munificent.io import serialize_records
+from munificent.nextbus import populate_db
+from munificent.schedule import PhasedScheduler
 
 from . import utils
+from .test_db import FakeAPI, route_config
+from .test_schedule import FakeClock
+
+
+class ListEmitter(object):
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class FakeProbe(object):
+    '''
+    A probe that returns `records` records, after calling `wait` if given, so that
+    tests can control when concurrent probes finish without depending on timing.
+    '''
+
+    def __init__(self, name, records=1, wait=None, timeout=10):
+        self.name = name
+        self.records = records
+        self.wait = wait
+        self.request_timeout = timeout
+        self.timeouts = []
+
+    def collect(self, **request_args):
+        self.timeouts.append(request_args.get('timeout'))
+        if self.wait is not None:
+            self.wait()
+        return [(self.name, i) for i in range(self.records)]
+
+
+class CycleCounter(object):
+    '''
+    A stand-in profiler that only counts the cycles the collector ends.
+    '''
+
+    def __init__(self):
+        self.cycles = 0
+
+    def collect(self, probe, **request_args):
+        return probe.collect(**request_args)
+
+    def end_cycle(self):
+        self.cycles += 1
+
+
+class Rendezvous(object):
+    '''
+    Blocks each of `parties` callers until all of them have arrived, raising if they
+    haven't within `timeout` seconds.
+    '''
+
+    def __init__(self, parties, timeout=5.0):
+        self.parties = parties
+        self.timeout = timeout
+        self.arrived = 0
+        self.condition = threading.Condition()
+
+    def __call__(self):
+        with self.condition:
+            self.arrived += 1
+            self.condition.notify_all()
+            deadline = time.time() + self.timeout
+            while self.arrived < self.parties and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            if self.arrived < self.parties:
+                raise AssertionError("Only {} of {} probes ran at once".format(self.arrived, self.parties))
 
 
 class TestPredictionResultParsing(unittest.TestCase):
@@ -13,6 +97,20 @@ class TestPredictionResultParsing(unittest.TestCase):
         points = parse_prediction_points(prediction_points)
         self.assertEqual(299, len(points))
 
+    def test_compact_records_match_dict_records(self):
+        prediction_result = utils.load_json_fixture('multiprediction.json')
+        records = parse_prediction_points(prediction_result)
+        compact = parse_prediction_points_compact(prediction_result)
+        self.assertEqual(records, [dict(point) for point in compact])
+        self.assertEqual(list(records[0].keys()), list(compact[0].keys()))
+        self.assertEqual(serialize_records(records), serialize_records(compact))
+
+    def test_compact_records_share_context(self):
+        compact = parse_prediction_points_compact(utils.load_json_fixture('multiprediction.json'))
+        self.assertIs(compact[0].context, compact[1].context)
+        self.assertEqual('F', compact[0]['routeTag'])
+        self.assertEqual(None, compact[0].get('missing'))
+
     def test_vehicle_locations_fixture(self):
         locations_fixture = utils.load_json_fixture('vehicle-locations.json')
         locations = parse_vehicle_locations(locations_fixture)
@@ -23,3 +121,119 @@ class TestPredictionResultParsing(unittest.TestCase):
         del locations_fixture['vehicle']
         locations = parse_vehicle_locations(locations_fixture)
         self.assertEqual(0, len(locations))
+
+
+class TestCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.released = threading.Event()
+
+    def tearDown(self):
+        self.released.set()
+
+    def collector(self, probes, emitter, period, **kwargs):
+        scheduler = PhasedScheduler(period, clock=self.clock, sleep=self.clock.sleep)
+        return Collector(probes, emitter, period=period, scheduler=scheduler, **kwargs)
+
+    def test_sequential_cycles(self):
+        emitter = ListEmitter()
+        probes = [FakeProbe('a'), FakeProbe('b')]
+        self.collector(probes, emitter, period=10.0).run(cycles=2)
+        self.assertEqual([('a', 0), ('b', 0), ('a', 0), ('b', 0)], emitter.records)
+        self.assertEqual(115.0, self.clock.now)
+
+    def test_cycle_ends_when_last_slot_skipped(self):
+        emitter = ListEmitter()
+        profiler = CycleCounter()
+        # The first probe overruns so far that the last slot of the first cycle is skipped
+        delays = [12.0]
+        probes = [FakeProbe('a', wait=lambda: self.clock.sleep(delays.pop() if delays else 0)),
+                  FakeProbe('b'), FakeProbe('c')]
+        self.collector(probes, emitter, period=10.0, profiler=profiler).run(cycles=2)
+        self.assertEqual([('a', 0), ('b', 0), ('a', 0), ('b', 0), ('c', 0)], emitter.records)
+        self.assertEqual(2, profiler.cycles)
+
+    def test_concurrent_records_in_probe_order(self):
+        emitter = ListEmitter()
+        fast_finished = threading.Event()
+        probes = [
+            FakeProbe('slow', records=2, wait=lambda: fast_finished.wait(5.0)),
+            FakeProbe('fast', records=2, wait=fast_finished.set),
+        ]
+        self.collector(probes, emitter, period=10.0, concurrency=2).run(cycles=1)
+        self.assertEqual([('slow', 0), ('slow', 1), ('fast', 0), ('fast', 1)], emitter.records)
+
+    def test_concurrent_probes_overlap(self):
+        emitter = ListEmitter()
+        # Each probe only finishes once all four are running at the same time
+        rendezvous = Rendezvous(4)
+        probes = [FakeProbe(str(i), wait=rendezvous) for i in range(4)]
+        self.collector(probes, emitter, period=10.0, concurrency=4).run(cycles=1)
+        self.assertEqual(4, len(emitter.records))
+
+    def test_concurrent_timeout_capped_by_deadline(self):
+        probe = FakeProbe('a', timeout=30)
+        self.collector([probe], ListEmitter(), period=0.1, concurrency=2).run(cycles=1)
+        self.assertAlmostEqual(0.1, probe.timeouts[0])
+
+    def test_cap_timeout(self):
+        self.assertEqual(5, cap_timeout(None, 5))
+        self.assertEqual(3, cap_timeout(3, 5))
+        self.assertEqual((3, 5), cap_timeout((3, 10), 5))
+
+    def test_concurrent_missed_deadline_is_dropped(self):
+        emitter = ListEmitter()
+        # The late probe doesn't finish until the test is over
+        probes = [FakeProbe('late', wait=self.released.wait), FakeProbe('ok')]
+        self.collector(probes, emitter, period=0.1, concurrency=2).run(cycles=1)
+        self.assertEqual([('ok', 0)], emitter.records)
+
+
+class ExplodingSession(object):
+
+    def query(self, *args):
+        raise AssertionError("Reference database queried")
+
+
+class TestProbePlan(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        db.create_db(engine)
+        self.session = sessionmaker(bind=engine)()
+        populate_db(['sf-muni'], api=FakeAPI({'sf-muni': route_config()}), session=self.session)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_build_plan(self):
+        plan = build_probe_plan(['N-Judah', 'S-Shuttle'], session=self.session)
+        self.assertEqual([
+            {'agency': 'sf-muni', 'route': 'N', 'stop_codes': ['N|1', 'N|2']},
+            {'agency': 'sf-muni', 'route': 'S', 'stop_codes': ['S|4']},
+        ], plan)
+
+    def test_cached_plan_skips_database(self):
+        plan = load_probe_plan(['N-Judah'], session=self.session, cache_dir=self.cache_dir, version='1')
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+        cached = load_probe_plan(['N-Judah'], session=ExplodingSession(), cache_dir=self.cache_dir, version='1')
+        self.assertEqual(plan, cached)
+
+    def test_reload_rebuilds_plan(self):
+        load_probe_plan(['N-Judah'], session=self.session, cache_dir=self.cache_dir)
+        engine = self.session.get_bind()
+        self.session.close()
+        db.drop_db(engine)
+        db.create_db(engine)
+        config = route_config()
+        config['route'][0]['stop'] = config['route'][0]['stop'][:1]
+        populate_db(['sf-muni'], api=FakeAPI({'sf-muni': config}), session=self.session)
+        plan = load_probe_plan(['N-Judah'], session=self.session, cache_dir=self.cache_dir)
+        self.assertEqual([{'agency': 'sf-muni', 'route': 'N', 'stop_codes': ['N|1']}], plan)
+
+    def test_new_version_rebuilds_plan(self):
+        load_probe_plan(['N-Judah'], session=self.session, cache_dir=self.cache_dir, version='1')
+        with self.assertRaises(AssertionError):
+            load_probe_plan(['N-Judah'], session=ExplodingSession(), cache_dir=self.cache_dir, version='2')
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from munificent.collect import parse_prediction_points, parse_vehicle_locations
+
+from . import utils
+
+try:
+    import pyarrow.parquet as pq
+    from munificent.columnar import ColumnarEmitter
+except ImportError:
+    pq = None
+
+
+@unittest.skipIf(pq is None, 'pyarrow is not installed')
+class TestColumnarEmitter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'output.parquet')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def finalized(self):
+        return sorted(f for f in os.listdir(self.tmpdir) if not f.startswith('.'))
+
+    def test_one_file_per_record_type(self):
+        predictions = parse_prediction_points(utils.load_json_fixture('multiprediction.json'))
+        locations = parse_vehicle_locations(utils.load_json_fixture('vehicle-locations.json'))
+        emitter = ColumnarEmitter(self.path, row_group_size=100)
+        for record in predictions + locations:
+            emitter.emit(record)
+        emitter.close()
+
+        self.assertEqual(['output.prediction.parquet', 'output.vehicle_location.parquet'],
+                         sorted(os.listdir(self.tmpdir)))
+        table = pq.read_table(os.path.join(self.tmpdir, 'output.prediction.parquet'))
+        self.assertEqual(299, table.num_rows)
+        self.assertEqual(3, pq.ParquetFile(os.path.join(self.tmpdir, 'output.prediction.parquet')).num_row_groups)
+        self.assertEqual(predictions[0], table.slice(0, 1).to_pylist()[0])
+
+    def test_vehicle_location_columns_are_typed(self):
+        locations = parse_vehicle_locations(utils.load_json_fixture('vehicle-locations.json'))
+        emitter = ColumnarEmitter(os.path.join(self.tmpdir, '{type}s.parquet'))
+        for record in locations:
+            emitter.emit(record)
+        emitter.close()
+
+        row = pq.read_table(os.path.join(self.tmpdir, 'vehicle_locations.parquet')).to_pylist()[0]
+        self.assertEqual('1434', row['vehicle'])
+        self.assertEqual(26, row['speedKmHr'])
+        self.assertEqual(37.7425, row['lat'])
+
+    def test_flushes_by_record_count_and_interval(self):
+        now = [1550534400.0]
+        locations = parse_vehicle_locations(utils.load_json_fixture('vehicle-locations.json'))
+        emitter = ColumnarEmitter(self.path, max_records=5, interval=3600, clock=lambda: now[0])
+        for record in locations[:6]:
+            emitter.emit(record)
+        # Five records were finalized before the sixth went to a new file
+        self.assertEqual(['output.vehicle_location.parquet'], self.finalized())
+        self.assertEqual(5, pq.read_table(os.path.join(self.tmpdir, 'output.vehicle_location.parquet')).num_rows)
+        now[0] += 3600
+        emitter.emit(locations[6])
+        self.assertEqual(2, len(self.finalized()))
+        emitter.close()
+        rows = sum(pq.read_table(os.path.join(self.tmpdir, f)).num_rows for f in self.finalized())
+        self.assertEqual(7, rows)
+
+    def test_unknown_record_type(self):
+        emitter = ColumnarEmitter(self.path)
+        with self.assertRaises(ValueError):
+            emitter.emit({'type': 'message'})
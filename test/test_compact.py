@@ -0,0 +1,160 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from munificent.compact import compact, reduce_runs, sort_key, split_runs, write_run
+from munificent.io import Emitter, RotatingFile, iter_output_files, read_metadata, read_records, serialize_records
+
+
+def record(timestamp, route, stop, n=0):
+    return {'type': 'prediction', 'request_timestamp': timestamp, 'routeTag': route, 'stopTag': stop, 'n': n}
+
+
+def record_order(r):
+    return (r['request_timestamp'], r['routeTag'], r['stopTag'])
+
+
+def sorted_fields(r):
+    return record_order(r) + (r['n'],)
+
+
+class TestCompact(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmpdir, 'output')
+        self.output_dir = os.path.join(self.tmpdir, 'compacted')
+        rng = random.Random(1)
+        # Two hours of records, written out of order across shards and restarts
+        self.records = [
+            record(1550534400 + t, rng.choice('NJK'), str(rng.randint(1, 20)), n)
+            for n, t in enumerate(rng.randint(0, 7199) for _ in range(3000))
+        ]
+        self.write_inputs()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_inputs(self):
+        os.makedirs(self.input_dir)
+        chunks = [self.records[i:i + 500] for i in range(0, len(self.records), 500)]
+        for i, chunk in enumerate(chunks[:4]):
+            emitter = Emitter(lambda mode, i=i: RotatingFile(
+                os.path.join(self.input_dir, 'w{}'.format(i % 2), 'out.jsonl.gz'), compress=True))
+            emitter.emit(chunk[0])
+            for r in chunk[1:]:
+                emitter.emit(r)
+            emitter.close()
+        # Output without metadata, from a plain emitter
+        with open(os.path.join(self.input_dir, 'plain.jsonl'), 'wb') as f:
+            f.write(serialize_records(chunks[4] + chunks[5]))
+        # A replay of records already collected
+        with gzip.open(os.path.join(self.input_dir, 'replay.jsonl.gz'), 'wb') as f:
+            f.write(serialize_records(chunks[0][:100]))
+
+    def compact(self, **kwargs):
+        kwargs.setdefault('workers', 2)
+        return list(compact([self.input_dir], self.output_dir, **kwargs))
+
+    def test_sorted_by_window(self):
+        results = self.compact(run_bytes=20000, block_size=10000)
+        self.assertEqual([1550534400, 1550538000], [result.window_start for result in results])
+        self.assertEqual(
+            ['compacted-2019021900.jsonl.xz', 'compacted-2019021901.jsonl.xz'],
+            [os.path.basename(result.path) for result in results],
+        )
+        self.assertEqual(len(self.records) + 100, sum(result.records for result in results))
+
+        compacted = list(read_records([self.output_dir]))
+        self.assertEqual(sorted(self.records + self.records[:100], key=sorted_fields),
+                         sorted(compacted, key=sorted_fields))
+        self.assertEqual([record_order(r) for r in compacted], sorted(record_order(r) for r in compacted))
+
+        metadata = read_metadata(results[0].path)
+        timestamps = [r['request_timestamp'] for r in self.records if r['request_timestamp'] < 1550538000]
+        self.assertEqual((min(timestamps), max(timestamps)), (metadata.min_timestamp, metadata.max_timestamp))
+        self.assertEqual({'N', 'J', 'K'}, metadata.routes)
+        self.assertGreater(len(metadata.blocks), 1)
+
+    def test_dedupe(self):
+        results = self.compact(dedupe=True, codec='gzip', template='{YYYYMMDD}-{YYYYMMDDHH}')
+        self.assertEqual(100, sum(result.duplicates for result in results))
+        self.assertEqual('2019021900.jsonl.gz', os.path.basename(results[0].path).partition('-')[2])
+        compacted = list(read_records([self.output_dir]))
+        self.assertEqual(sorted(self.records, key=sorted_fields), sorted(compacted, key=sorted_fields))
+
+    def test_windows_under_an_hour(self):
+        results = self.compact(window=600)
+        self.assertEqual(12, len(results))
+        names = [os.path.basename(result.path) for result in results]
+        self.assertEqual('compacted-201902190000.jsonl.xz', names[0])
+        self.assertEqual(sorted(names), names)
+        compacted = list(read_records([self.output_dir]))
+        self.assertEqual([record_order(r) for r in compacted], sorted(record_order(r) for r in compacted))
+
+    def test_template_coarser_than_window(self):
+        with self.assertRaises(ValueError):
+            self.compact(window=600, template='compacted-{YYYYMMDDHH}')
+        self.assertEqual([], list(iter_output_files([self.output_dir])))
+
+    def test_torn_inputs(self):
+        # A crash mid-write leaves a truncated compressed file, and a torn last line
+        path = os.path.join(self.input_dir, 'torn.jsonl.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(serialize_records([record(1550534400, 'N', '1', -1)] * 1000))
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 10)
+        with open(os.path.join(self.input_dir, 'plain.jsonl'), 'ab') as f:
+            f.write(b'{"type": "prediction", "request_timestamp": 15505')
+
+        results = self.compact(dedupe=True)
+        self.assertEqual(len(self.records) + 1, sum(result.records for result in results))
+        self.assertEqual(sorted(self.records + [record(1550534400, 'N', '1', -1)], key=sorted_fields),
+                         sorted(read_records([self.output_dir]), key=sorted_fields))
+
+    def test_output_under_input(self):
+        self.output_dir = os.path.join(self.input_dir, 'compacted')
+        self.compact()
+        self.compact()
+        compacted = list(iter_output_files([self.output_dir]))
+        self.assertEqual(4, len(compacted))
+        self.assertEqual(2 * (len(self.records) + 100), len(list(read_records(compacted))))
+
+
+class TestRuns(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_split_and_reduce(self):
+        records = [record(1000 + n % 7, 'N', str(n % 3), n) for n in range(200)]
+        runs = []
+        for i in range(5):
+            path = os.path.join(self.tmpdir, 'out-{}.jsonl'.format(i))
+            with open(path, 'wb') as f:
+                f.write(serialize_records(records[i::5]))
+            runs.extend(split_runs([path], self.tmpdir, window=5))
+        self.assertEqual({1000, 1005}, set(window_start for window_start, _ in runs))
+        self.assertEqual(10, len(runs))
+
+        window_runs = [run for window_start, run in runs if window_start == 1000]
+        reduced = reduce_runs(1000, window_runs, max_runs=2)
+        self.assertEqual(2, len(reduced))
+        lines = []
+        for run in reduced:
+            with open(run, 'rb') as f:
+                run_lines = f.readlines()
+            self.assertEqual(sorted(run_lines), run_lines)
+            lines.extend(run_lines)
+        self.assertEqual(len([r for r in records if 1000 <= r['request_timestamp'] < 1005]), len(lines))
+
+    def test_sort_key_orders_numerically(self):
+        keys = [sort_key(record(t, route, '1')) for t, route in [(999.5, 'N'), (1000, 'J'), (1000, 'N'), (1e4, 'A')]]
+        self.assertEqual(keys, sorted(keys))
+        self.assertTrue(write_run([b'a\n'], 0, self.tmpdir).endswith('.run'))
@@ -0,0 +1,83 @@
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from munificent import db
+from munificent.nextbus import populate_db
+
+
+def stop(tag, stop_id, title):
+    return {'tag': tag, 'stopId': stop_id, 'title': title, 'lat': '37.7', 'lon': '-122.4'}
+
+
+def route_config(title='N-Judah', shared_stop_title='Church St'):
+    return {'route': [
+        {'tag': 'N', 'title': title, 'stop': [stop('1', '101', shared_stop_title), stop('2', '102', 'Duboce')]},
+        {'tag': 'J', 'title': 'J-Church', 'stop': [stop('1', '101', shared_stop_title), stop('3', '103', 'Market')]},
+        {'tag': 'S', 'title': 'S-Shuttle', 'stop': stop('4', '104', 'Castro')},
+    ]}
+
+
+class FakeAPI(object):
+
+    def __init__(self, route_configs):
+        self.route_configs = route_configs
+
+    def list_agencies(self):
+        return {'agency': [
+            {'tag': 'sf-muni', 'title': 'San Francisco Muni', 'regionTitle': 'California-Northern'},
+            {'tag': 'actransit', 'title': 'AC Transit', 'regionTitle': 'California-Northern'},
+        ]}
+
+    def get_route_config(self, agency):
+        return self.route_configs[agency]
+
+
+class TestPopulateDB(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        db.create_db(engine)
+        self.session = sessionmaker(bind=engine)()
+
+    def count(self, model):
+        return self.session.query(model).count()
+
+    def test_bulk_load(self):
+        populate_db(['sf-muni'], api=FakeAPI({'sf-muni': route_config()}), session=self.session)
+        self.assertEqual(2, self.count(db.Agency))
+        self.assertEqual(3, self.count(db.Route))
+        self.assertEqual(4, self.count(db.Stop))
+        self.assertEqual(5, self.count(db.RouteStop))
+
+        route = self.session.query(db.Route).filter(db.Route.tag == 'N').one()
+        self.assertEqual(['N|1', 'N|2'], sorted(rs.route_stop_code for rs in route.stops))
+
+    def test_reload_updates_in_place(self):
+        populate_db(['sf-muni'], api=FakeAPI({'sf-muni': route_config()}), session=self.session)
+        updated = route_config(title='N-Judah Line', shared_stop_title='Church St & Duboce')
+        populate_db(['sf-muni'], api=FakeAPI({'sf-muni': updated}), session=self.session)
+        self.assertEqual(3, self.count(db.Route))
+        self.assertEqual(4, self.count(db.Stop))
+        self.assertEqual(5, self.count(db.RouteStop))
+        self.assertEqual('N-Judah Line', self.session.query(db.Route.title).filter(db.Route.tag == 'N').scalar())
+        self.assertEqual('Church St & Duboce', self.session.query(db.Stop.title).filter(db.Stop.tag == '1').scalar())
+
+    def test_load_bumps_reference_version(self):
+        self.assertEqual(None, db.reference_version(self.session))
+        populate_db(['sf-muni'], api=FakeAPI({'sf-muni': route_config()}), session=self.session)
+        first = db.reference_version(self.session)
+        self.assertIsNotNone(first)
+        populate_db(['sf-muni'], api=FakeAPI({'sf-muni': route_config()}), session=self.session)
+        self.assertNotIn(db.reference_version(self.session), (None, first))
+
+    def test_no_reference_version_before_migration(self):
+        session = sessionmaker(bind=create_engine('sqlite://'))()
+        self.assertEqual(None, db.reference_version(session))
+
+    def test_multiple_agencies(self):
+        api = FakeAPI({'sf-muni': route_config(), 'actransit': route_config()})
+        populate_db(['sf-muni', 'actransit'], api=api, session=self.session)
+        self.assertEqual(6, self.count(db.Route))
+        self.assertEqual(8, self.count(db.Stop))
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import inspect, text
+
+from munificent.collect import parse_prediction_points, parse_prediction_points_compact, parse_vehicle_locations
+from munificent.dbemitter import DatabaseEmitter
+
+from . import utils
+
+
+def open_emitter(path):
+    DatabaseEmitter(path).close()
+
+
+class TestDatabaseEmitter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'observations.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def query(self, emitter, sql):
+        with emitter.engine.connect() as connection:
+            return connection.execute(text(sql)).fetchall()
+
+    def test_records_inserted_by_type(self):
+        predictions = parse_prediction_points(utils.load_json_fixture('multiprediction.json'))
+        locations = parse_vehicle_locations(utils.load_json_fixture('vehicle-locations.json'))
+        emitter = DatabaseEmitter(self.path, batch_size=100)
+        for record in predictions + locations:
+            emitter.emit(record)
+        emitter.flush()
+
+        self.assertEqual([(299,)], self.query(emitter, 'SELECT COUNT(*) FROM predictions'))
+        self.assertEqual([(len(locations),)], self.query(emitter, 'SELECT COUNT(*) FROM vehicle_locations'))
+        vehicle, lat, speed = self.query(
+            emitter, 'SELECT vehicle, lat, speedKmHr FROM vehicle_locations ORDER BY id LIMIT 1')[0]
+        self.assertEqual(('1434', 37.7425, 26), (vehicle, lat, speed))
+        self.assertEqual([('wal',)], self.query(emitter, 'PRAGMA journal_mode'))
+
+        indexes = {index['name'] for index in inspect(emitter.engine).get_indexes('predictions')}
+        self.assertIn('ix_predictions_route_stop_time', indexes)
+        emitter.close()
+
+    def test_compact_records(self):
+        prediction_result = utils.load_json_fixture('multiprediction.json')
+        emitter = DatabaseEmitter('sqlite:///' + self.path)
+        for record in parse_prediction_points_compact(prediction_result):
+            emitter.emit(record)
+        emitter.close()
+
+        emitter = DatabaseEmitter(self.path)
+        expected = parse_prediction_points(prediction_result)[0]
+        row = self.query(emitter, 'SELECT routeTag, stopTag, epochTime, isDeparture FROM predictions ORDER BY id')[0]
+        self.assertEqual(
+            (expected['routeTag'], expected['stopTag'], expected['epochTime'], expected['isDeparture']), tuple(row))
+        emitter.close()
+
+    def test_unknown_record_type(self):
+        emitter = DatabaseEmitter(self.path)
+        with self.assertRaises(ValueError):
+            emitter.emit({'type': 'tombstone'})
+        emitter.close()
+
+    def test_concurrent_table_creation(self):
+        # As when collect workers share a database, and start at the same time
+        with ProcessPoolExecutor(max_workers=8) as pool:
+            for trial in range(3):
+                path = os.path.join(self.tmpdir, 'observations-{}.db'.format(trial))
+                for future in [pool.submit(open_emitter, path) for _ in range(8)]:
+                    future.result()
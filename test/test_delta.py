@@ -0,0 +1,82 @@
+import copy
+import unittest
+
+from munificent.collect import parse_prediction_points_compact, parse_vehicle_locations
+from munificent.delta import ChangeTracker
+
+from . import utils
+
+
+class TestChangeTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.locations = utils.load_json_fixture('vehicle-locations.json')
+
+    def tracker(self, **kwargs):
+        kwargs.setdefault('keyframe_interval', 600)
+        return ChangeTracker('locations:L', clock=lambda: self.now, **kwargs)
+
+    def diff(self, tracker, result):
+        result = copy.deepcopy(result)
+        return list(tracker.diff(parse_vehicle_locations(result), result['_meta']))
+
+    def test_first_result_is_keyframe(self):
+        records = self.diff(self.tracker(), self.locations)
+        self.assertEqual('keyframe', records[0]['type'])
+        self.assertEqual(11, records[0]['records'])
+        self.assertEqual(12, len(records))
+
+    def test_unchanged_records_not_emitted(self):
+        tracker = self.tracker()
+        self.diff(tracker, self.locations)
+        self.now += 10
+        moved = copy.deepcopy(self.locations)
+        moved['vehicle'][0]['lat'] = '37.75'
+        for vehicle in moved['vehicle']:
+            vehicle['secsSinceReport'] = '1'
+        records = self.diff(tracker, moved)
+        self.assertEqual([('vehicle_location', '1434')], [(r['type'], r['vehicle']) for r in records])
+
+    def test_disappeared_records_tombstoned(self):
+        tracker = self.tracker()
+        self.diff(tracker, self.locations)
+        fewer = copy.deepcopy(self.locations)
+        gone = fewer['vehicle'].pop()
+        records = self.diff(tracker, fewer)
+        self.assertEqual(1, len(records))
+        self.assertEqual('tombstone', records[0]['type'])
+        self.assertEqual('vehicle_location', records[0]['record_type'])
+        self.assertEqual(gone['id'], records[0]['vehicle'])
+
+    def test_partial_results_expire_by_ttl(self):
+        tracker = self.tracker(partial=True, ttl=60)
+        self.diff(tracker, self.locations)
+        one = copy.deepcopy(self.locations)
+        one['vehicle'] = one['vehicle'][:1]
+        self.now += 30
+        self.assertEqual([], self.diff(tracker, one))
+        self.now += 31
+        records = self.diff(tracker, one)
+        self.assertEqual(10, len([r for r in records if r['type'] == 'tombstone']))
+
+    def test_max_entries_evicts_least_recently_seen(self):
+        tracker = self.tracker(partial=True, max_entries=5)
+        records = self.diff(tracker, self.locations)
+        self.assertEqual(6, len([r for r in records if r['type'] == 'tombstone']))
+        self.assertEqual(5, records[6]['records'])
+
+    def test_periodic_keyframe_has_full_state(self):
+        tracker = self.tracker()
+        self.diff(tracker, self.locations)
+        self.now += 600
+        records = self.diff(tracker, self.locations)
+        self.assertEqual('keyframe', records[0]['type'])
+        self.assertEqual(11, len(records[1:]))
+
+    def test_compact_prediction_records(self):
+        predictions = utils.load_json_fixture('multiprediction.json')
+        tracker = self.tracker()
+        records = list(tracker.diff(parse_prediction_points_compact(predictions), predictions['_meta']))
+        self.assertEqual(records[0]['records'], len(records) - 1)
+        self.assertEqual([], list(tracker.diff(parse_prediction_points_compact(predictions), predictions['_meta'])))
@@ -1,7 +1,20 @@
+import gzip
+import json
+import os
+import shutil
 import tempfile
 import unittest
 
-from munificent.io import Emitter, open_file_gzip, open_file_normal
+from munificent.io import (
+    METADATA_SUFFIX, BufferedEmitter, Emitter, RecordFilter, RotatingFile, iter_output_files, open_file_gzip,
+    open_file_normal, open_file_rotating, output_order, read_file, read_metadata,
+)
+from munificent.io import read_records as read_output
+
+
+def read_records(path, opener=open):
+    with opener(path, 'rb') as f:
+        return [json.loads(line.decode('utf-8')) for line in f]
 
 
 class TestFileOpeners(unittest.TestCase):
@@ -19,3 +32,256 @@ class TestFileOpeners(unittest.TestCase):
             emitter = Emitter(opener)
             emitter.emit({'foo': 'bar', 'baz': 72})
             emitter.flush()
+
+
+class TestEmitter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'output.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_request_flush_reopens_before_next_record(self):
+        emitter = Emitter(open_file_normal(self.path))
+        emitter.emit({'n': 1})
+        os.rename(self.path, self.path + '.1')
+        emitter.request_flush()
+        emitter.emit({'n': 2})
+        emitter.close()
+        self.assertEqual([{'n': 1}], read_records(self.path + '.1'))
+        self.assertEqual([{'n': 2}], read_records(self.path))
+
+
+class TestBufferedEmitter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'output.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_records_written_in_order(self):
+        emitter = BufferedEmitter(open_file_gzip(self.path), batch_size=7, max_queue=5)
+        records = [{'n': n, 'text': u'é'} for n in range(100)]
+        for record in records:
+            emitter.emit(record)
+        emitter.close()
+        self.assertEqual(records, read_records(self.path, gzip.open))
+
+    def test_flush_drains_queue(self):
+        emitter = BufferedEmitter(open_file_normal(self.path), batch_size=1000, flush_interval=60)
+        for n in range(10):
+            emitter.emit({'n': n})
+        emitter.flush()
+        self.assertEqual(10, len(read_records(self.path)))
+        emitter.emit({'n': 10})
+        emitter.close()
+        self.assertEqual(11, len(read_records(self.path)))
+
+    def test_writer_errors_are_reraised(self):
+        def failing_opener(mode):
+            raise IOError('disk full')
+
+        emitter = BufferedEmitter(failing_opener)
+        emitter.emit({'n': 1})
+        with self.assertRaises(IOError):
+            emitter.flush()
+        emitter.close()
+
+
+class TestRotatingFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = 1550534400.0  # 2019-02-19 00:00:00 UTC
+        self.template = os.path.join(self.tmpdir, '{target}-{YYYYMMDDHH}.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def rotating_file(self, **kwargs):
+        kwargs.setdefault('fields', {'target': 'trains'})
+        return RotatingFile(self.template, clock=lambda: self.now, **kwargs)
+
+    def test_file_renamed_into_place_on_close(self):
+        f = self.rotating_file()
+        f.write(b'{}\n')
+        self.assertEqual(1, len(os.listdir(self.tmpdir)))
+        self.assertTrue(os.listdir(self.tmpdir)[0].startswith('.trains-2019021900.jsonl'))
+        f.close()
+        self.assertEqual(['trains-2019021900.jsonl'], os.listdir(self.tmpdir))
+
+    def test_rotates_on_interval(self):
+        f = self.rotating_file(interval=3600)
+        f.write(b'1\n')
+        self.now += 3599
+        f.write(b'2\n')
+        self.now += 1
+        f.write(b'3\n')
+        f.close()
+        self.assertEqual(['trains-2019021900.jsonl', 'trains-2019021901.jsonl'], sorted(os.listdir(self.tmpdir)))
+        with open(os.path.join(self.tmpdir, 'trains-2019021900.jsonl'), 'rb') as hour:
+            self.assertEqual(b'1\n2\n', hour.read())
+
+    def test_rotates_on_size_with_unique_names(self):
+        f = self.rotating_file(max_bytes=4)
+        for n in range(5):
+            f.write('{}\n'.format(n).encode('utf-8'))
+        f.close()
+        expected = ['trains-2019021900-1.jsonl', 'trains-2019021900-2.jsonl', 'trains-2019021900.jsonl']
+        self.assertEqual(expected, sorted(os.listdir(self.tmpdir)))
+
+    def test_output_order(self):
+        for n in range(12):
+            f = self.rotating_file()
+            f.write('{}\n'.format(n).encode('utf-8'))
+            f.close()
+        self.now += 3600
+        f = self.rotating_file()
+        f.write(b'12\n')
+        f.close()
+        contents = []
+        for path in iter_output_files([self.tmpdir]):
+            with open(path, 'rb') as f:
+                contents.append(int(f.read()))
+        self.assertEqual(list(range(13)), contents)
+        self.assertLess(output_order('trains.jsonl.gz'), output_order('trains-1.jsonl'))
+
+    def test_recovers_leftover_temporary_files(self):
+        # Left by a process that died, and by one still writing
+        dead = os.path.join(self.tmpdir, '.trains-2019021900.jsonl.99999999.tmp')
+        live = os.path.join(self.tmpdir, '.trains-2019021900.jsonl.{}.tmp'.format(os.getppid()))
+        with open(dead, 'wb') as f:
+            f.write(b'{"n": 0}\n{"n": 1')
+        with open(live, 'wb') as f:
+            f.write(b'{"n": 2}\n')
+        f = self.rotating_file()
+        f.write(b'{"n": 3}\n')
+        f.close()
+        self.assertFalse(os.path.exists(dead))
+        self.assertTrue(os.path.exists(live))
+        self.assertEqual([0, 3], [r['n'] for r in read_output([self.tmpdir])])
+
+    def test_emitter_with_compressed_rotation(self):
+        template = os.path.join(self.tmpdir, 'shards', '{target}-{YYYYMMDD}.jsonl.gz')
+        emitter = Emitter(open_file_rotating(template, compress=True, max_bytes=1, target='trains'))
+        emitter.emit({'n': 1})
+        emitter.emit({'n': 2})
+        emitter.close()
+        filenames = os.listdir(os.path.join(self.tmpdir, 'shards'))
+        shards = sorted(filename for filename in filenames if not filename.endswith(METADATA_SUFFIX))
+        self.assertEqual(2, len(shards))
+        self.assertEqual(4, len(filenames))
+        records = [r for shard in shards for r in read_records(os.path.join(self.tmpdir, 'shards', shard), gzip.open)]
+        self.assertEqual([1, 2], sorted(r['n'] for r in records))
+
+
+def record(n, route='N', record_type='prediction'):
+    return {'type': record_type, 'request_timestamp': 1000 + n, 'routeTag': route, 'stopTag': str(n % 3),
+            'vehicle': str(n % 5), 'n': n}
+
+
+class TestReadRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = 1550534400
+        self.records = [record(n, route='NJ'[n % 2]) for n in range(600)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_shards(self, compress=True, **kwargs):
+        template = os.path.join(self.tmpdir, 'w{worker}', 'out-{YYYYMMDDHH}.jsonl' + ('.gz' if compress else ''))
+        for worker in (1, 2):
+            emitter = Emitter(lambda mode, worker=worker: RotatingFile(
+                template, compress=compress, fields={'worker': worker}, clock=lambda: self.now, **kwargs))
+            for i in range(0, len(self.records), 50):
+                emitter._write_records(self.records[i:i + 50])
+            emitter.close()
+        return sorted(iter_output_files([self.tmpdir]))
+
+    def test_metadata_sidecar(self):
+        paths = self.write_shards(block_size=2000)
+        self.assertEqual(2, len(paths))
+        metadata = read_metadata(paths[0])
+        self.assertEqual((600, 1000, 1599), (metadata.records, metadata.min_timestamp, metadata.max_timestamp))
+        self.assertEqual(({'prediction'}, {'N', 'J'}), (metadata.types, metadata.routes))
+        self.assertGreater(len(metadata.blocks), 1)
+        self.assertEqual(600, sum(block.records for block in metadata.blocks))
+        self.assertEqual(os.path.getsize(paths[0]), sum(block.length for block in metadata.blocks))
+
+    def test_untracked_writes_have_no_metadata(self):
+        f = RotatingFile(os.path.join(self.tmpdir, 'out.jsonl'))
+        f.write(b'{}\n')
+        f.close()
+        self.assertEqual(['out.jsonl'], os.listdir(self.tmpdir))
+
+    def test_filters(self):
+        self.write_shards(block_size=2000)
+        found = list(read_output([self.tmpdir], routes=['J'], stops=['1'], start=1100, end=1200))
+        expected = [
+            r for r in self.records
+            if r['routeTag'] == 'J' and r['stopTag'] == '1' and 1100 <= r['request_timestamp'] < 1200
+        ]
+        self.assertEqual(expected * 2, found)
+        self.assertEqual([], list(read_output([self.tmpdir], types=['vehicle_location'])))
+        self.assertEqual(2 * 240, len(list(read_output([self.tmpdir], vehicles=['0', '1']))))
+
+    def test_skips_blocks_by_metadata(self):
+        path = self.write_shards(compress=False, block_size=2000)[0]
+        metadata = read_metadata(path)
+        # Corrupt every block but the one with the timestamps asked for
+        wanted = [block for block in metadata.blocks if block.min_timestamp <= 1300 <= block.max_timestamp][0]
+        with open(path, 'r+b') as f:
+            for block in metadata.blocks:
+                if block is not wanted:
+                    f.seek(block.offset)
+                    f.write(b'x' * block.length)
+        found = list(read_file(path, RecordFilter(start=1300, end=1301)))
+        self.assertEqual([self.records[300]], found)
+
+    def test_files_without_metadata(self):
+        path = os.path.join(self.tmpdir, 'output.jsonl.gz')
+        emitter = Emitter(open_file_gzip(path))
+        for r in self.records:
+            emitter.emit(r)
+        emitter.close()
+        self.assertEqual([1, 4, 7], [r['n'] for r in read_output([path], stops=['1'], end=1010)])
+
+    def test_non_ascii_filters(self):
+        for r in self.records[:10]:
+            r['routeTag'] = u'\u00d1'
+        paths = self.write_shards(compress=False)
+        with open(paths[0], 'rb') as f:
+            self.assertIn(u'"\u00d1"'.encode('utf-8'), f.read())
+        for workers in (1, 2):
+            found = list(read_output([self.tmpdir], routes=[u'\u00d1'], workers=workers))
+            self.assertEqual(self.records[:10] * 2, found)
+
+    def test_truncated_compressed_file(self):
+        path = os.path.join(self.tmpdir, 'output.jsonl.gz')
+        with gzip.open(path, 'wb') as f:
+            f.writelines(json.dumps(r).encode('utf-8') + b'\n' for r in self.records)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 20)
+        found = list(read_output([path]))
+        self.assertGreater(len(found), 0)
+        self.assertEqual(self.records[:len(found)], found)
+
+    def test_undecodable_lines(self):
+        path = os.path.join(self.tmpdir, 'output.jsonl')
+        lines = [json.dumps(r).encode('utf-8') for r in self.records[:3]]
+        with open(path, 'wb') as f:
+            f.write(b'\n'.join([lines[0], b'\xff{"n": 1}', lines[1], b'{"type": "prediction"', lines[2][:-5]]))
+        self.assertEqual(self.records[:2], list(read_output([path])))
+
+    def test_process_pool(self):
+        self.write_shards(compress=False, max_bytes=3000)
+        self.assertGreater(len(list(iter_output_files([self.tmpdir]))), 4)
+        found = list(read_output([self.tmpdir], routes=['N'], workers=2))
+        self.assertEqual(600, len(found))
+        self.assertEqual(found, list(read_output([self.tmpdir], routes=['N'])))
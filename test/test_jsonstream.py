@@ -0,0 +1,62 @@
+import json
+import os
+import unittest
+
+from munificent.collect import iter_prediction_points, parse_prediction_points
+from munificent.jsonstream import stream_object
+
+from . import utils
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def fixture_bytes(relpath):
+    with open(os.path.join(utils.TEST_DATA_ROOT, relpath), 'rb') as f:
+        return f.read()
+
+
+class TestStreamObject(unittest.TestCase):
+
+    def test_fixtures_decode_identically(self):
+        for relpath, item_key in [('multiprediction.json', 'predictions'), ('vehicle-locations.json', 'vehicle')]:
+            data = fixture_bytes(relpath)
+            for size in [97, 4096]:
+                result = stream_object(chunked(data, size), item_key)
+                result[item_key] = list(result[item_key])
+                self.assertEqual(json.loads(data.decode('utf-8')), result)
+
+    def test_members_after_items_filled_in_when_exhausted(self):
+        result = stream_object([b'{"a": 1, "items": [{"n": 1}, {"n": 2}], "lastTime": 12345}'], 'items')
+        self.assertEqual(1, result['a'])
+        self.assertNotIn('lastTime', result)
+        self.assertEqual([{'n': 1}, {'n': 2}], list(result['items']))
+        self.assertEqual(12345, result['lastTime'])
+
+    def test_items_decoded_lazily(self):
+        chunks = iter(chunked(b'{"items": [1, 2, {"broken": ', 4))
+        items = stream_object(chunks, 'items')['items']
+        self.assertEqual(1, next(items))
+        self.assertEqual(2, next(items))
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_single_object_item(self):
+        result = stream_object([b'{"items": {"n": 1}}'], 'items')
+        self.assertEqual([{'n': 1}], list(result['items']))
+
+    def test_missing_item_key(self):
+        result = stream_object([b'{"Error": {"content": "No route"}}'], 'items')
+        self.assertEqual({'Error': {'content': 'No route'}}, result)
+
+    def test_multibyte_characters_split_across_chunks(self):
+        data = u'{"items": ["été", "café"]}'.encode('utf-8')
+        self.assertEqual([u'été', u'café'], list(stream_object(chunked(data, 1), 'items')['items']))
+
+    def test_streamed_predictions_parse_identically(self):
+        data = fixture_bytes('multiprediction.json')
+        streamed = stream_object(chunked(data, 512), 'predictions')
+        streamed['_meta'] = utils.load_json_fixture('multiprediction.json')['_meta']
+        self.assertEqual(parse_prediction_points(json.loads(data.decode('utf-8'))),
+                         list(iter_prediction_points(streamed)))
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib2 import urlopen
+
+from munificent import metrics
+from munificent.collect import Collector
+from munificent.metrics import Registry, StatsFileWriter, serve_metrics
+
+from .test_collect import FakeProbe, ListEmitter
+
+
+class FailingProbe(FakeProbe):
+
+    def collect(self, **request_args):
+        raise RuntimeError("Request failed")
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('requests_total', 'Requests', ['command'])
+        counter.inc(command='predictions')
+        counter.inc(2, command='predictions')
+        self.assertEqual(3, counter.value(command='predictions'))
+        self.assertIn('requests_total{command="predictions"} 3', self.registry.render())
+        with self.assertRaises(ValueError):
+            counter.inc(route='N')
+
+    def test_gauge_function(self):
+        depth = [5]
+        gauge = self.registry.gauge('queue_depth', 'Queue depth')
+        gauge.set_function(lambda: depth[0])
+        depth[0] = 7
+        self.assertIn('queue_depth 7', self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency', ['probe'], buckets=(0.1, 1))
+        for value in [0.05, 0.5, 0.5, 5]:
+            histogram.observe(value, probe='a"b')
+        rendered = self.registry.render()
+        self.assertIn('# TYPE latency_seconds histogram', rendered)
+        self.assertIn('latency_seconds_bucket{probe="a\\"b",le="0.1"} 1', rendered)
+        self.assertIn('latency_seconds_bucket{probe="a\\"b",le="1"} 3', rendered)
+        self.assertIn('latency_seconds_bucket{probe="a\\"b",le="+Inf"} 4', rendered)
+        self.assertIn('latency_seconds_count{probe="a\\"b"} 4', rendered)
+        self.assertIn('latency_seconds_sum{probe="a\\"b"} 6.05', rendered)
+
+
+class TestExposition(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.counter('cycles_total', 'Cycles').inc()
+
+    def test_http_endpoint(self):
+        server = serve_metrics(0, registry=self.registry)
+        try:
+            response = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+            self.assertIn(b'cycles_total 1', response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_stats_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'munificent.prom')
+            StatsFileWriter(path, interval=60, registry=self.registry).start().stop()
+            with open(path) as f:
+                self.assertIn('cycles_total 1', f.read())
+            self.assertEqual(['munificent.prom'], os.listdir(tmp_dir))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestCollectorMetrics(unittest.TestCase):
+
+    def test_records_and_errors_counted(self):
+        records = metrics.PROBE_RECORDS.value(probe='metrics-ok')
+        errors = metrics.PROBE_ERRORS.value(probe='metrics-failing')
+        cycles = metrics.CYCLES.value()
+        probes = [FakeProbe('metrics-ok', records=3), FailingProbe('metrics-failing')]
+        Collector(probes, ListEmitter(), period=0.05).run(cycles=2)
+        self.assertEqual(records + 6, metrics.PROBE_RECORDS.value(probe='metrics-ok'))
+        self.assertEqual(errors + 2, metrics.PROBE_ERRORS.value(probe='metrics-failing'))
+        self.assertEqual(cycles + 2, metrics.CYCLES.value())
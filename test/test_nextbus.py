@@ -0,0 +1,301 @@
+import io
+import json
+import threading
+import unittest
+
+import requests
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from munificent.collect import CollectionProbe, iter_prediction_points, iter_vehicle_locations, parse_vehicle_locations
+from munificent.delta import ChangeTracker
+from munificent.nextbus import (
+    BatchedRequest, JitteredRetry, NextBusAPI, NextBusAPIRequestBuilder, ResponseCache, build_session,
+)
+
+from . import utils
+
+
+def fixture_response(relpath, status_code=200, headers=None):
+    res = requests.Response()
+    res.status_code = status_code
+    res.headers.update(headers or {})
+    with open(utils.TEST_DATA_ROOT + '/' + relpath, 'rb') as f:
+        res.raw = io.BytesIO(f.read())
+    return res
+
+
+def json_response(content):
+    res = requests.Response()
+    res.status_code = 200
+    res.raw = io.BytesIO(json.dumps(content).encode('utf-8'))
+    return res
+
+
+class FakeSession(requests.Session):
+
+    def __init__(self, responses):
+        super(FakeSession, self).__init__()
+        self.responses = list(responses)
+        self.sent = []
+
+    def send(self, prepared, **kwargs):
+        self.sent.append((prepared, kwargs))
+        return self.responses.pop(0)
+
+
+class HeaderRecordingServer(object):
+    '''
+    A local HTTP server that answers every GET with an empty JSON object and keeps the
+    headers of each request it receives.
+    '''
+
+    def __init__(self):
+        self.received = []
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                recorder.received.append(dict(self.headers.items()))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = HTTPServer(('127.0.0.1', 0), Handler)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/service/publicJSONFeed'.format(self._server.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestNextBusAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.api = NextBusAPI()
+        self.request = NextBusAPIRequestBuilder().get_vehicle_locations('sf-muni', 'L')
+
+    def test_perform_request_adds_meta(self):
+        self.api.session = FakeSession([fixture_response('vehicle-locations.json')])
+        result = self.api.perform_request(self.request)
+        self.assertEqual(11, len(result['vehicle']))
+        self.assertEqual({'timestamp', 'request_id'}, set(result['_meta']))
+
+    def test_stream_request(self):
+        self.api.session = FakeSession([fixture_response('vehicle-locations.json')])
+        result = self.api.stream_request(self.request, timeout=5)
+        self.assertEqual({'stream': True, 'timeout': 5}, self.api.session.sent[0][1])
+        self.assertEqual(11, len(list(iter_vehicle_locations(result))))
+        self.assertEqual({'time': '1550534597015'}, result['lastTime'])
+
+    def test_command_timeouts(self):
+        self.api = NextBusAPI(timeout=(1, 2), command_timeouts={'vehicleLocations': (3, 4)})
+        self.api.session = FakeSession([fixture_response('vehicle-locations.json') for _ in range(2)])
+        self.api.perform_request(self.request)
+        self.api.perform_request(NextBusAPIRequestBuilder().list_agencies())
+        self.assertEqual([(3, 4), (1, 2)], [kwargs['timeout'] for _, kwargs in self.api.session.sent])
+
+
+class TestTransport(unittest.TestCase):
+
+    def test_build_session(self):
+        session = build_session(pool_size=8, retries=3, accept_encoding='gzip')
+        adapter = session.get_adapter('http://webservices.nextbus.com/')
+        self.assertEqual(8, adapter._pool_maxsize)
+        self.assertIsInstance(adapter.max_retries, JitteredRetry)
+        self.assertEqual(3, adapter.max_retries.total)
+        self.assertEqual('gzip', session.headers['Accept-Encoding'])
+
+    def test_session_headers_sent(self):
+        server = HeaderRecordingServer().start()
+        try:
+            for response_cache in (None, ResponseCache()):
+                api = NextBusAPI(
+                    json_feed_url=server.url, response_cache=response_cache, session=build_session(retries=0))
+                request = api.request_builder.get_vehicle_locations('sf-muni', 'L')
+                api.perform_request(request)
+                api.stream_request(request)
+        finally:
+            server.stop()
+        self.assertEqual(['gzip, deflate'] * 4, [headers.get('Accept-Encoding') for headers in server.received])
+
+    def test_jittered_backoff(self):
+        retry = JitteredRetry(total=5, backoff_factor=1)
+        for _ in range(3):
+            retry = retry.increment(method='GET', url='/')
+        self.assertIsInstance(retry, JitteredRetry)
+        for _ in range(20):
+            self.assertTrue(0 <= retry.get_backoff_time() <= 4)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(incremental_locations=True)
+        self.api = NextBusAPI(response_cache=self.cache)
+        self.request = NextBusAPIRequestBuilder().get_vehicle_locations('sf-muni', 'L')
+
+    def test_duplicate_bodies_skipped(self):
+        self.api.session = FakeSession([fixture_response('vehicle-locations.json') for _ in range(2)])
+        self.assertIsNotNone(self.api.perform_request(self.request))
+        self.assertIsNone(self.api.perform_request(self.request))
+        self.assertEqual(1, self.cache.duplicates_skipped)
+
+    def test_validators_sent_and_not_modified_skipped(self):
+        self.api.session = FakeSession([
+            fixture_response('vehicle-locations.json', headers={'ETag': '"abc"'}),
+            fixture_response('vehicle-locations.json', status_code=304),
+        ])
+        self.api.perform_request(self.request)
+        self.assertIsNone(self.api.perform_request(self.request))
+        self.assertEqual('"abc"', self.api.session.sent[1][0].headers['If-None-Match'])
+        self.assertEqual(1, self.cache.not_modified)
+
+    def test_undecodable_response_not_remembered(self):
+        torn = fixture_response('vehicle-locations.json', headers={'ETag': '"abc"'})
+        torn.raw = io.BytesIO(torn.raw.read()[:100])
+        self.api.session = FakeSession([torn, fixture_response('vehicle-locations.json', headers={'ETag': '"abc"'})])
+        with self.assertRaises(ValueError):
+            self.api.perform_request(self.request)
+        self.assertIsNotNone(self.api.perform_request(self.request))
+        self.assertNotIn('If-None-Match', self.api.session.sent[1][0].headers)
+
+    def test_unparsed_response_not_skipped(self):
+        results = []
+
+        def parser(result):
+            results.append(result)
+            if len(results) == 1:
+                raise KeyError('vehicle')
+            return parse_vehicle_locations(result)
+
+        def iter_parser(result):
+            # Fails part way through the streamed records
+            for i, record in enumerate(iter_vehicle_locations(result)):
+                if i == 5 and not results:
+                    results.append(result)
+                    raise KeyError('vehicle')
+                yield record
+
+        for stream, record_parser in ((False, parser), (True, iter_parser)):
+            del results[:]
+            self.api.session = FakeSession([fixture_response('vehicle-locations.json') for _ in range(2)])
+            probe = CollectionProbe(self.api, self.request, record_parser, stream=stream)
+            with self.assertRaises(KeyError):
+                list(probe.collect())
+            self.assertEqual(11, len(list(probe.collect())))
+            self.assertIn('t=0', self.api.session.sent[1][0].url)
+
+    def test_keyframes_while_unchanged(self):
+        now = [1000.0]
+        tracker = ChangeTracker('locations:L', keyframe_interval=600, clock=lambda: now[0])
+        self.api.session = FakeSession([fixture_response('vehicle-locations.json') for _ in range(3)])
+        probe = CollectionProbe(self.api, self.request, parse_vehicle_locations, tracker=tracker)
+        self.assertEqual('keyframe', list(probe.collect())[0]['type'])
+        now[0] += 10
+        self.assertEqual([], list(probe.collect()))
+        now[0] += 600
+        records = list(probe.collect())
+        self.assertEqual(2, self.cache.duplicates_skipped)
+        self.assertEqual(['keyframe'] + ['vehicle_location'] * 11, [r['type'] for r in records])
+        self.assertEqual(11, records[0]['records'])
+
+    def test_incremental_vehicle_locations(self):
+        self.api.session = FakeSession([fixture_response('vehicle-locations.json') for _ in range(2)])
+        self.api.perform_request(self.request)
+        self.api.perform_request(self.request)
+        first, second = [prepared.url for prepared, _ in self.api.session.sent]
+        self.assertIn('t=0', first)
+        self.assertIn('t=1550534597015', second)
+        self.assertEqual(0, self.request.params['t'])
+
+
+class TestBatchedRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache()
+        self.api = NextBusAPI(response_cache=self.cache, batch_concurrency=1)
+        stops = ['N|{}'.format(i) for i in range(5)]
+        self.request = NextBusAPIRequestBuilder().get_batched_multistop_predictions('sf-muni', stops, 2)
+
+    def test_split_into_batches(self):
+        self.assertIsInstance(self.request, BatchedRequest)
+        self.assertEqual([['N|0', 'N|1'], ['N|2', 'N|3'], ['N|4']], [r.params['stops'] for r in self.request.requests])
+        self.assertEqual('predictionsForMultiStops', self.request.params['command'])
+
+        small = NextBusAPIRequestBuilder().get_batched_multistop_predictions('sf-muni', ['N|0', 'N|1'], 2)
+        self.assertNotIsInstance(small, BatchedRequest)
+
+    def test_results_merged(self):
+        self.api.session = FakeSession([fixture_response('multiprediction.json') for _ in range(3)])
+        result = self.api.perform_request(self.request, timeout=5)
+        self.assertEqual(3, len(self.api.session.sent))
+        self.assertEqual({'timeout': 5}, self.api.session.sent[0][1])
+        self.assertEqual(3 * 59, len(result['predictions']))
+        self.assertEqual({'timestamp', 'request_id'}, set(result['_meta']))
+        request_ids = set(p['request_id'] for p in iter_prediction_points(result))
+        self.assertEqual({result['_meta']['request_id']}, request_ids)
+
+    def test_unchanged_batches_filled_from_previous_result(self):
+        self.api.session = FakeSession([json_response({'predictions': [{'stopTag': str(i)}]}) for i in range(3)])
+        self.api.perform_request(self.request)
+        self.api.session = FakeSession([json_response({'predictions': [{'stopTag': str(i)}]}) for i in range(3)])
+        self.assertIsNone(self.api.perform_request(self.request))
+
+        self.api.session = FakeSession([
+            json_response({'predictions': [{'stopTag': '0'}]}),
+            json_response({'predictions': [{'stopTag': '1'}, {'stopTag': '5'}]}),
+            json_response({'predictions': [{'stopTag': '2'}]}),
+        ])
+        result = self.api.perform_request(self.request)
+        self.assertEqual(['0', '1', '5', '2'], [p['stopTag'] for p in result['predictions']])
+
+    def test_unchanged_batch_after_partial_failure(self):
+        failed = requests.Response()
+        failed.status_code = 503
+        failed.raw = io.BytesIO(b'')
+        self.api.session = FakeSession([
+            json_response({'predictions': [{'stopTag': '0'}]}),
+            failed,
+            json_response({'predictions': [{'stopTag': '2'}]}),
+        ])
+        with self.assertRaises(requests.HTTPError):
+            self.api.perform_request(self.request)
+
+        self.api.session = FakeSession([json_response({'predictions': [{'stopTag': str(i)}]}) for i in range(3)])
+        result = self.api.perform_request(self.request)
+        self.assertEqual(['0', '1', '2'], [p['stopTag'] for p in result['predictions']])
+
+    def test_unchanged_batch_without_previous_result_refetched(self):
+        self.api.session = FakeSession([json_response({'predictions': [{'stopTag': str(i)}]}) for i in range(3)])
+        self.api.perform_request(self.request)
+        rebuilt = BatchedRequest(self.request.requests, self.request.item_key)
+        # Each unchanged sub-request is fetched again, bypassing the cache
+        self.api.session = FakeSession([json_response({'predictions': [{'stopTag': str(i // 2)}]}) for i in range(6)])
+        result = self.api.perform_request(rebuilt)
+        self.assertEqual(6, len(self.api.session.sent))
+        self.assertEqual(['0', '1', '2'], [p['stopTag'] for p in result['predictions']])
+
+    def test_stream_batches(self):
+        self.api.session = FakeSession([fixture_response('multiprediction.json') for _ in range(3)])
+        result = self.api.stream_request(self.request)
+        self.assertEqual(3 * 59, len(list(result['predictions'])))
+        self.assertIn('copyright', result)
@@ -0,0 +1,59 @@
+import os
+import pstats
+import re
+import shutil
+import tempfile
+import unittest
+
+from munificent import profiling
+from munificent.collect import Collector
+from munificent.profiling import CollectionProfiler
+
+from .test_collect import FakeProbe, ListEmitter
+
+
+class StagedProbe(FakeProbe):
+
+    def collect(self, **request_args):
+        with profiling.stage('parse'):
+            return super(StagedProbe, self).collect(**request_args)
+
+
+class TestCollectionProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.profiler = CollectionProfiler(os.path.join(self.tmp_dir, 'profile-{YYYYMMDD}'), cycles=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_collector(self, cycles, concurrency=1):
+        probes = [StagedProbe('predictions:N'), StagedProbe('locations:N')]
+        Collector(probes, ListEmitter(), period=0.1, concurrency=concurrency, profiler=self.profiler).run(cycles)
+
+    def test_idle_until_started(self):
+        self.run_collector(cycles=1)
+        self.assertEqual([], self.profiler.reports)
+        self.assertIs(profiling._NULL_TIMER, profiling.stage('parse'))
+
+    def test_profile_written_after_cycles(self):
+        self.profiler.start()
+        self.run_collector(cycles=3)
+        self.assertEqual(1, len(self.profiler.reports))
+        self.assertFalse(self.profiler.active)
+
+        with open(self.profiler.reports[0]) as f:
+            summary = f.read()
+        self.assertIn('Profile of 2 collection cycles', summary)
+        self.assertTrue(re.search(r'predictions:N\s+parse\s+2 ', summary))
+
+        base = self.profiler.reports[0][:-len('.txt')]
+        stats = pstats.Stats(base + '.predictions_N.pstats')
+        self.assertTrue(any(name == 'collect' for _, _, name in stats.stats))
+
+    def test_concurrent_probes_profiled(self):
+        self.profiler.start()
+        self.run_collector(cycles=2, concurrency=2)
+        self.assertEqual(1, len(self.profiler.reports))
+        self.assertEqual(3, len(os.listdir(self.tmp_dir)))
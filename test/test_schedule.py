@@ -0,0 +1,102 @@
+import itertools
+import unittest
+
+from munificent.schedule import PhasedScheduler
+
+
+class FakeClock(object):
+
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def run_ticks(scheduler, clock, slots, cycles, work=None):
+    '''
+    Drain a scheduler's ticks, advancing the fake clock by `work(tick)` seconds after
+    each one to simulate the time spent running a probe.
+    '''
+    ticks = []
+    for tick in scheduler.ticks(slots, cycles):
+        ticks.append(tick)
+        clock.now += work(tick) if work else 0.0
+    return ticks
+
+
+class TestPhasedScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def scheduler(self, **kwargs):
+        return PhasedScheduler(10.0, clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def test_slots_have_fixed_phase(self):
+        ticks = run_ticks(self.scheduler(), self.clock, slots=2, cycles=2, work=lambda t: 1.5)
+        self.assertEqual([0.0, 5.0, 10.0, 15.0], [t.scheduled - 100.0 for t in ticks])
+        self.assertEqual([(0, 0), (0, 1), (1, 0), (1, 1)], [(t.cycle, t.slot) for t in ticks])
+        self.assertEqual([0.0] * 4, [t.lag for t in ticks])
+
+    def test_no_drift_over_many_cycles(self):
+        scheduler = self.scheduler()
+        work = itertools.cycle([0.3, 4.9, 0.0, 2.2])
+        ticks = run_ticks(scheduler, self.clock, slots=3, cycles=1000, work=lambda t: next(work))
+        self.assertAlmostEqual(100.0 + 999 * 10.0 + 2 * 10.0 / 3, ticks[-1].scheduled)
+        self.assertEqual(3000, scheduler.ticks_fired)
+        self.assertEqual(0, scheduler.overruns)
+
+    def test_late_tick_records_lag(self):
+        scheduler = self.scheduler()
+        ticks = run_ticks(scheduler, self.clock, slots=2, cycles=1, work=lambda t: 6.5 if t.slot == 0 else 0)
+        self.assertAlmostEqual(1.5, ticks[1].lag)
+        self.assertAlmostEqual(1.5, scheduler.max_lag)
+        self.assertEqual(0, scheduler.overruns)
+
+    def test_skip_drops_missed_ticks(self):
+        scheduler = self.scheduler()
+        work = {(0, 0): 17.0}
+        ticks = run_ticks(scheduler, self.clock, slots=2, cycles=2, work=lambda t: work.get((t.cycle, t.slot), 0))
+        self.assertEqual([(0, 0), (0, 1), (1, 1)], [(t.cycle, t.slot) for t in ticks])
+        self.assertAlmostEqual(12.0, ticks[1].lag)
+        self.assertEqual(115.0, ticks[2].scheduled)
+        self.assertEqual(1, scheduler.overruns)
+        self.assertEqual(1, scheduler.ticks_skipped)
+
+    def test_skip_fires_tick_after_slow_slot(self):
+        # The first slot always overruns the next one's start, but never its own cycle
+        scheduler = self.scheduler()
+        ticks = run_ticks(scheduler, self.clock, slots=3, cycles=3, work=lambda t: 7.0 if t.slot == 0 else 0)
+        self.assertEqual([(c, s) for c in range(3) for s in range(3)], [(t.cycle, t.slot) for t in ticks])
+        self.assertEqual(3, scheduler.overruns)
+        self.assertEqual(0, scheduler.ticks_skipped)
+
+    def test_coalesce_fires_overdue_tick_once(self):
+        scheduler = self.scheduler(overrun=PhasedScheduler.COALESCE)
+        ticks = run_ticks(scheduler, self.clock, slots=2, cycles=3, work=lambda t: 25.0 if t.cycle == 0 else 0)
+        self.assertEqual([(0, 0), (2, 1)], [(t.cycle, t.slot) for t in ticks])
+        self.assertAlmostEqual(0.0, ticks[1].lag)
+        self.assertEqual(1, scheduler.overruns)
+        self.assertEqual(4, scheduler.ticks_skipped)
+
+    def test_unknown_overrun_policy(self):
+        with self.assertRaises(ValueError):
+            self.scheduler(overrun='wait')
+
+    def test_period_must_be_positive(self):
+        for period in (0, -1.0):
+            with self.assertRaises(ValueError):
+                PhasedScheduler(period)
+
+    def test_stop(self):
+        scheduler = self.scheduler()
+        ticks = []
+        for tick in scheduler.ticks(slots=2):
+            ticks.append(tick)
+            if len(ticks) == 3:
+                scheduler.stop()
+        self.assertEqual(3, len(ticks))
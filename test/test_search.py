@@ -0,0 +1,91 @@
+import unittest
+
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, String, Table, create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+from munificent import db
+from munificent.nextbus import populate_db
+from munificent.search import EXACT, PREFIX, SIMILAR, WORD_PREFIX, SearchEntry, SearchIndex
+
+from .test_db import FakeAPI, route_config
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        engine = create_engine('sqlite://')
+        db.create_db(engine)
+        cls.session = sessionmaker(bind=engine)()
+        api = FakeAPI({'sf-muni': route_config(), 'actransit': route_config(title='N-Owl')})
+        populate_db(['sf-muni', 'actransit'], api=api, session=cls.session)
+        cls.index = SearchIndex.from_db(cls.session)
+
+    def search(self, query, **kwargs):
+        # Leaving out the trigram matches that fill up the results
+        return [(result.score, result.entry.kind, result.entry.agency, result.entry.tag)
+                for result in self.index.search(query, **kwargs) if result.score >= WORD_PREFIX]
+
+    def test_from_db(self):
+        # 3 routes and 4 stops per agency
+        self.assertEqual(14, len(self.index))
+
+    def test_exact_before_prefix(self):
+        results = self.search('n', kinds=['route'])
+        self.assertEqual({(EXACT, 'route', 'sf-muni', 'N'), (EXACT, 'route', 'actransit', 'N')}, set(results))
+
+        results = self.search('N-J')
+        self.assertEqual([(PREFIX, 'route', 'sf-muni', 'N')], results)
+
+    def test_stop_id(self):
+        self.assertEqual([(EXACT, 'stop', 'sf-muni', '3')], self.search('103', agency='sf-muni'))
+
+    def test_word_prefix(self):
+        self.assertEqual([(WORD_PREFIX, 'route', 'actransit', 'N')], self.search('owl'))
+        self.assertEqual(
+            [(PREFIX, 'stop', 'sf-muni', '1'), (WORD_PREFIX, 'route', 'sf-muni', 'J')],
+            self.search('chu', agency='sf-muni'),
+        )
+
+    def test_typo(self):
+        results = self.index.search('Juddah', kinds=['route'], agency='sf-muni')
+        self.assertEqual('N', results[0].entry.tag)
+        self.assertLess(results[0].score, SIMILAR)
+        self.assertEqual([], self.index.search('xyzzy'))
+
+    def test_limit_and_filters(self):
+        self.assertEqual(1, len(self.index.search('church', limit=1)))
+        self.assertEqual({'stop'}, {kind for _, kind, _, _ in self.search('1', kinds=['stop'])})
+        self.assertEqual([], self.search(''))
+
+    def test_route_entries(self):
+        entries = db.search_route_entries('owl', session=self.session)
+        self.assertEqual([('route', 'actransit', 'N', 'N-Owl')], [entry[:4] for entry in entries])
+
+    def test_prefix_of_many(self):
+        entries = [SearchEntry('stop', 'a', str(i), 'Noriega St & {}th Ave'.format(i), None) for i in range(500)]
+        index = SearchIndex(entries + [SearchEntry('route', 'a', 'N', 'N-Judah', None)])
+        results = index.search('n', limit=5)
+        self.assertEqual((EXACT, 'N'), (results[0].score, results[0].entry.tag))
+        self.assertEqual([PREFIX] * 4, [result.score for result in results[1:]])
+
+
+class TestMigrateDB(unittest.TestCase):
+
+    def test_adds_missing_indexes(self):
+        engine = create_engine('sqlite://')
+        # Reference tables as created before they were indexed
+        metadata = MetaData()
+        Table('agencies', metadata, Column('id', Integer, primary_key=True), Column('tag', String))
+        Table('routes', metadata,
+              Column('id', Integer, primary_key=True), Column('agency_id', Integer, ForeignKey('agencies.id')),
+              Column('tag', String), Column('title', String))
+        metadata.create_all(engine)
+
+        self.assertEqual(['ix_routes_tag', 'ix_routes_title'], db.migrate_db(engine))
+        indexes = {index['name'] for index in inspect(engine).get_indexes('routes')}
+        self.assertTrue({'ix_routes_tag', 'ix_routes_title'} <= indexes)
+        # Missing tables are created with their indexes
+        indexes = {index['name'] for index in inspect(engine).get_indexes('stops')}
+        self.assertTrue({'ix_stops_stopID', 'ix_stops_tag'} <= indexes)
+        self.assertEqual([], db.migrate_db(engine))
@@ -0,0 +1,109 @@
+import random
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from munificent import db
+from munificent.collect import iter_vehicle_locations, parse_vehicle_locations
+from munificent.nextbus import populate_db
+from munificent.spatial import IndexedStop, StopIndex, brute_force_nearest
+
+from . import utils
+from .test_db import FakeAPI, route_config
+
+
+def random_stops(count, rng):
+    return [
+        IndexedStop(str(i), 'Stop {}'.format(i), rng.uniform(37.70, 37.82), rng.uniform(-122.51, -122.36),
+                    ('R{}'.format(i % 5),))
+        for i in range(count)
+    ]
+
+
+class TestStopIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(1)
+        self.stops = random_stops(500, self.rng)
+        self.index = StopIndex(self.stops)
+
+    def random_points(self, count):
+        # Including points outside the indexed area
+        return [(self.rng.uniform(37.6, 37.9), self.rng.uniform(-122.6, -122.3)) for _ in range(count)]
+
+    def test_nearest_matches_brute_force(self):
+        for lat, lon in self.random_points(200):
+            expected = brute_force_nearest(self.stops, lat, lon, 5, self.index.reference_lat)
+            found = self.index.nearest(lat, lon, 5)
+            self.assertEqual([stop for _, stop in expected], [stop for _, stop in found])
+            self.assertAlmostEqual(expected[0][0], found[0][0], places=3)
+
+    def test_nearest_max_distance(self):
+        lat, lon = self.stops[0].lat, self.stops[0].lon
+        found = self.index.nearest(lat, lon, 3, max_distance=1.0)
+        self.assertEqual([self.stops[0]], [stop for _, stop in found])
+        self.assertEqual([], StopIndex(self.stops).nearest(lat + 1, lon, max_distance=1000))
+
+    def test_nearest_far_outside_the_grid(self):
+        # A GPS fix at (0, 0) is thousands of kilometers, and of 10 meter cells, away
+        index = StopIndex(self.stops, cell_size=10)
+        for lat, lon in [(0.0, 0.0), (37.76, 150.0), (37.76, -122.0)]:
+            expected = brute_force_nearest(self.stops, lat, lon, 3, index.reference_lat)
+            self.assertEqual([stop for _, stop in expected], [stop for _, stop in index.nearest(lat, lon, 3)])
+        self.assertEqual([], index.nearest(0.0, 0.0, max_distance=1000))
+
+    def test_within_radius(self):
+        for lat, lon in self.random_points(50):
+            expected = [
+                stop for distance, stop in brute_force_nearest(
+                    self.stops, lat, lon, len(self.stops), self.index.reference_lat)
+                if distance <= 800
+            ]
+            self.assertEqual(expected, [stop for _, stop in self.index.within_radius(lat, lon, 800)])
+
+    def test_within_bbox(self):
+        south, west, north, east = 37.75, -122.45, 37.78, -122.40
+        expected = [s for s in self.stops if south <= s.lat <= north and west <= s.lon <= east]
+        self.assertTrue(expected)
+        self.assertEqual(sorted(expected), sorted(self.index.within_bbox(south, west, north, east)))
+
+    def test_snap_to_route(self):
+        record = {'routeTag': 'R2', 'lat': 37.76, 'lon': -122.42}
+        route_stops = [stop for stop in self.stops if 'R2' in stop.routes]
+        distance, stop = brute_force_nearest(route_stops, 37.76, -122.42, 1, self.index.reference_lat)[0]
+        self.index.snap(record)
+        self.assertEqual(stop.tag, record['nearestStopTag'])
+        self.assertAlmostEqual(distance, record['nearestStopDistance'], places=0)
+
+        unknown = self.index.snap({'routeTag': 'X', 'lat': 37.76, 'lon': -122.42})
+        self.assertIsNone(unknown['nearestStopTag'])
+
+    def test_snapping_parser(self):
+        result = utils.load_json_fixture('vehicle-locations.json')
+        result['_meta'] = {'request_id': 'test', 'timestamp': 0}
+        route = result['vehicle'][0]['routeTag']
+        index = StopIndex([IndexedStop('1', 'Stop', 37.74, -122.46, (route,))])
+        snapped = index.snapping(parse_vehicle_locations)(result)
+        self.assertIsInstance(snapped, list)
+        self.assertEqual('1', snapped[0]['nearestStopTag'])
+
+        result = utils.load_json_fixture('vehicle-locations.json')
+        result['_meta'] = {'request_id': 'test', 'timestamp': 0}
+        self.assertEqual(len(snapped), len(list(index.snapping(iter_vehicle_locations)(result))))
+
+
+class TestStopIndexFromDB(unittest.TestCase):
+
+    def test_from_db(self):
+        engine = create_engine('sqlite://')
+        db.create_db(engine)
+        session = sessionmaker(bind=engine)()
+        api = FakeAPI({'sf-muni': route_config(), 'actransit': route_config()})
+        populate_db(['sf-muni', 'actransit'], api=api, session=session)
+
+        index = StopIndex.from_db(session=session, agency='sf-muni')
+        self.assertEqual(4, len(index))
+        shared = [stop for stop in index.stops if stop.tag == '1'][0]
+        self.assertEqual(('J', 'N'), tuple(sorted(shared.routes)))
+        self.assertEqual(8, len(StopIndex.from_db(session=session)))
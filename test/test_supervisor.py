@@ -0,0 +1,75 @@
+import collections
+import functools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from munificent.supervisor import Supervisor, shard_for, shard_path, shard_probes
+
+FakeProbe = collections.namedtuple('FakeProbe', ['name'])
+
+
+def crash_once(marker_dir, shard):
+    marker = os.path.join(marker_dir, str(shard))
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        raise RuntimeError("Worker crashed")
+
+
+def sleep_forever(shard):
+    while True:
+        time.sleep(0.1)
+
+
+class TestSharding(unittest.TestCase):
+
+    def test_assignments_stable_when_adding_shards(self):
+        keys = [str(i) for i in range(200)]
+        before = {key: shard_for(key, 4) for key in keys}
+        after = {key: shard_for(key, 5) for key in keys}
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(after[key] == 4 for key in moved))
+        self.assertEqual(set(range(4)), set(before.values()))
+
+    def test_shard_probes_by_route(self):
+        probes = [FakeProbe('{}:{}'.format(kind, route)) for route in 'FJLMN' for kind in ['predictions', 'locations']]
+        shards = [shard_probes(probes, shard, 3) for shard in range(3)]
+        self.assertEqual(sorted(probes), sorted(p for shard in shards for p in shard))
+        for shard in shards:
+            for probe in shard:
+                route = probe.name.partition(':')[2]
+                self.assertIn(FakeProbe('predictions:' + route), shard)
+                self.assertIn(FakeProbe('locations:' + route), shard)
+
+    def test_shard_path(self):
+        self.assertEqual('out/data-w2.jsonl.gz', shard_path('out/data.jsonl.gz', 2))
+        self.assertEqual('{target}-2-{YYYYMMDD}.jsonl', shard_path('{target}-{worker}-{YYYYMMDD}.jsonl', 2))
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_crashed_workers_restarted(self):
+        # Workers must be picklable to be started with spawn (macOS, Windows)
+        supervisor = Supervisor(
+            functools.partial(crash_once, self.tmp_dir), 2, restart_delay=0.05, poll_interval=0.05)
+        supervisor.run()
+        self.assertEqual(2, supervisor.restarts)
+        self.assertEqual(['0', '1'], sorted(os.listdir(self.tmp_dir)))
+
+    def test_stop_terminates_workers(self):
+        supervisor = Supervisor(sleep_forever, 2, poll_interval=0.05)
+        threading.Timer(0.5, supervisor.stop).start()
+        start = time.time()
+        supervisor.run()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(0, supervisor.restarts)